@@ -15,7 +15,10 @@ limitations under the License."""
 
 import sys
 import imp
-from os.path import dirname, join, abspath, exists
+import time
+import gzip
+from collections import deque
+from os.path import dirname, join, abspath, exists, getsize
 from optparse import OptionParser
 
 # Figure out where we're installed
@@ -37,8 +40,9 @@ except ImportError:
 
 from twisted.internet import stdio, reactor, defer
 from twisted.protocols.basic import LineReceiver
-from carbon.routers import ConsistentHashingRouter, RelayRulesRouter
+from carbon.routers import RelayRulesRouter, HASHING_ROUTERS
 from carbon.client import CarbonClientManager
+from carbon.conf import settings
 from carbon import log, events
 
 
@@ -47,9 +51,21 @@ option_parser.add_option('--debug', action='store_true', help="Log debug info to
 option_parser.add_option('--keyfunc', help="Use a custom key function (path/to/module.py:myFunc)")
 option_parser.add_option('--replication', type='int', default=1, help='Replication factor')
 option_parser.add_option('--routing', default='consistent-hashing',
-  help='Routing method: "consistent-hashing" (default) or "relay"')
+  help='Routing method: "consistent-hashing" (default), "jump-hashing", "rendezvous-hashing" or "relay"')
 option_parser.add_option('--relayrules', default=default_relayrules,
   help='relay-rules.conf file to use for relay routing')
+option_parser.add_option('--protocol', default='pickle',
+  help='Message encoding: "pickle" (default) or "binary"')
+option_parser.add_option('--input',
+  help='Bulk load this file (plain or gzipped) instead of reading stdin')
+option_parser.add_option('--offset', type='int', default=0,
+  help='Resume a bulk load at this (uncompressed) byte offset')
+option_parser.add_option('--chunk-size', type='int', default=4 * 2 ** 20,
+  help='Bytes read and parsed at a time by a bulk load (default 4MB)')
+option_parser.add_option('--max-queue-size', type='int', default=100000,
+  help='Datapoints a bulk load may queue per destination (default 100000)')
+option_parser.add_option('--progress-interval', type='float', default=5.0,
+  help='Seconds between progress reports of a bulk load (default 5)')
 
 options, args = option_parser.parse_args()
 
@@ -58,12 +74,20 @@ if not args:
   option_parser.print_usage()
   raise SystemExit(1)
 
-if options.routing not in ('consistent-hashing', 'relay'):
+if options.routing not in ('consistent-hashing', 'jump-hashing', 'rendezvous-hashing', 'relay'):
   print "Invalid --routing value, must be one of:"
   print "  consistent-hashing"
+  print "  jump-hashing"
+  print "  rendezvous-hashing"
   print "  relay"
   raise SystemExit(1)
 
+if options.protocol not in ('pickle', 'binary'):
+  print "Invalid --protocol value, must be one of:"
+  print "  pickle"
+  print "  binary"
+  raise SystemExit(1)
+
 destinations = []
 for arg in args:
   parts = arg.split(':', 2)
@@ -75,13 +99,20 @@ for arg in args:
     instance = None
   destinations.append( (host, port, instance) )
 
+if options.input and not exists(options.input):
+  print "input file %s does not exist" % options.input
+  raise SystemExit(1)
+
+if options.input:
+  settings['MAX_QUEUE_SIZE'] = options.max_queue_size
+
 if options.debug:
   log.logToStdout()
   log.setDebugEnabled(True)
   defer.setDebugging(True)
 
-if options.routing == 'consistent-hashing':
-  router = ConsistentHashingRouter(options.replication)
+if options.routing in HASHING_ROUTERS:
+  router = HASHING_ROUTERS[options.routing](options.replication)
 elif options.routing == 'relay':
   if exists(options.relayrules):
     router = RelayRulesRouter(options.relayrules)
@@ -89,7 +120,7 @@ elif options.routing == 'relay':
     print "relay rules file %s does not exist" % options.relayrules
     raise SystemExit(1)
 
-client_manager = CarbonClientManager(router)
+client_manager = CarbonClientManager(router, options.protocol)
 reactor.callWhenRunning(client_manager.startService)
 
 if options.keyfunc:
@@ -114,13 +145,138 @@ class StdinMetricsReader(LineReceiver):
 
   def connectionLost(self, reason):
     log.msg('stdin disconnected')
-    def startShutdown(results):
-      log.msg("startShutdown(%s)" % str(results))
-      allStopped = client_manager.stopAllClients()
-      allStopped.addCallback(shutdown)
     firstConnectsAttempted.addCallback(startShutdown)
 
-stdio.StandardIO( StdinMetricsReader() )
+class BulkFileReader:
+  """ Loads a file of 'metric value timestamp' lines a chunk at a time,
+  sending only as much as fits in the destinations' send queues. Progress
+  reports include the offset up to which everything has been handed to the
+  network, which --offset can resume from. """
+  PACING_DELAY = 0.01
+
+  def __init__(self, path, offset, chunk_size):
+    self.path = path
+    if open(path, 'rb').read(2) == '\x1f\x8b':
+      self.file = gzip.open(path, 'rb')
+      self.rawFile = self.file.fileobj
+    else:
+      self.file = self.rawFile = open(path, 'rb')
+    self.size = getsize(path)
+    self.file.seek(offset)
+    self.chunk_size = chunk_size
+    self.partial = ''
+    self.pending = [] # datapoints of the current chunk, sent up to pendingIndex
+    self.pendingIndex = 0
+    self.startOffset = self.chunkEnd = offset
+    self.checkpoints = deque() # (datapoints sent, offset) at chunk ends
+    self.safeOffset = offset # end of the data that has left the send queues
+    self.datapoints = 0
+    self.invalid = 0
+    self.finished = False
+    self.startTime = self.lastReport = time.time()
+    self.lastReportDatapoints = 0
+
+  def start(self, results=None):
+    log.msg("bulk loading %s from offset %d" % (self.path, self.safeOffset))
+    self.sendMore()
+
+  def queuedDatapoints(self):
+    return sum([f.queueSize for f in client_manager.client_factories.values()])
+
+  def updateSafeOffset(self):
+    # Whatever is still queued is among the most recently sent datapoints
+    left = self.datapoints - self.queuedDatapoints()
+    while self.checkpoints and self.checkpoints[0][0] <= left:
+      self.safeOffset = self.checkpoints.popleft()[1]
+
+  def queueSpace(self):
+    sizes = [f.queueSize for f in client_manager.client_factories.values()]
+    return settings.MAX_QUEUE_SIZE - max(sizes or [0])
+
+  def readChunk(self):
+    data = self.file.read(self.chunk_size)
+    if not data:
+      self.finished = True
+      if self.partial:
+        data, self.partial = self.partial + '\n', ''
+      else:
+        return
+
+    lines = (self.partial + data).split('\n')
+    self.partial = lines.pop()
+    self.pending = []
+    self.pendingIndex = 0
+    for line in lines:
+      try:
+        (metric, value, timestamp) = line.split()
+        datapoint = (float(timestamp), float(value))
+        if datapoint[1] != datapoint[1]: # filter out NaNs
+          continue
+        self.pending.append( (metric, datapoint) )
+      except ValueError:
+        if line.strip():
+          self.invalid += 1
+    self.chunkEnd = self.file.tell() - len(self.partial)
+
+  def hasPending(self):
+    return self.pendingIndex < len(self.pending)
+
+  def sendMore(self):
+    space = self.queueSpace()
+    while space > 0:
+      if not self.hasPending():
+        if self.finished:
+          break
+        self.readChunk()
+        if not self.hasPending():
+          self.checkpoints.append( (self.datapoints, self.chunkEnd) )
+          continue
+
+      count = min(space, len(self.pending) - self.pendingIndex)
+      batch = self.pending[self.pendingIndex:self.pendingIndex + count]
+      self.pendingIndex += count
+      client_manager.sendDatapoints(batch)
+      self.datapoints += count
+      space -= count
+      if not self.hasPending():
+        self.checkpoints.append( (self.datapoints, self.chunkEnd) )
+
+    self.updateSafeOffset()
+    now = time.time()
+    if now - self.lastReport >= options.progress_interval:
+      self.reportProgress(now)
+
+    if self.finished and not self.hasPending():
+      if not self.queuedDatapoints():
+        self.reportProgress(time.time())
+        log.msg("bulk load complete, %d invalid lines skipped" % self.invalid)
+        self.file.close()
+        startShutdown(None)
+        return
+    reactor.callLater(self.PACING_DELAY, self.sendMore)
+
+  def reportProgress(self, now):
+    rate = (self.datapoints - self.lastReportDatapoints) / max(now - self.lastReport, 0.001)
+    elapsed = max(now - self.startTime, 0.001)
+    percent = 100.0 * self.rawFile.tell() / max(self.size, 1)
+    print >> sys.stderr, ("%5.1f%% read, %d datapoints sent (%d/s now, %d/s overall, %.1f MB/s), "
+                          "resume with --offset %d" % (percent, self.datapoints, rate,
+                          self.datapoints / elapsed, (self.file.tell() - self.startOffset) / elapsed / 2 ** 20, self.safeOffset))
+    self.lastReport = now
+    self.lastReportDatapoints = self.datapoints
+
+
+def startShutdown(results):
+  log.msg("startShutdown(%s)" % str(results))
+  allStopped = client_manager.stopAllClients()
+  allStopped.addCallback(shutdown)
+
+
+if options.input:
+  bulkReader = BulkFileReader(options.input, options.offset, options.chunk_size)
+  firstConnectsAttempted.addCallback(bulkReader.start)
+else:
+  stdio.StandardIO( StdinMetricsReader() )
 
 exitCode = 0
 def shutdown(results):
@@ -1,12 +1,25 @@
+import sys
 import time
-from twisted.internet.task import LoopingCall
+import struct
+from twisted.internet.task import LoopingCall, cooperate
 from carbon.conf import settings
 from carbon import log
+from carbon.aggregator.sketch import QuantileSketch, isFinite
+
+
+# What a raw value held in a list would take: a float and the list's pointer to it
+VALUE_SIZE = sys.getsizeof(0.0) + struct.calcsize('P')
 
 
 class BufferManager:
+  """Owns the metric buffers and computes them. Buffers are grouped by
+  aggregation frequency and each group is computed in a single sweep by one
+  timer, rather than every buffer running its own. What a sweep computes is
+  sent in batches of up to AGGREGATION_SWEEP_SIZE buffers, which the client
+  manager routes a destination at a time."""
   def __init__(self):
     self.buffers = {}
+    self.schedules = {} # { frequency : (compute task, set of buffers) }
 
   def __len__(self):
     return len(self.buffers)
@@ -18,24 +31,92 @@ class BufferManager:
 
     return self.buffers[metric_path]
 
-  def clear(self):
-    for buffer in self.buffers.values():
+  def remove_buffer(self, metric_path):
+    buffer = self.buffers.pop(metric_path, None)
+    if buffer is not None:
       buffer.close()
 
+  def schedule(self, buffer):
+    frequency = buffer.aggregation_frequency
+    if frequency not in self.schedules:
+      compute_task = LoopingCall(self.compute_values, frequency)
+      self.schedules[frequency] = (compute_task, set())
+      compute_task.start(frequency, now=False)
+    self.schedules[frequency][1].add(buffer)
+
+  def unschedule(self, buffer):
+    schedule = self.schedules.get(buffer.aggregation_frequency)
+    if schedule:
+      compute_task, buffers = schedule
+      buffers.discard(buffer)
+      if not buffers:
+        if compute_task.running:
+          compute_task.stop()
+        del self.schedules[buffer.aggregation_frequency]
+
+  def compute_values(self, frequency):
+    schedule = self.schedules.get(frequency)
+    if not schedule:
+      return
+
+    now = int( time.time() )
+    if len(schedule[1]) <= settings.AGGREGATION_SWEEP_SIZE:
+      self.compute_batch(schedule[1], now)
+    else:
+      cooperate( self.compute_batches(list(schedule[1]), now) )
+
+  def compute_batches(self, buffers, now):
+    """Computes a large sweep AGGREGATION_SWEEP_SIZE buffers at a time, so
+    receiving carries on between the batches"""
+    batch_size = settings.AGGREGATION_SWEEP_SIZE
+    for i in xrange(0, len(buffers), batch_size):
+      # Skip buffers removed since the sweep started
+      batch = [buffer for buffer in buffers[i:i + batch_size]
+               if self.buffers.get(buffer.metric_path) is buffer]
+      self.compute_batch(batch, now)
+      yield None
+
+  def compute_batch(self, buffers, now):
+    datapoints = []
+    for buffer in buffers:
+      buffer.compute_value(now, datapoints)
+
+    if datapoints:
+      state.events.metricsGenerated(datapoints)
+      state.instrumentation.increment('aggregateDatapointsSent', len(datapoints))
+
+  def memory_saved(self):
+    """Estimates the bytes saved by accumulating values rather than keeping
+    every value received in the interval"""
+    values = 0
+    for buffer in self.buffers.values():
+      for interval_buffer in buffer.interval_buffers.values():
+        values += interval_buffer.count
+        if interval_buffer.sketch is not None:
+          values -= len(interval_buffer.sketch)
+    return max(values, 0) * VALUE_SIZE
+
+  def clear(self):
+    for compute_task, buffers in self.schedules.values():
+      if compute_task.running:
+        compute_task.stop()
+
+    self.schedules.clear()
     self.buffers.clear()
 
 
 class MetricBuffer:
-  __slots__ = ('metric_path', 'interval_buffers', 'compute_task', 'configured',
-               'aggregation_frequency', 'aggregation_func')
+  __slots__ = ('metric_path', 'interval_buffers', 'configured',
+               'aggregation_frequency', 'aggregation_func', 'sketched', 'rule')
 
   def __init__(self, metric_path):
     self.metric_path = metric_path
     self.interval_buffers = {}
-    self.compute_task = None
     self.configured = False
     self.aggregation_frequency = None
     self.aggregation_func = None
+    self.sketched = False
+    self.rule = None # the aggregation rule that configured the buffer
 
   def input(self, datapoint):
     (timestamp, value) = datapoint
@@ -43,52 +124,77 @@ class MetricBuffer:
     if interval in self.interval_buffers:
       buffer = self.interval_buffers[interval]
     else:
-      buffer = self.interval_buffers[interval] = IntervalBuffer(interval)
+      buffer = self.interval_buffers[interval] = IntervalBuffer(interval, self.sketched)
 
     buffer.input(datapoint)
 
-  def configure_aggregation(self, frequency, func):
+  def configure_aggregation(self, frequency, func, rule=None):
+    self.rule = rule
     self.aggregation_frequency = int(frequency)
     self.aggregation_func = func
-    self.compute_task = LoopingCall(self.compute_value)
-    self.compute_task.start(frequency, now=False)
+    self.sketched = getattr(func, 'quantile', None) is not None
+    BufferManager.schedule(self)
     self.configured = True
 
-  def compute_value(self):
-    now = int( time.time() )
+  def compute_value(self, now, datapoints):
+    """Appends the values of the intervals that received data since the last
+    computation to datapoints, as (metric, datapoint) tuples"""
     current_interval = now - (now % self.aggregation_frequency)
     age_threshold = current_interval - (settings['MAX_AGGREGATION_INTERVALS'] * self.aggregation_frequency)
 
     for buffer in self.interval_buffers.values():
       if buffer.active:
-        value = self.aggregation_func(buffer.values)
-        datapoint = (buffer.interval, value)
-        state.events.metricGenerated(self.metric_path, datapoint)
-        state.instrumentation.increment('aggregateDatapointsSent')
+        value = self.aggregation_func(buffer)
+        datapoints.append( (self.metric_path, (buffer.interval, value)) )
         buffer.mark_inactive()
 
       if buffer.interval < age_threshold:
         del self.interval_buffers[buffer.interval]
 
   def close(self):
-    if self.compute_task and self.compute_task.running:
-      self.compute_task.stop()
+    if self.configured:
+      BufferManager.unschedule(self)
 
   @property
   def size(self):
-    return sum([len(buf.values) for buf in self.interval_buffers.values()])
+    return sum([buf.count for buf in self.interval_buffers.values()])
 
 
 class IntervalBuffer:
-  __slots__ = ('interval', 'values', 'active')
+  """Accumulates the values of one interval in constant memory, keeping
+  their count, sum, min, max and last value, plus a quantile sketch when
+  the aggregation method needs one"""
+  __slots__ = ('interval', 'count', 'sum', 'min', 'max', 'last', 'sketch', 'active')
 
-  def __init__(self, interval):
+  def __init__(self, interval, sketched=False):
     self.interval = interval
-    self.values = []
+    self.count = 0
+    self.sum = 0
+    self.min = None
+    self.max = None
+    self.last = None
+    if sketched:
+      self.sketch = QuantileSketch()
+    else:
+      self.sketch = None
     self.active = True
 
   def input(self, datapoint):
-    self.values.append( datapoint[1] )
+    value = datapoint[1]
+    if not isFinite(value): # would turn every aggregate of the interval into inf or NaN
+      return
+    if self.count:
+      if value < self.min:
+        self.min = value
+      elif value > self.max:
+        self.max = value
+    else:
+      self.min = self.max = value
+    self.count += 1
+    self.sum += value
+    self.last = value
+    if self.sketch is not None:
+      self.sketch.add(value)
     self.active = True
 
   def mark_inactive(self):
@@ -1,3 +1,4 @@
+from carbon import log
 from carbon.instrumentation import increment
 from carbon.aggregator.rules import RuleManager
 from carbon.aggregator.buffers import BufferManager
@@ -6,30 +7,47 @@ from carbon import events
 
 
 def process(metric, datapoint):
-  increment('datapointsReceived')
+  process_many([(metric, datapoint)])
 
-  for rule in RewriteRuleManager.preRules:
-    metric = rule.apply(metric)
 
-  aggregate_metrics = []
-
-  for rule in RuleManager.rules:
-    aggregate_metric = rule.get_aggregate_metric(metric)
+def process_many(datapoints):
+  increment('datapointsReceived', len(datapoints))
+  passthrough = []
 
-    if aggregate_metric is None:
+  for (metric, datapoint) in datapoints:
+    try:
+      passthrough_datapoint = process_datapoint(metric, datapoint)
+    except:
+      log.err(None, "Exception aggregating %s: datapoint=%s" % (metric, datapoint))
       continue
-    else:
-      aggregate_metrics.append(aggregate_metric)
+    if passthrough_datapoint is not None:
+      passthrough.append(passthrough_datapoint)
+
+  if passthrough:
+    events.metricsGenerated(passthrough)
 
-    buffer = BufferManager.get_buffer(aggregate_metric)
 
-    if not buffer.configured:
-      buffer.configure_aggregation(rule.frequency, rule.aggregation_func)
+def process_datapoint(metric, datapoint):
+  """Feeds the datapoint into every matching aggregate buffer and returns
+  the (metric, datapoint) to pass through unaggregated, or None"""
+  metric = RewriteRuleManager.preRules.apply(metric)
+
+  aggregate_metrics = []
 
-    buffer.input(datapoint)
+  for rule, aggregate_metric in RuleManager.get_aggregate_metrics(metric):
+    aggregate_metrics.append(aggregate_metric)
+    aggregate(rule, aggregate_metric, datapoint)
 
-  for rule in RewriteRuleManager.postRules:
-    metric = rule.apply(metric)
+  metric = RewriteRuleManager.postRules.apply(metric)
 
   if metric not in aggregate_metrics:
-    events.metricGenerated(metric, datapoint)
+    return (metric, datapoint)
+
+
+def aggregate(rule, aggregate_metric, datapoint):
+  buffer = BufferManager.get_buffer(aggregate_metric)
+
+  if not buffer.configured:
+    buffer.configure_aggregation(rule.frequency, rule.aggregation_func, rule)
+
+  buffer.input(datapoint)
@@ -1,20 +1,48 @@
 import time
 import re
+from operator import attrgetter
 from os.path import exists, getmtime
 from twisted.internet.task import LoopingCall
-from carbon import log
+from carbon import log, state
+from carbon.conf import settings
+from carbon.util import LRUCache
 from carbon.aggregator.buffers import BufferManager
 
 
+# Characters that make a pattern component more than a literal name
+NON_LITERAL_CHARS = set('<>*^$+?{}[]()|\\')
+
+
 class RuleManager:
   def __init__(self):
     self.rules = []
     self.rules_file = None
     self.read_task = LoopingCall(self.read_rules)
     self.rules_last_read = 0.0
+    self.index = RuleIndex([])
+    self.cache = LRUCache(settings.AGGREGATION_RULE_CACHE_SIZE)
 
   def clear(self):
-    self.rules = []
+    self.set_rules([])
+
+  def set_rules(self, rules):
+    self.rules = rules
+    self.index = RuleIndex(rules)
+    self.cache.max_size = settings.AGGREGATION_RULE_CACHE_SIZE
+    self.cache.clear()
+
+  def get_aggregate_metrics(self, metric_path):
+    """Returns a tuple of (rule, aggregate metric) for the rules the metric
+    matches, in rule order"""
+    aggregates = self.cache.get(metric_path)
+    if aggregates is None:
+      aggregates = []
+      for rule in self.index.candidates(metric_path):
+        aggregate_metric = rule.get_aggregate_metric(metric_path)
+        if aggregate_metric is not None:
+          aggregates.append( (rule, aggregate_metric) )
+      aggregates = self.cache[metric_path] = tuple(aggregates)
+    return aggregates
 
   def read_from(self, rules_file):
     self.rules_file = rules_file
@@ -37,6 +65,7 @@ class RuleManager:
 
     # Read new rules
     log.aggregator("reading new aggregation rules from %s" % self.rules_file)
+    start = time.time()
     new_rules = []
     for line in open(self.rules_file):
       line = line.strip()
@@ -46,11 +75,36 @@ class RuleManager:
       rule = self.parse_definition(line)
       new_rules.append(rule)
 
-    log.aggregator("clearing aggregation buffers")
-    BufferManager.clear()
-    self.rules = new_rules
+    self.update_rules(new_rules)
     self.rules_last_read = mtime
 
+    reload_time = time.time() - start
+    log.aggregator("reloaded aggregation rules in %.3f seconds" % reload_time)
+    state.instrumentation.increment('aggregationRules.reloadTime', reload_time)
+
+  def update_rules(self, new_rules):
+    """Replaces the rules, keeping the rules that are unchanged along with
+    their buffers and only closing the buffers of rules that were removed"""
+    current_rules = dict((rule.key, rule) for rule in self.rules)
+    rules = []
+    for rule in new_rules:
+      rules.append( current_rules.pop(rule.key, rule) )
+    removed_rules = set(current_rules.values())
+    unchanged_rules = set(self.rules)
+    added = len([rule for rule in rules if rule not in unchanged_rules])
+
+    buffers_removed = 0
+    if removed_rules:
+      for metric_path, buffer in BufferManager.buffers.items():
+        if buffer.rule in removed_rules:
+          BufferManager.remove_buffer(metric_path)
+          buffers_removed += 1
+
+    self.set_rules(rules)
+    log.aggregator("aggregation rules: %d added, %d removed, %d unchanged, %d buffers closed" %
+                   (added, len(removed_rules), len(rules) - added, buffers_removed))
+    state.instrumentation.increment('aggregationRules.buffersRemoved', buffers_removed)
+
   def parse_definition(self, line):
     try:
       left_side, right_side = line.split('=', 1)
@@ -70,19 +124,16 @@ class AggregationRule:
     self.output_pattern = output_pattern
     self.method = method
     self.frequency = int(frequency)
+    self.key = (input_pattern, output_pattern, method, self.frequency)
 
-    if method not in AGGREGATION_METHODS:
+    self.aggregation_func = get_aggregation_func(method)
+    if self.aggregation_func is None:
       raise ValueError("Invalid aggregation method '%s'" % method)
 
-    self.aggregation_func = AGGREGATION_METHODS[method]
     self.build_regex()
     self.build_template()
-    self.cache = {}
 
   def get_aggregate_metric(self, metric_path):
-    if metric_path in self.cache:
-      return self.cache[metric_path]
-
     match = self.regex.match(metric_path)
     result = None
 
@@ -93,7 +144,6 @@ class AggregationRule:
       except:
         log.err("Failed to interpolate template %s with fields %s" % (self.output_template, extracted_fields))
 
-    self.cache[metric_path] = result
     return result
 
   def build_regex(self):
@@ -131,15 +181,101 @@ class AggregationRule:
     self.output_template = self.output_pattern.replace('<', '%(').replace('>', ')s')
 
 
-def avg(values):
-  if values:
-    return float( sum(values) ) / len(values)
+class RuleIndex:
+  """A trie over the dot separated components of the rules' input patterns,
+  so a metric is only matched against rules whose literal components it
+  has. Components with wildcards or fields follow a single wildcard branch.
+  The last component isn't indexed (rules match it as a prefix), nor is
+  anything from a <<field>> on, which can span components; rules are
+  attached to the node where their indexable components end."""
+  def __init__(self, rules):
+    self.rule_order = {}
+    self.root = RuleIndexNode()
+    for position, rule in enumerate(rules):
+      self.rule_order[rule] = position
+      self.add(rule)
+
+  def add(self, rule):
+    node = self.root
+    for part in rule.input_pattern.split('.')[:-1]:
+      if '<<' in part:
+        break
+      if NON_LITERAL_CHARS.intersection(part):
+        if node.wildcard is None:
+          node.wildcard = RuleIndexNode()
+        node = node.wildcard
+      else:
+        node = node.children.setdefault(part, RuleIndexNode())
+    node.rules.append(rule)
+
+  def candidates(self, metric_path):
+    parts = metric_path.split('.')
+    found = []
+    nodes = [self.root]
+    depth = 0
+    while nodes:
+      next_nodes = []
+      for node in nodes:
+        found.extend(node.rules)
+        if depth < len(parts):
+          child = node.children.get(parts[depth])
+          if child is not None:
+            next_nodes.append(child)
+          if node.wildcard is not None:
+            next_nodes.append(node.wildcard)
+      nodes = next_nodes
+      depth += 1
+
+    if len(found) > 1:
+      found.sort(key=self.rule_order.get)
+    return found
 
 
+class RuleIndexNode:
+  __slots__ = ('children', 'wildcard', 'rules')
+
+  def __init__(self):
+    self.children = {}
+    self.wildcard = None
+    self.rules = []
+
+
+def avg(buffer):
+  if buffer.count:
+    return float(buffer.sum) / buffer.count
+
+
+class Percentile:
+  "Aggregates with the interval buffer's quantile sketch"
+  def __init__(self, percent):
+    self.quantile = percent / 100.0
+
+  def __call__(self, buffer):
+    return buffer.sketch.quantile(self.quantile)
+
+
+def get_aggregation_func(method):
+  "The function of an interval buffer for a method name, or None"
+  if method in AGGREGATION_METHODS:
+    return AGGREGATION_METHODS[method]
+
+  match = PERCENTILE_METHOD.match(method)
+  if match and float(match.group(1)) <= 100:
+    return Percentile(float(match.group(1)))
+
+
+# Aggregation functions take the IntervalBuffer accumulating the values
 AGGREGATION_METHODS = {
-  'sum' : sum,
+  'sum' : attrgetter('sum'),
   'avg' : avg,
+  'min' : attrgetter('min'),
+  'max' : attrgetter('max'),
+  'count' : attrgetter('count'),
+  'last' : attrgetter('last'),
 }
 
+# p50, p99.9 and so on
+PERCENTILE_METHOD = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
 # Importable singleton
 RuleManager = RuleManager()
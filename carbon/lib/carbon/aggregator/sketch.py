@@ -0,0 +1,96 @@
+import math
+
+
+def isFinite(value):
+  "False for infinities and NaN, whose difference with themselves is NaN"
+  return value - value == 0
+
+
+class QuantileSketch:
+  """Estimates quantiles of a stream of values in bounded memory. Values
+  are counted in buckets whose bounds grow geometrically, so any quantile
+  is estimated to within relative_accuracy of the true value. Sketches with
+  the same accuracy can be merged. Should the buckets ever exceed
+  max_buckets, the smallest magnitudes are collapsed together, sacrificing
+  the accuracy of the lowest quantiles first."""
+  __slots__ = ('gamma', 'log_gamma', 'max_buckets', 'positive', 'negative',
+               'zeros', 'count')
+
+  def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+    self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_buckets = max_buckets
+    self.positive = {} # { bucket key : count }
+    self.negative = {}
+    self.zeros = 0
+    self.count = 0
+
+  def __len__(self):
+    return len(self.positive) + len(self.negative) + bool(self.zeros)
+
+  def key(self, magnitude):
+    return int( math.ceil(math.log(magnitude) / self.log_gamma) )
+
+  def value(self, key):
+    "The estimate for every value in a bucket, which has the least relative error"
+    return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+  def add(self, value):
+    if not isFinite(value):
+      return
+
+    if value > 0:
+      key = self.key(value)
+      self.positive[key] = self.positive.get(key, 0) + 1
+    elif value < 0:
+      key = self.key(-value)
+      self.negative[key] = self.negative.get(key, 0) + 1
+    else:
+      self.zeros += 1
+
+    self.count += 1
+    if len(self.positive) + len(self.negative) > self.max_buckets:
+      self.collapse()
+
+  def merge(self, other):
+    if other.gamma != self.gamma:
+      raise ValueError("Cannot merge sketches of different accuracy")
+
+    for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+      for key, count in other_buckets.iteritems():
+        buckets[key] = buckets.get(key, 0) + count
+    self.zeros += other.zeros
+    self.count += other.count
+
+    while len(self.positive) + len(self.negative) > self.max_buckets:
+      self.collapse()
+
+  def collapse(self):
+    if len(self.negative) > 1:
+      buckets = self.negative
+    else:
+      buckets = self.positive
+    keys = sorted(buckets)
+    while len(self.positive) + len(self.negative) > self.max_buckets and len(keys) > 1:
+      smallest = keys.pop(0)
+      buckets[keys[0]] += buckets.pop(smallest)
+
+  def quantile(self, q):
+    if not self.count:
+      return None
+
+    rank = min(max(q, 0.0), 1.0) * (self.count - 1)
+    seen = 0
+    for key in sorted(self.negative, reverse=True):
+      seen += self.negative[key]
+      if seen > rank:
+        return -self.value(key)
+
+    seen += self.zeros
+    if seen > rank:
+      return 0.0
+
+    for key in sorted(self.positive):
+      seen += self.positive[key]
+      if seen > rank:
+        return self.value(key)
@@ -0,0 +1,244 @@
+"""Multi-process aggregation.
+
+With AGGREGATOR_PROCESSES set, carbon-aggregator spawns that many
+aggregator processes and partitions the aggregates between them by a hash
+of the aggregate metric's name, so every aggregate is buffered in exactly
+one process. The daemon itself keeps receiving and parsing, applies the
+pre rewrite rules, matches the aggregation rules and forwards the datapoint
+to the process each aggregate belongs to over a local UNIX socket using the
+binary format from carbon.binaryformat. The datapoint is sent under the
+aggregate's name followed by its rule (see getRuleKey), so the aggregator
+processes don't match the rules again. Metrics that aren't aggregated are
+passed through by the daemon. The aggregator processes send what they
+compute straight to DESTINATIONS.
+
+Receiving is held paused until the daemon has connected to every
+aggregator process, whatever else tries to resume it meanwhile, and
+datapoints for a process that is down are buffered up to MAX_QUEUE_SIZE
+and counted as aggregatorProcessDrops beyond that.
+"""
+
+import os
+import sys
+import zlib
+from os.path import exists, join
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from carbon.conf import settings
+from carbon.util import pickle, parseDestinations
+from carbon.workers import ReceiverSupervisor, ChannelFactory, exitWithParent
+from carbon import log, events, state, instrumentation
+
+
+def getChannelPath(worker_id):
+  return os.path.splitext(settings['pidfile'])[0] + '.aggregator-%d.sock' % worker_id
+
+
+def getPartition(aggregate_metric, count):
+  "The aggregator process an aggregate metric belongs to"
+  if isinstance(aggregate_metric, unicode): # ie. from a pickle
+    aggregate_metric = aggregate_metric.encode('utf-8')
+  return (zlib.crc32(aggregate_metric) & 0xffffffff) % count
+
+
+def getRuleKey(rule):
+  "Identifies a rule to the aggregator processes, metric names have no spaces"
+  return '%s %s %s %d' % rule.key
+
+
+#
+# Daemon side
+#
+
+class AggregatorSupervisor(ReceiverSupervisor):
+  worker_name = 'aggregator'
+  worker_module = 'carbon.aggregator.workers'
+
+  def getArgs(self, worker_id):
+    return [str(worker_id), str(self.count)]
+
+
+class AggregatorChannelFactory(ChannelFactory):
+  drop_stat = 'aggregatorProcessDrops'
+
+  def __init__(self, worker_id, dispatcher=None):
+    ChannelFactory.__init__(self, worker_id)
+    self.dispatcher = dispatcher
+
+  def log(self, message):
+    log.aggregator("aggregator process %d %s" % (self.worker_id, message))
+
+  def connected(self, channel):
+    ChannelFactory.connected(self, channel)
+    if self.dispatcher is not None:
+      self.dispatcher.channelConnected(self)
+
+
+class AggregatorDispatcher:
+  "Forwards datapoints to the aggregator processes owning their aggregates"
+
+  def __init__(self, count):
+    self.channels = [AggregatorChannelFactory(worker_id, self) for worker_id in range(count)]
+    self.waiting = set(self.channels)
+    self.rules = None
+    self.rule_keys = {}
+
+  def connect(self):
+    self.holdReceiving()
+    for channel in self.channels:
+      reactor.connectUNIX(getChannelPath(channel.worker_id), channel)
+
+  def holdReceiving(self):
+    "Keeps receiving paused until every aggregator process is listening"
+    state.metricReceiversHeld = True
+    events.pauseReceivingMetrics()
+
+  def channelConnected(self, channel):
+    if channel in self.waiting:
+      self.waiting.discard(channel)
+      if not self.waiting:
+        log.aggregator("connected to all %d aggregator processes" % len(self.channels))
+        state.metricReceiversHeld = False
+        events.resumeReceivingMetrics()
+
+  def getRuleKey(self, rule):
+    from carbon.aggregator.rules import RuleManager
+
+    if self.rules is not RuleManager.rules:
+      self.rules = RuleManager.rules
+      self.rule_keys = dict([(r, getRuleKey(r)) for r in self.rules])
+    rule_key = self.rule_keys.get(rule)
+    if rule_key is None:
+      rule_key = self.rule_keys[rule] = getRuleKey(rule)
+    return rule_key
+
+  def process_many(self, datapoints):
+    from carbon.aggregator.rules import RuleManager
+    from carbon.rewrite import RewriteRuleManager
+
+    count = len(self.channels)
+    batches = [[] for channel in self.channels]
+    passthrough = []
+
+    for (metric, datapoint) in datapoints:
+      metric = RewriteRuleManager.preRules.apply(metric)
+
+      aggregate_metrics = []
+      for rule, aggregate_metric in RuleManager.get_aggregate_metrics(metric):
+        aggregate_metrics.append(aggregate_metric)
+        batches[getPartition(aggregate_metric, count)].append(
+          ('%s %s' % (aggregate_metric, self.getRuleKey(rule)), datapoint) )
+
+      metric = RewriteRuleManager.postRules.apply(metric)
+
+      if metric not in aggregate_metrics:
+        passthrough.append( (metric, datapoint) )
+
+    for channel, batch in zip(self.channels, batches):
+      if batch:
+        channel.sendDatapoints(batch)
+
+    if passthrough:
+      events.metricsGenerated(passthrough)
+
+
+def createAggregatorServices(root_service):
+  dispatcher = AggregatorDispatcher(int(settings.AGGREGATOR_PROCESSES))
+  events.metricsReceived.addHandler(dispatcher.process_many)
+
+  service = AggregatorSupervisor(len(dispatcher.channels))
+  service.setServiceParent(root_service)
+  dispatcher.connect()
+  return dispatcher
+
+
+#
+# Aggregator process side
+#
+
+class PartitionReceiver:
+  """Feeds an aggregator process the datapoints of its own aggregates, as
+  matched and named by the daemon"""
+
+  def __init__(self, worker_id, count):
+    self.worker_id = worker_id
+    self.count = count
+    self.rules = None
+    self.rules_by_key = {}
+
+  def get_rule(self, rule_key):
+    from carbon.aggregator.rules import RuleManager
+
+    if self.rules is not RuleManager.rules:
+      self.rules = RuleManager.rules
+      self.rules_by_key = dict([(getRuleKey(rule), rule) for rule in self.rules])
+    return self.rules_by_key.get(rule_key)
+
+  def process_many(self, datapoints):
+    from carbon.aggregator.rules import RuleManager
+    from carbon.aggregator.receiver import aggregate
+
+    for (name, datapoint) in datapoints:
+      try:
+        aggregate_metric, rule_key = name.split(' ', 1)
+      except ValueError:
+        log.aggregator("ignoring datapoint for %s without an aggregation rule" % name)
+        continue
+
+      rule = self.get_rule(rule_key)
+      if rule is None and RuleManager.rules_file is not None:
+        # The daemon may have picked up changed rules first
+        RuleManager.read_rules()
+        rule = self.get_rule(rule_key)
+      if rule is None:
+        instrumentation.increment('aggregatorUnknownRules')
+        continue
+      aggregate(rule, aggregate_metric, datapoint)
+
+
+def main():
+  worker_id, count = int(sys.argv[1]), int(sys.argv[2])
+  settings.update(pickle.load(sys.stdin))
+  if settings.instance:
+    settings['instance'] = '%s-aggregator%d' % (settings.instance, worker_id)
+  else:
+    settings['instance'] = 'aggregator%d' % worker_id
+  settings['QUEUE_DIR'] = join(settings.QUEUE_DIR, 'aggregator%d' % worker_id)
+  log.logToStdout()
+
+  state.events = events
+  state.instrumentation = instrumentation
+
+  # These need the settings to import
+  from carbon.protocols import WorkerChannelReceiver
+  from carbon.aggregator.rules import RuleManager
+  from carbon.routers import ConsistentHashingRouter, HASHING_ROUTERS
+  from carbon.client import CarbonClientManager
+  from carbon.instrumentation import InstrumentationService
+
+  router = HASHING_ROUTERS.get(settings.RELAY_METHOD, ConsistentHashingRouter)()
+  state.router = router
+  client_manager = CarbonClientManager(router)
+  for destination in parseDestinations(settings.DESTINATIONS):
+    client_manager.startClient(destination)
+  client_manager.startService()
+
+  receiver = PartitionReceiver(worker_id, count)
+  events.metricsReceived.addHandler(receiver.process_many)
+  events.metricsGenerated.addHandler(client_manager.sendDatapoints)
+  RuleManager.read_from(settings["aggregation-rules"])
+  InstrumentationService().startService()
+
+  channel_path = getChannelPath(worker_id)
+  if exists(channel_path):
+    os.unlink(channel_path)
+  factory = ServerFactory()
+  factory.protocol = WorkerChannelReceiver
+  reactor.listenUNIX(channel_path, factory, mode=0600)
+  exitWithParent()
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
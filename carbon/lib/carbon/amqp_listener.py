@@ -37,6 +37,7 @@ from optparse import OptionParser
 
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.internet.protocol import ReconnectingClientFactory
 from txamqp.protocol import AMQClient
 from txamqp.client import TwistedDelegate
@@ -58,14 +59,22 @@ HOSTNAME = socket.gethostname().split('.')[0]
 
 
 class AMQPGraphiteProtocol(AMQClient):
-    """This is the protocol instance that will receive and post metrics."""
+    """This is the protocol instance that will receive and post metrics.
+
+    If AMQP_PREFETCH_COUNT is set, messages are consumed with acknowledgements
+    and the broker keeps at most that many unacknowledged messages in flight.
+    Whatever has arrived is then drained as one batch, parsed, dispatched
+    with a single metricsReceived event and acknowledged with a single
+    basic_ack, so datapoints are delivered at least once."""
 
     consumer_tag = "graphite_consumer"
+    backlog_interval = 10
 
     @inlineCallbacks
     def connectionMade(self):
         yield AMQClient.connectionMade(self)
         log.listener("New AMQP connection made")
+        self.prefetch_count = int(settings.get("AMQP_PREFETCH_COUNT", 0))
         yield self.setup()
         yield self.receive_loop()
 
@@ -92,30 +101,127 @@ class AMQPGraphiteProtocol(AMQClient):
             yield chan.queue_bind(exchange=exchange, queue=my_queue,
                                   routing_key=bind_pattern)
 
-        yield chan.basic_consume(queue=my_queue, no_ack=True,
+        if self.prefetch_count:
+            yield chan.basic_qos(prefetch_count=self.prefetch_count)
+
+        yield chan.basic_consume(queue=my_queue,
+                                 no_ack=not self.prefetch_count,
                                  consumer_tag=self.consumer_tag)
+        self.chan = chan
+        self.queue_name = my_queue
+
     @inlineCallbacks
     def receive_loop(self):
         queue = yield self.queue(self.consumer_tag)
 
+        if not self.prefetch_count:
+            while True:
+                msg = yield queue.get()
+                self.processMessage(msg)
+
+        self.backlog_task = LoopingCall(self.checkBacklog)
+        self.backlog_task.start(self.backlog_interval, now=False)
+
         while True:
             msg = yield queue.get()
-            self.processMessage(msg)
+            messages = [msg]
+            self.takeArrived(queue, messages)
+
+            self.processMessages(messages)
+            try:
+                yield self.chan.basic_ack(delivery_tag=messages[-1].delivery_tag,
+                                          multiple=True)
+            except:
+                log.err(None, "Failed to acknowledge %d AMQP messages" % len(messages))
+
+    def takeArrived(self, queue, messages):
+        """Adds the messages that have already arrived to the batch, up to
+        prefetch_count of them, without waiting for more."""
+        while len(messages) < self.prefetch_count:
+            arrived = []
+            d = queue.get()
+            d.addCallbacks(arrived.append, lambda failure: None)
+            if not arrived:
+                if not d.called:
+                    d.cancel() # nothing more has arrived
+                break
+            messages.append(arrived[0])
+
+    @inlineCallbacks
+    def checkBacklog(self):
+        """Record how many messages are waiting in our queue on the broker."""
+        reply = yield self.chan.queue_declare(queue=self.queue_name,
+                                              passive=True)
+        instrumentation.append('amqp.backlog', reply.message_count)
+
+    def connectionLost(self, reason):
+        backlog_task = getattr(self, 'backlog_task', None)
+        if backlog_task is not None and backlog_task.running:
+            backlog_task.stop()
+        AMQClient.connectionLost(self, reason)
 
     def processMessage(self, message):
         """Parse a message and post it as a metric."""
+        self.processMessages([message])
+
+    def processMessages(self, messages):
+        """Parse a batch of messages and post their datapoints at once."""
+        datapoints = []
+        for message in messages:
+            datapoints.extend(self.parseMessage(message))
 
+        instrumentation.increment('amqp.messagesReceived', len(messages))
+        if datapoints:
+            events.metricsReceived(datapoints)
+
+    def parseMessage(self, message):
         if self.factory.verbose:
             log.listener("Message received: %s" % (message,))
 
         metric = message.routing_key
+        body = message.content.body
+        name_in_body = settings.get("AMQP_METRIC_NAME_IN_BODY", False)
+
+        # Fast path: split the whole body at once, which is valid as long as
+        # every line holds exactly one datapoint. That is checked by rebuilding
+        # the body from the fields, so it's only taken for bodies laid out as
+        # single space separated fields with no blank lines. Otherwise (or if
+        # a float() conversion fails) the body is reparsed line by line so
+        # that bad lines can be reported.
+        fields = body.split()
+        field_count = name_in_body and 3 or 2
+        lines = zip(*[iter(fields)] * field_count)
+        line_count = len(lines)
+        try:
+            if '\n'.join(map(' '.join, lines)) != body.rstrip('\n') or body.endswith('\n\n'):
+                raise ValueError("not one datapoint per line")
+            if name_in_body:
+                datapoints = zip(fields[0::3],
+                                 zip(map(float, fields[2::3]),
+                                     map(float, fields[1::3])))
+            else:
+                datapoints = zip([metric] * line_count,
+                                 zip(map(float, fields[1::2]),
+                                     map(float, fields[0::2])))
+        except ValueError:
+            datapoints = self.parseLines(metric, body, name_in_body)
+
+        if self.factory.verbose:
+            for (metric, (timestamp, value)) in datapoints:
+                log.listener("Metric posted: %s %s %s" %
+                             (metric, value, timestamp,))
 
-        for line in message.content.body.split("\n"):
+        return datapoints
+
+    def parseLines(self, metric, body, name_in_body):
+        datapoints = []
+
+        for line in body.split("\n"):
             line = line.strip()
             if not line:
                 continue
             try:
-                if settings.get("AMQP_METRIC_NAME_IN_BODY", False):
+                if name_in_body:
                     metric, value, timestamp = line.split()
                 else:
                     value, timestamp = line.split()
@@ -124,11 +230,9 @@ class AMQPGraphiteProtocol(AMQClient):
                 log.listener("invalid message line: %s" % (line,))
                 continue
 
-            events.metricReceived(metric, datapoint)
+            datapoints.append( (metric, datapoint) )
 
-            if self.factory.verbose:
-                log.listener("Metric posted: %s %s %s" %
-                             (metric, value, timestamp,))
+        return datapoints
 
 
 class AMQPReconnectingFactory(ReconnectingClientFactory):
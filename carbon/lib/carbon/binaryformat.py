@@ -0,0 +1,98 @@
+"""Compact binary encoding of datapoint batches.
+
+A message (framed by a 4 byte length prefix on the wire, as with the
+pickle protocol) is laid out in network byte order as:
+
+  uint8   format version (1)
+  uint32  number of metric names N
+  N times:
+    uint16  length of the name in bytes
+    bytes   the metric name
+  uint32  number of records M
+  M times:
+    uint32  index of the record's metric name, 0 <= index < N
+    float64 timestamp
+    float64 value
+
+Unlike pickle, decoding never instantiates anything but strings and floats,
+so no allowlist is needed to make it safe. Unicode names are sent UTF-8
+encoded and decode to byte strings.
+"""
+
+import struct
+
+
+VERSION = 1
+HEADER = struct.Struct('!BI')
+NAME_LENGTH = struct.Struct('!H')
+RECORD_COUNT = struct.Struct('!I')
+RECORD_FORMAT = 'Idd'
+RECORD_SIZE = struct.calcsize('!' + RECORD_FORMAT)
+MAX_NAME_LENGTH = 2 ** 16 - 1
+
+
+def encodeDatapoints(datapoints):
+  "Encodes a list of (metric, (timestamp, value)) tuples into a message"
+  name_ids = {}
+  names = []
+  records = []
+
+  for (metric, (timestamp, value)) in datapoints:
+    name_id = name_ids.get(metric)
+    if name_id is None:
+      if isinstance(metric, unicode): # ie. from a pickle
+        name = metric.encode('utf-8')
+      else:
+        name = metric
+      if len(name) > MAX_NAME_LENGTH:
+        raise ValueError("metric name longer than %d bytes" % MAX_NAME_LENGTH)
+      name_id = name_ids[metric] = len(name_ids)
+      names.append(NAME_LENGTH.pack(len(name)))
+      names.append(name)
+    records.append(name_id)
+    records.append(timestamp)
+    records.append(value)
+
+  count = len(records) / 3
+  return ''.join([
+    HEADER.pack(VERSION, len(name_ids)),
+    ''.join(names),
+    RECORD_COUNT.pack(count),
+    struct.pack('!' + RECORD_FORMAT * count, *records),
+  ])
+
+
+def decodeDatapoints(data):
+  """Decodes a message into a list of (metric, (timestamp, value)) tuples.
+  Raises ValueError if the message is malformed."""
+  try:
+    version, name_count = HEADER.unpack_from(data)
+    if version != VERSION:
+      raise ValueError("unsupported binary format version %d" % version)
+
+    offset = HEADER.size
+    names = []
+    for i in xrange(name_count):
+      (length,) = NAME_LENGTH.unpack_from(data, offset)
+      offset += NAME_LENGTH.size
+      name = data[offset:offset + length]
+      if len(name) != length:
+        raise ValueError("truncated metric name")
+      names.append(name)
+      offset += length
+
+    (count,) = RECORD_COUNT.unpack_from(data, offset)
+    offset += RECORD_COUNT.size
+    if len(data) - offset != count * RECORD_SIZE:
+      raise ValueError("record section is %d bytes, expected %d" %
+                       (len(data) - offset, count * RECORD_SIZE))
+
+    records = struct.unpack_from('!' + RECORD_FORMAT * count, data, offset)
+  except struct.error, e:
+    raise ValueError(str(e))
+
+  name_ids = records[0::3]
+  if name_ids and max(name_ids) >= name_count:
+    raise ValueError("record refers to undefined metric name")
+
+  return zip([names[i] for i in name_ids], zip(records[1::3], records[2::3]))
@@ -36,6 +36,20 @@ class MetricCache(dict):
       log.msg("MetricCache is full: self.size=%d" % self.size)
       state.events.cacheFull()
 
+  def storeMany(self, datapoints):
+    try:
+      self.lock.acquire()
+      setdefault = self.setdefault
+      for (metric, datapoint) in datapoints:
+        setdefault(metric, []).append(datapoint)
+      self.size += len(datapoints)
+    finally:
+      self.lock.release()
+
+    if self.isFull():
+      log.msg("MetricCache is full: self.size=%d" % self.size)
+      state.events.cacheFull()
+
   def isFull(self):
     return self.size >= settings.MAX_CACHE_SIZE
 
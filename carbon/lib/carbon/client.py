@@ -1,27 +1,58 @@
+import zlib
+import struct
+from collections import deque
+from os.path import join
 from twisted.application.service import Service
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.internet.defer import Deferred, DeferredList
-from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.protocol import ClientFactory, ReconnectingClientFactory
 from twisted.protocols.basic import Int32StringReceiver
 from carbon.conf import settings
 from carbon.util import pickle
+from carbon.binaryformat import encodeDatapoints
+from carbon.diskqueue import DiskQueue
+from carbon.compression import (COMPRESSION_REQUEST, COMPRESSION_ACCEPTED,
+                                COMPRESSION_NEGOTIATION_TIMEOUT)
 from carbon import log, state, events, instrumentation
 
 
-SEND_QUEUE_LOW_WATERMARK = settings.MAX_QUEUE_SIZE * 0.8
+SEND_QUEUE_LOW_WATERMARK = 0.8 # of MAX_QUEUE_SIZE, read when used as it may change
+DISK_QUEUE_DRAIN_INTERVAL = 1.0
+
+# Message encodings a destination can be sent, see DESTINATION_PROTOCOL
+SERIALIZERS = {
+  'pickle' : lambda datapoints: pickle.dumps(datapoints, protocol=-1),
+  'binary' : encodeDatapoints,
+}
 
 
 class CarbonClientProtocol(Int32StringReceiver):
   def connectionMade(self):
     log.clients("%s::connectionMade" % self)
     self.paused = False
+    self.transportPaused = False
     self.connected = True
     self.transport.registerProducer(self, streaming=True)
     # Define internal metric names
     self.destinationName = self.factory.destinationName
     self.queuedUntilReady = 'destinations.%s.queuedUntilReady' % self.destinationName
     self.sent = 'destinations.%s.sent' % self.destinationName
-
+    self.bytesSent = 'destinations.%s.bytesSent' % self.destinationName
+    self.compressedBytesSent = 'destinations.%s.compressedBytesSent' % self.destinationName
+
+    # Nothing is sent until the destination answers a compression request
+    self.compressor = None
+    self.negotiationTimeout = None
+    self.received = ''
+    self.requestedCompression = self.factory.compression and not self.factory.compressionRefused
+    if self.requestedCompression:
+      self.paused = True
+      self.sendString(COMPRESSION_REQUEST)
+      self.negotiationTimeout = reactor.callLater(COMPRESSION_NEGOTIATION_TIMEOUT,
+                                                  self.negotiationTimedOut)
+
+    self.factory.connectedProtocols.append(self)
     self.factory.connectionMade.callback(self)
     self.factory.connectionMade = Deferred()
     self.sendQueued()
@@ -29,11 +60,65 @@ class CarbonClientProtocol(Int32StringReceiver):
   def connectionLost(self, reason):
     log.clients("%s::connectionLost %s" % (self, reason.getErrorMessage()))
     self.connected = False
+    if self.negotiationTimeout is not None and self.negotiationTimeout.active():
+      self.negotiationTimeout.cancel()
+    if not self.requestedCompression:
+      self.factory.compressionRefused = False # ask again on the next connection
+    if self in self.factory.connectedProtocols:
+      self.factory.connectedProtocols.remove(self)
+
+  def dataReceived(self, data):
+    # Destinations only ever answer compression requests. The answer arrives
+    # while paused, when Int32StringReceiver wouldn't deliver it.
+    self.received += data
+    answer = struct.pack(self.structFormat, len(COMPRESSION_ACCEPTED)) + COMPRESSION_ACCEPTED
+    if len(self.received) >= len(answer):
+      if self.received.startswith(answer):
+        self.compressionNegotiated()
+      self.received = ''
+
+  def negotiationTimedOut(self):
+    """ Once the request is out the destination may still accept it, so
+    rather than sending uncompressed on this connection the client
+    reconnects without asking.
+    """
+    self.negotiationTimeout = None
+    log.clients("%s destination did not accept compression, reconnecting uncompressed" % self)
+    self.factory.compressionRefused = True
+    self.disconnect()
+
+  def compressionNegotiated(self):
+    if self.negotiationTimeout is None:
+      return
+    if self.negotiationTimeout.active():
+      self.negotiationTimeout.cancel()
+    self.negotiationTimeout = None
+
+    log.clients("%s compressing the connection" % self)
+    self.compressor = zlib.compressobj()
+    if not self.transportPaused:
+      self.paused = False
+      self.sendQueued()
+
+  def sendString(self, data):
+    if self.compressor is None:
+      Int32StringReceiver.sendString(self, data)
+      return
+
+    frame = struct.pack(self.structFormat, len(data)) + data
+    compressed = self.compressor.compress(frame) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self.transport.write(compressed)
+    instrumentation.increment(self.bytesSent, len(frame))
+    instrumentation.increment(self.compressedBytesSent, len(compressed))
 
   def pauseProducing(self):
+    self.transportPaused = True
     self.paused = True
 
   def resumeProducing(self):
+    self.transportPaused = False
+    if self.negotiationTimeout is not None:
+      return # compressionNegotiated resumes
     self.paused = False
     self.sendQueued()
 
@@ -58,19 +143,35 @@ class CarbonClientProtocol(Int32StringReceiver):
     else:
       self._sendDatapoints([(metric, datapoint)])
 
+  def sendBatch(self, batch):
+    if self.paused:
+      self.factory.queue.appendBatch(batch)
+      instrumentation.increment(self.queuedUntilReady, len(batch))
+
+    elif self.factory.hasQueuedDatapoints():
+      self.factory.queue.appendBatch(batch)
+      self.sendQueued()
+
+    else:
+      self._sendBatch(batch)
+
   def _sendDatapoints(self, datapoints):
-      self.sendString(pickle.dumps(datapoints, protocol=-1))
+      self.sendString(self.factory.serialize(datapoints))
       instrumentation.increment(self.sent, len(datapoints))
       self.factory.checkQueue()
 
+  def _sendBatch(self, batch):
+      self.sendString(batch.getPayload(self.factory.serialize))
+      instrumentation.increment(self.sent, len(batch))
+      self.factory.checkQueue()
+
   def sendQueued(self):
     while (not self.paused) and self.factory.hasQueuedDatapoints():
-      datapoints = self.factory.takeSomeFromQueue()
-      self._sendDatapoints(datapoints)
+      self._sendBatch(self.factory.queue.takeBatch())
 
       queueSize = self.factory.queueSize
       if (self.factory.queueFull.called and
-          queueSize < SEND_QUEUE_LOW_WATERMARK):
+          queueSize < settings.MAX_QUEUE_SIZE * SEND_QUEUE_LOW_WATERMARK):
         self.factory.queueHasSpace.callback(queueSize)
 
         if (settings.USE_FLOW_CONTROL and
@@ -83,18 +184,113 @@ class CarbonClientProtocol(Int32StringReceiver):
   __repr__ = __str__
 
 
-class CarbonClientFactory(ReconnectingClientFactory):
+class QueuedBatch:
+  """ Up to MAX_DATAPOINTS_PER_MESSAGE datapoints that are sent as one
+  message. The message is serialized at most once, when first asked for.
+  """
+  __slots__ = ('datapoints', 'payload')
+
+  def __init__(self, datapoints, payload=None):
+    self.datapoints = datapoints
+    self.payload = payload
+
+  def __len__(self):
+    return len(self.datapoints)
+
+  def getPayload(self, serialize):
+    if self.payload is None:
+      self.payload = serialize(self.datapoints)
+    return self.payload
+
+
+class SendQueue:
+  """ FIFO of datapoints kept as a deque of QueuedBatches, so that both
+  queueing a datapoint and taking a message's worth of them are O(1) no
+  matter how large the backlog gets.
+  """
+  def __init__(self):
+    self.batches = deque()
+    self.size = 0
+    self.batch_size = settings.MAX_DATAPOINTS_PER_MESSAGE
+    self.tail = None # datapoints of the last batch, while it has room left
+
+  def __len__(self):
+    return self.size
+
+  def append(self, datapoint):
+    tail = self.tail
+    if tail is None or len(tail) >= self.batch_size:
+      tail = self.tail = []
+      self.batches.append( QueuedBatch(tail) )
+    tail.append(datapoint)
+    self.size += 1
+
+  def appendBatch(self, batch):
+    """ Queues a whole batch as is, it may be shared with other queues """
+    self.batches.append(batch)
+    self.tail = None
+    self.size += len(batch)
+
+  def takeBatch(self):
+    batch = self.batches.popleft()
+    if batch.datapoints is self.tail:
+      self.tail = None
+    self.size -= len(batch)
+    return batch
+
+
+class CarbonConnectionFactory(ReconnectingClientFactory):
+  """ Keeps one of a destination's connections up, the protocols it builds
+  belong to the destination's CarbonClientFactory """
   maxDelay = 5
 
-  def __init__(self, destination):
+  def __init__(self, client, index):
+    self.client = client
+    self.index = index
+    self.connector = None
+
+  def buildProtocol(self, addr):
+    return self.client.buildProtocol(addr)
+
+  def startedConnecting(self, connector):
+    self.client.startedConnecting(connector)
+
+  def clientConnectionLost(self, connector, reason):
+    ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+    self.client.clientConnectionLost(connector, reason)
+
+  def clientConnectionFailed(self, connector, reason):
+    ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+    self.client.clientConnectionFailed(connector, reason)
+
+
+class CarbonClientFactory(ClientFactory):
+  """ Sends to one destination over DESTINATION_CONNECTIONS connections.
+  Batches are spread across the connections that aren't paused, and all of
+  them drain the one send queue, so queueFull and queueHasSpace still apply
+  to the destination as a whole. """
+  def __init__(self, destination, protocol=None):
     self.destination = destination
+    self.protocol = protocol or settings.DESTINATION_PROTOCOL
+    if self.protocol not in SERIALIZERS:
+      raise ValueError("Invalid destination protocol \"%s\"" % self.protocol)
+    self.serialize = SERIALIZERS[self.protocol]
+    self.compression = settings.DESTINATION_COMPRESSION
+    if self.compression in ('none', 'None', ''):
+      self.compression = None
+    if self.compression not in (None, 'zlib'):
+      raise ValueError("Invalid destination compression \"%s\"" % self.compression)
+    self.compressionRefused = False # the last request timed out
     self.destinationName = ('%s:%d:%s' % destination).replace('.', '_')
     self.host, self.port, self.carbon_instance = destination
     self.addr = (self.host, self.port)
     self.started = False
     # This factory maintains protocol state across reconnects
-    self.queue = [] # including datapoints that still need to be sent
-    self.connectedProtocol = None
+    self.queue = SendQueue() # including datapoints that still need to be sent
+    self.connections = [CarbonConnectionFactory(self, i)
+                        for i in range(max(1, int(settings.DESTINATION_CONNECTIONS)))]
+    self.connectedProtocols = []
+    self.nextProtocol = 0
     self.queueEmpty = Deferred()
     self.queueFull = Deferred()
     self.queueFull.addCallback(self.queueFullCallback)
@@ -103,51 +299,83 @@ class CarbonClientFactory(ReconnectingClientFactory):
     self.connectFailed = Deferred()
     self.connectionMade = Deferred()
     self.connectionLost = Deferred()
+    # Datapoints that overflow the send queue go to disk, if enabled
+    self.diskQueue = None
+    if settings.USE_DISK_QUEUE:
+      self.diskQueue = DiskQueue(join(settings.QUEUE_DIR, self.destinationName),
+                                 settings.DISK_QUEUE_SEGMENT_SIZE,
+                                 settings.DISK_QUEUE_MAX_SIZE,
+                                 settings.MAX_DATAPOINTS_PER_MESSAGE)
+    self.drainTask = LoopingCall(self.drainDiskQueue)
     # Define internal metric names
     self.attemptedRelays = 'destinations.%s.attemptedRelays' % self.destinationName
     self.fullQueueDrops = 'destinations.%s.fullQueueDrops' % self.destinationName
     self.queuedUntilConnected = 'destinations.%s.queuedUntilConnected' % self.destinationName
+    self.queuedOnDisk = 'destinations.%s.queuedOnDisk' % self.destinationName
+    self.diskQueueSize = 'destinations.%s.diskQueueSize' % self.destinationName
+    self.diskQueueAge = 'destinations.%s.diskQueueAge' % self.destinationName
 
   def queueFullCallback(self, result):
     log.clients('%s send queue is full (%d datapoints)' % (self, result))
     
   def queueSpaceCallback(self, result):
     if self.queueFull.called:
-      log.clients('%s send queue has space available' % self.connectedProtocol)
+      log.clients('%s send queue has space available' % self)
       self.queueFull = Deferred()
       self.queueFull.addCallback(self.queueFullCallback)
     self.queueHasSpace = Deferred()
     self.queueHasSpace.addCallback(self.queueSpaceCallback)
 
   def buildProtocol(self, addr):
-    self.connectedProtocol = CarbonClientProtocol()
-    self.connectedProtocol.factory = self
-    return self.connectedProtocol
+    protocol = CarbonClientProtocol()
+    protocol.factory = self
+    return protocol
+
+  def getProtocol(self):
+    """ Round robins over the connected protocols, skipping paused ones
+    unless all of them are paused. Returns None while disconnected. """
+    protocols = self.connectedProtocols
+    for i in xrange(len(protocols)):
+      self.nextProtocol = (self.nextProtocol + 1) % len(protocols)
+      protocol = protocols[self.nextProtocol]
+      if not protocol.paused:
+        return protocol
+    if protocols:
+      return protocols[self.nextProtocol]
+    return None
 
   def startConnecting(self): # calling this startFactory yields recursion problems
     self.started = True
-    self.connector = reactor.connectTCP(self.host, self.port, self)
+    for connection in self.connections:
+      connection.continueTrying = True
+      connection.connector = reactor.connectTCP(self.host, self.port, connection)
+    if self.diskQueue is not None and not self.drainTask.running:
+      self.drainTask.start(DISK_QUEUE_DRAIN_INTERVAL, now=False)
 
   def stopConnecting(self):
     self.started = False
-    self.stopTrying()
-    if self.connectedProtocol and self.connectedProtocol.connected:
-      return self.connectedProtocol.disconnect()
+    for connection in self.connections:
+      connection.stopTrying()
+    if self.drainTask.running:
+      self.drainTask.stop()
+    if self.diskQueue is not None:
+      self.diskQueue.savePosition()
+    for protocol in list(self.connectedProtocols):
+      if protocol.connected:
+        protocol.disconnect()
 
   @property
   def queueSize(self):
-    return len(self.queue)
+    return self.queue.size
 
   def hasQueuedDatapoints(self):
-    return bool(self.queue)
+    return self.queue.size > 0
 
   def takeSomeFromQueue(self):
-    datapoints = self.queue[:settings.MAX_DATAPOINTS_PER_MESSAGE]
-    self.queue = self.queue[settings.MAX_DATAPOINTS_PER_MESSAGE:]
-    return datapoints
+    return self.queue.takeBatch().datapoints
 
   def checkQueue(self):
-    if not self.queue:
+    if not self.queue.size:
       self.queueEmpty.callback(0)
       self.queueEmpty = Deferred()
 
@@ -157,29 +385,84 @@ class CarbonClientFactory(ReconnectingClientFactory):
   def sendDatapoint(self, metric, datapoint):
     instrumentation.increment(self.attemptedRelays)
     queueSize = self.queueSize
-    if queueSize >= settings.MAX_QUEUE_SIZE:
+    if self.diskQueue is not None and self.diskQueue.size:
+      self.overflow([(metric, datapoint)])
+    elif queueSize >= settings.MAX_QUEUE_SIZE:
       if not self.queueFull.called:
         self.queueFull.callback(queueSize)
-      instrumentation.increment(self.fullQueueDrops)
-    elif self.connectedProtocol:
-      self.connectedProtocol.sendDatapoint(metric, datapoint)
+      self.overflow([(metric, datapoint)])
+    elif self.connectedProtocols:
+      self.getProtocol().sendDatapoint(metric, datapoint)
     else:
       self.enqueue(metric, datapoint)
       instrumentation.increment(self.queuedUntilConnected)
 
+  def sendBatch(self, batch):
+    instrumentation.increment(self.attemptedRelays, len(batch))
+    queueSize = self.queueSize
+    if self.diskQueue is not None and self.diskQueue.size:
+      # Keep datapoints in order until the backlog on disk is drained
+      self.overflow(batch.datapoints)
+    elif queueSize >= settings.MAX_QUEUE_SIZE:
+      if not self.queueFull.called:
+        self.queueFull.callback(queueSize)
+      self.overflow(batch.datapoints)
+    elif self.connectedProtocols:
+      self.getProtocol().sendBatch(batch)
+    else:
+      self.queue.appendBatch(batch)
+      instrumentation.increment(self.queuedUntilConnected, len(batch))
+
+  def overflow(self, datapoints):
+    if self.diskQueue is not None and self.diskQueue.append(datapoints):
+      instrumentation.increment(self.queuedOnDisk, len(datapoints))
+    else:
+      instrumentation.increment(self.fullQueueDrops, len(datapoints))
+
+  def drainDiskQueue(self):
+    """ Moves datapoints from the disk queue back into the send queue, at
+    most DISK_QUEUE_DRAIN_RATE per second and only while connected and the
+    send queue is below its low watermark.
+    """
+    diskQueue = self.diskQueue
+    diskQueue.flush()
+    budget = settings.DISK_QUEUE_DRAIN_RATE * DISK_QUEUE_DRAIN_INTERVAL
+    protocol = self.getProtocol()
+    if protocol is not None and not protocol.paused:
+      budget = min(budget, settings.MAX_QUEUE_SIZE - self.queueSize)
+      drained = 0
+      lowWatermark = settings.MAX_QUEUE_SIZE * SEND_QUEUE_LOW_WATERMARK
+      while diskQueue.size and self.queueSize < lowWatermark and drained < budget:
+        record = diskQueue.take()
+        if record is None:
+          break
+        datapoints, payload = record
+        if self.protocol != 'binary':
+          payload = None
+        self.queue.appendBatch( QueuedBatch(datapoints, payload) )
+        drained += len(datapoints)
+
+      if drained:
+        diskQueue.savePosition()
+        protocol.sendQueued()
+
+    instrumentation.append(self.diskQueueSize, diskQueue.size)
+    instrumentation.append(self.diskQueueAge, diskQueue.age())
+
   def startedConnecting(self, connector):
     log.clients("%s::startedConnecting (%s:%d)" % (self, connector.host, connector.port))
 
   def clientConnectionLost(self, connector, reason):
-    ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
     log.clients("%s::clientConnectionLost (%s:%d) %s" % (self, connector.host, connector.port, reason.getErrorMessage()))
-    self.connectedProtocol = None
+    if self.connectedProtocols:
+      return # the destination is still connected over the other connections
     self.connectionLost.callback(0)
     self.connectionLost = Deferred()
 
   def clientConnectionFailed(self, connector, reason):
-    ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
     log.clients("%s::clientConnectionFailed (%s:%d) %s" % (self, connector.host, connector.port, reason.getErrorMessage()))
+    if self.connectedProtocols:
+      return
     self.connectFailed.callback(dict(connector=connector, reason=reason))
     self.connectFailed = Deferred()
 
@@ -191,8 +474,9 @@ class CarbonClientFactory(ReconnectingClientFactory):
       fireOnOneErrback=True)
     self.checkQueue()
 
-    # This can happen if the client is stopped before a connection is ever made
-    if (not readyToStop.called) and (not self.started):
+    # This can happen if the client is stopped before a connection is ever
+    # made, otherwise the connections still closing are waited for
+    if (not readyToStop.called) and (not self.started) and (not self.connectedProtocols):
       readyToStop.callback(None)
 
     return readyToStop
@@ -203,8 +487,9 @@ class CarbonClientFactory(ReconnectingClientFactory):
 
 
 class CarbonClientManager(Service):
-  def __init__(self, router):
+  def __init__(self, router, protocol=None):
     self.router = router
+    self.protocol = protocol
     self.client_factories = {} # { destination : CarbonClientFactory() }
 
   def startService(self):
@@ -223,7 +508,7 @@ class CarbonClientManager(Service):
 
     log.clients("connecting to carbon daemon at %s:%d:%s" % destination)
     self.router.addDestination(destination)
-    factory = self.client_factories[destination] = CarbonClientFactory(destination)
+    factory = self.client_factories[destination] = CarbonClientFactory(destination, self.protocol)
     connectAttempted = DeferredList(
         [factory.connectionMade, factory.connectFailed],
         fireOnOneCallback=True,
@@ -245,9 +530,10 @@ class CarbonClientManager(Service):
 
   def disconnectClient(self, destination):
     factory = self.client_factories.pop(destination)
-    c = factory.connector
-    if c and c.state == 'connecting' and not factory.hasQueuedDatapoints():
-      c.stopConnecting()
+    for connection in factory.connections:
+      c = connection.connector
+      if c and c.state == 'connecting' and not factory.hasQueuedDatapoints():
+        c.stopConnecting()
 
   def stopAllClients(self):
     deferreds = []
@@ -259,5 +545,17 @@ class CarbonClientManager(Service):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendDatapoint(metric, datapoint)
 
+  def sendDatapoints(self, datapoints):
+    """ Routes a whole batch at once. Datapoints going to the same set of
+    destinations share QueuedBatches, so each message is serialized once
+    however many replicas it is sent to.
+    """
+    batch_size = settings.MAX_DATAPOINTS_PER_MESSAGE
+    for destinations, group in self.router.groupByDestinations(datapoints).iteritems():
+      for i in xrange(0, len(group), batch_size):
+        batch = QueuedBatch(group[i:i + batch_size])
+        for destination in destinations:
+          self.client_factories[destination].sendBatch(batch)
+
   def __str__(self):
     return "<%s[%x]>" % (self.__class__.__name__, id(self))
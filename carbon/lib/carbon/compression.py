@@ -0,0 +1,19 @@
+"""Compressed links between carbon daemons.
+
+A client with DESTINATION_COMPRESSION set opens each connection by sending
+COMPRESSION_REQUEST as an ordinary Int32 framed message. Receivers that
+support compression answer with COMPRESSION_ACCEPTED, after which
+everything the client sends on that connection is a single zlib stream of
+the usual framed messages, flushed after every message. Compressing the
+whole connection as one stream lets repeated metric names reference
+earlier messages. Older receivers ignore the request, which neither
+unpickles nor decodes, though they log it as an invalid message. If no
+answer arrives within COMPRESSION_NEGOTIATION_TIMEOUT seconds the client
+closes the connection and its next connection is uncompressed from the
+start, so a late answer can never meet uncompressed data. A later
+connection asks again once that uncompressed one is lost.
+"""
+
+COMPRESSION_REQUEST = '\x00carbon-compression zlib'
+COMPRESSION_ACCEPTED = '\x00carbon-compression zlib accepted'
+COMPRESSION_NEGOTIATION_TIMEOUT = 5
@@ -35,10 +35,14 @@ defaults = dict(
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
+  RECEIVER_PROCESSES=0,
+  AGGREGATOR_PROCESSES=0,
   UDP_RECEIVER_INTERFACE='0.0.0.0',
   UDP_RECEIVER_PORT=2003,
   PICKLE_RECEIVER_INTERFACE='0.0.0.0',
   PICKLE_RECEIVER_PORT=2004,
+  BINARY_RECEIVER_INTERFACE='0.0.0.0',
+  BINARY_RECEIVER_PORT=0,
   CACHE_QUERY_INTERFACE='0.0.0.0',
   CACHE_QUERY_PORT=7002,
   LOG_UPDATES=True,
@@ -47,6 +51,7 @@ defaults = dict(
   WHISPER_LOCK_WRITES=False,
   MAX_DATAPOINTS_PER_MESSAGE=500,
   MAX_AGGREGATION_INTERVALS=5,
+  AGGREGATION_SWEEP_SIZE=10000,
   MAX_QUEUE_SIZE=1000,
   ENABLE_AMQP=False,
   AMQP_VERBOSE=False,
@@ -59,9 +64,20 @@ defaults = dict(
   RELAY_METHOD='rules',
   REPLICATION_FACTOR=1,
   DESTINATIONS=[],
+  ROUTER_CACHE_SIZE=100000,
+  AGGREGATION_RULE_CACHE_SIZE=100000,
+  REWRITE_RULE_CACHE_SIZE=100000,
+  DESTINATION_PROTOCOL='pickle',
+  DESTINATION_CONNECTIONS=1,
+  DESTINATION_COMPRESSION=None,
   USE_FLOW_CONTROL=True,
+  USE_DISK_QUEUE=False,
+  DISK_QUEUE_MAX_SIZE=1073741824,
+  DISK_QUEUE_SEGMENT_SIZE=16777216,
+  DISK_QUEUE_DRAIN_RATE=50000,
   USE_INSECURE_UNPICKLER=False,
   USE_WHITELIST=False,
+  REGEX_LIST_CACHE_SIZE=100000,
 )
 
 
@@ -357,9 +373,11 @@ class CarbonRelayOptions(CarbonCacheOptions):
             self["rules"] = join(settings["CONF_DIR"], "relay-rules.conf")
         settings["relay-rules"] = self["rules"]
 
-        if settings["RELAY_METHOD"] not in ("rules", "consistent-hashing"):
-            print ("In carbon.conf, RELAY_METHOD must be either 'rules' or "
-                   "'consistent-hashing'. Invalid value: '%s'" %
+        if settings["RELAY_METHOD"] not in ("rules", "consistent-hashing",
+                                            "jump-hashing", "rendezvous-hashing"):
+            print ("In carbon.conf, RELAY_METHOD must be one of 'rules', "
+                   "'consistent-hashing', 'jump-hashing' or "
+                   "'rendezvous-hashing'. Invalid value: '%s'" %
                    settings.RELAY_METHOD)
             sys.exit(1)
 
@@ -479,6 +497,8 @@ def read_config(program, options, **kwargs):
         "LOCAL_DATA_DIR", join(settings["STORAGE_DIR"], "whisper"))
     settings.setdefault(
         "WHITELISTS_DIR", join(settings["STORAGE_DIR"], "lists"))
+    settings.setdefault(
+        "QUEUE_DIR", join(settings["STORAGE_DIR"], "queues", program))
 
     # Read configuration options from program-specific section.
     section = program[len("carbon-"):]
@@ -504,6 +524,8 @@ def read_config(program, options, **kwargs):
         settings["LOG_DIR"] = (options["logdir"] or
                               join(settings["LOG_DIR"],
                                 "%s-%s" % (program ,options["instance"])))
+        settings["QUEUE_DIR"] = join(settings["QUEUE_DIR"],
+                                     "%s-%s" % (program, options["instance"]))
     else:
         settings["pidfile"] = (
             options["pidfile"] or
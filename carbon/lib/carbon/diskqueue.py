@@ -0,0 +1,227 @@
+"""Disk backed overflow queue for relay destinations.
+
+Datapoints that don't fit in a destination's in-memory send queue are
+appended to a series of segment files in the destination's queue
+directory. Each record is a header (write time, datapoint count, payload
+length) followed by the datapoints encoded with carbon.binaryformat, which
+can be read back without trusting the file's contents. Segments are
+deleted once fully read and the read position is kept in a small file, so
+a restarted daemon resumes where it left off.
+
+Appended datapoints are held in memory until record_size of them are
+pending, so single datapoints don't each become a record, and the segment
+is only flushed by flush(), which reading and saving the position do.
+A datapoint that can't be encoded is logged and dropped by itself; the
+rest of its record is still written.
+"""
+
+import os
+import time
+import struct
+from os.path import join, exists
+from carbon.binaryformat import encodeDatapoints, decodeDatapoints, RECORD_SIZE
+from carbon import log
+
+
+RECORD_HEADER = struct.Struct('!dII')
+SEGMENT_SUFFIX = '.segment'
+POSITION_FILE = 'position'
+
+
+class DiskQueue:
+  def __init__(self, path, segment_size, max_size, record_size=1):
+    self.path = path
+    self.segment_size = segment_size
+    self.max_size = max_size
+    self.record_size = record_size
+    self.size = 0  # datapoints, including the pending ones
+    self.bytes = 0
+    self.segments = []
+    self.pending = []
+    self.writer = None
+    self.unflushed = False
+    self.reader = None
+    self.read_segment = None
+    self.head_time = None
+
+    if not exists(path):
+      os.makedirs(path)
+    self.recover()
+
+  def segmentPath(self, segment):
+    return join(self.path, '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+  def recover(self):
+    "Picks up whatever a previous process left in the queue directory"
+    self.segments = sorted([int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                            if name.endswith(SEGMENT_SUFFIX)])
+    position = (None, 0)
+    position_file = join(self.path, POSITION_FILE)
+    if exists(position_file):
+      try:
+        segment, offset = open(position_file).read().split()
+        position = (int(segment), int(offset))
+      except:
+        log.err("Ignoring unreadable disk queue position in %s" % position_file)
+
+    # Drop segments that were completely read before
+    while self.segments and position[0] is not None and self.segments[0] < position[0]:
+      os.unlink(self.segmentPath(self.segments.pop(0)))
+
+    for segment in self.segments:
+      if segment == position[0]:
+        start = position[1]
+      else:
+        start = 0
+      self.size += self.scanSegment(segment, start)
+      self.bytes += os.path.getsize(self.segmentPath(segment)) - start
+
+    if self.segments:
+      self.openReader(self.segments[0], position[0] == self.segments[0] and position[1] or 0)
+      log.clients("Disk queue %s holds %d datapoints" % (self.path, self.size))
+
+  def scanSegment(self, segment, offset):
+    """Counts the datapoints in a segment from the given offset, truncating
+    a partially written record at its end"""
+    count = 0
+    f = open(self.segmentPath(segment), 'r+b')
+    try:
+      f.seek(offset)
+      while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+          break
+        written_at, datapoints, length = RECORD_HEADER.unpack(header)
+        if len(f.read(length)) < length:
+          break
+        count += datapoints
+        offset = f.tell()
+      f.truncate(offset)
+    finally:
+      f.close()
+    return count
+
+  def append(self, datapoints):
+    "Returns False without queueing anything if the queue is at its size limit"
+    if self.bytes + len(self.pending) * RECORD_SIZE >= self.max_size:
+      return False
+
+    self.pending.extend(datapoints)
+    self.size += len(datapoints)
+    if len(self.pending) >= self.record_size:
+      self.writeRecord()
+    return True
+
+  def writeRecord(self):
+    "Writes the pending datapoints as one record"
+    try:
+      payload = encodeDatapoints(self.pending)
+    except Exception:
+      self.dropUnencodable()
+      if not self.pending:
+        return
+      payload = encodeDatapoints(self.pending)
+    if self.writer is None or self.writer.tell() >= self.segment_size:
+      self.openWriter()
+    self.writer.write(RECORD_HEADER.pack(time.time(), len(self.pending), len(payload)) + payload)
+    self.pending = []
+    self.unflushed = True
+    self.bytes += RECORD_HEADER.size + len(payload)
+    if self.reader is None:
+      self.openReader(self.segments[0], 0)
+
+  def dropUnencodable(self):
+    "Drops the pending datapoints that can't be encoded so the rest can be written"
+    encodable = []
+    for datapoint in self.pending:
+      try:
+        encodeDatapoints([datapoint])
+      except Exception, e:
+        log.err("Dropping datapoint for %r that can't be queued in %s: %s" % (datapoint[0], self.path, e))
+      else:
+        encodable.append(datapoint)
+    self.size -= len(self.pending) - len(encodable)
+    self.pending = encodable
+
+  def flush(self):
+    "Writes out the pending datapoints and flushes the current segment"
+    if self.pending:
+      self.writeRecord()
+    if self.unflushed:
+      self.writer.flush()
+      self.unflushed = False
+
+  def openWriter(self):
+    if self.writer is not None:
+      self.writer.close()
+    if self.segments:
+      segment = self.segments[-1] + 1
+    else:
+      segment = 0
+    self.segments.append(segment)
+    self.writer = open(self.segmentPath(segment), 'ab')
+
+  def openReader(self, segment, offset):
+    if self.reader is not None:
+      self.reader.close()
+    self.reader = open(self.segmentPath(segment), 'rb')
+    self.reader.seek(offset)
+    self.read_segment = segment
+    self.head_time = None
+
+  def take(self):
+    """Returns the (datapoints, payload) of the oldest record, or None if the
+    queue is empty"""
+    self.flush()
+    while self.reader is not None:
+      offset = self.reader.tell()
+      header = self.reader.read(RECORD_HEADER.size)
+      if len(header) == RECORD_HEADER.size:
+        written_at, count, length = RECORD_HEADER.unpack(header)
+        payload = self.reader.read(length)
+        if len(payload) == length:
+          self.size -= count
+          self.bytes -= RECORD_HEADER.size + length
+          self.head_time = None
+          try:
+            return (decodeDatapoints(payload), payload)
+          except ValueError, e:
+            log.err("Skipping corrupt record in disk queue %s: %s" % (self.path, e))
+            continue
+
+      # End of this segment, move on if the writer has moved on
+      self.reader.seek(offset)
+      if self.read_segment == self.segments[-1]:
+        return None
+      self.reader.close()
+      self.reader = None
+      os.unlink(self.segmentPath(self.segments.pop(0)))
+      self.openReader(self.segments[0], 0)
+
+  def age(self):
+    "Seconds since the oldest queued record was written"
+    if not self.size or self.reader is None:
+      return 0.0
+    if self.head_time is None:
+      offset = self.reader.tell()
+      header = self.reader.read(RECORD_HEADER.size)
+      self.reader.seek(offset)
+      if len(header) < RECORD_HEADER.size:
+        return 0.0
+      self.head_time = RECORD_HEADER.unpack(header)[0]
+    return time.time() - self.head_time
+
+  def savePosition(self):
+    self.flush()
+    if self.reader is None:
+      return
+    f = open(join(self.path, POSITION_FILE), 'w')
+    f.write('%d %d\n' % (self.read_segment, self.reader.tell()))
+    f.close()
+
+  def close(self):
+    self.savePosition()
+    for f in (self.reader, self.writer):
+      if f is not None:
+        f.close()
+    self.reader = self.writer = None
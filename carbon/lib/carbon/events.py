@@ -22,15 +22,76 @@ class Event:
         log.err(None, "Exception in %s event handler: args=%s kwargs=%s" % (self.name, args, kwargs))
 
 
-metricReceived = Event('metricReceived')
-metricGenerated = Event('metricGenerated')
+class ResumeEvent(Event):
+  """Does nothing while state.metricReceiversHeld is set, so that whatever
+  holds the receivers paused isn't overridden by flow control resuming them"""
+
+  def __call__(self, *args, **kwargs):
+    if not state.metricReceiversHeld:
+      Event.__call__(self, *args, **kwargs)
+
+
+class BatchEvent(Event):
+  """An event whose handlers are called once per list of (metric, datapoint)
+  tuples, so the per-handler overhead is paid once per batch."""
+
+  def __call__(self, datapoints):
+    for handler in self.handlers:
+      try:
+        handler(datapoints)
+      except:
+        log.err(None, "Exception in %s event handler: %d datapoints" % (self.name, len(datapoints)))
+
+
+class DatapointEvent:
+  """Single datapoint view of a BatchEvent. Firing it sends a batch of one
+  and handlers added to it are called once for each datapoint of a batch."""
+
+  def __init__(self, name, batchEvent):
+    self.name = name
+    self.batchEvent = batchEvent
+
+  def addHandler(self, handler):
+    self.batchEvent.addHandler(PerDatapointHandler(self.name, handler))
+
+  def removeHandler(self, handler):
+    self.batchEvent.removeHandler(PerDatapointHandler(self.name, handler))
+
+  def __call__(self, metric, datapoint):
+    self.batchEvent([(metric, datapoint)])
+
+
+class PerDatapointHandler:
+  def __init__(self, name, handler):
+    self.name = name
+    self.handler = handler
+
+  def __eq__(self, other):
+    return isinstance(other, PerDatapointHandler) and self.handler == other.handler
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __call__(self, datapoints):
+    handler = self.handler
+    for (metric, datapoint) in datapoints:
+      try:
+        handler(metric, datapoint)
+      except:
+        log.err(None, "Exception in %s event handler: args=%s" % (self.name, (metric, datapoint)))
+
+
+metricsReceived = BatchEvent('metricsReceived')
+metricsGenerated = BatchEvent('metricsGenerated')
+metricReceived = DatapointEvent('metricReceived', metricsReceived)
+metricGenerated = DatapointEvent('metricGenerated', metricsGenerated)
 cacheFull = Event('cacheFull')
 cacheSpaceAvailable = Event('cacheSpaceAvailable')
 pauseReceivingMetrics = Event('pauseReceivingMetrics')
-resumeReceivingMetrics = Event('resumeReceivingMetrics')
+resumeReceivingMetrics = ResumeEvent('resumeReceivingMetrics')
 
 # Default handlers
-metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+metricsReceived.addHandler(lambda datapoints: state.instrumentation.increment('metricsReceived', len(datapoints)))
 
 cacheFull.addHandler(lambda: state.instrumentation.increment('cache.overflow'))
 cacheFull.addHandler(lambda: setattr(state, 'cacheTooFull', True))
@@ -3,6 +3,7 @@ try:
 except ImportError:
   from md5 import md5
 import bisect
+from math import log
 from carbon.conf import settings
 
 
@@ -21,11 +22,15 @@ class ConsistentHashRing:
 
   def add_node(self, node):
     self.nodes.add(node)
+    entries = []
     for i in range(self.replica_count):
       replica_key = "%s:%d" % (node, i)
       position = self.compute_ring_position(replica_key)
-      entry = (position, node)
-      bisect.insort(self.ring, entry)
+      entries.append( (position, node) )
+    # One sort instead of an insort per replica, which made building a large
+    # ring quadratic
+    self.ring.extend(entries)
+    self.ring.sort()
 
   def remove_node(self, node):
     self.nodes.discard(node)
@@ -54,3 +59,93 @@ class ConsistentHashRing:
       index = (index + 1) % len(self.ring)
 
     return nodes
+
+
+def compute_key_hash(key):
+  "64 bits of the key's MD5"
+  return int(md5( str(key) ).hexdigest()[:16], 16)
+
+
+def jump_hash(key_hash, bucket_count):
+  """Lamping & Veach's jump consistent hash, maps a 64 bit hash to one of
+  bucket_count buckets moving only 1/n of the keys when a bucket is added"""
+  bucket, j = -1, 0
+  while j < bucket_count:
+    bucket = j
+    key_hash = (key_hash * 2862933555777941757 + 1) & 0xffffffffffffffff
+    j = int( (bucket + 1) * (float(1 << 31) / float((key_hash >> 33) + 1)) )
+  return bucket
+
+
+class JumpHashRing:
+  """Jump consistent hashing over the nodes in the order they were added.
+  It balances load evenly and needs no ring, but nodes can only be added
+  or removed at the end without moving more than their share of keys, so
+  every process sharing a cluster must list the nodes in the same order."""
+  def __init__(self, nodes):
+    self.node_list = []
+    self.nodes = set()
+    for node in nodes:
+      self.add_node(node)
+
+  def add_node(self, node):
+    if node not in self.nodes:
+      self.nodes.add(node)
+      self.node_list.append(node)
+
+  def remove_node(self, node):
+    if node in self.nodes:
+      self.nodes.discard(node)
+      self.node_list.remove(node)
+
+  def get_node(self, key):
+    assert self.node_list
+    return self.node_list[ jump_hash(compute_key_hash(key), len(self.node_list)) ]
+
+  def get_nodes(self, key):
+    """All nodes, starting with get_node(key). Each further node is picked by
+    jump hashing a salted key among the nodes not picked yet."""
+    nodes = []
+    remaining = list(self.node_list)
+    replica = 0
+    while remaining:
+      if replica:
+        key_hash = compute_key_hash("%s:%d" % (key, replica))
+      else:
+        key_hash = compute_key_hash(key)
+      nodes.append( remaining.pop(jump_hash(key_hash, len(remaining))) )
+      replica += 1
+    return nodes
+
+
+class RendezvousHashRing:
+  """Weighted rendezvous (highest random weight) hashing. Every node scores
+  each key and the highest scores win, so adding or removing a node only
+  moves the keys it wins or won, regardless of the order nodes are listed in."""
+  def __init__(self, nodes, weights=None):
+    self.weights = {}
+    self.nodes = set()
+    for node in nodes:
+      self.add_node(node, (weights or {}).get(node, 1.0))
+
+  def add_node(self, node, weight=1.0):
+    self.nodes.add(node)
+    self.weights[node] = float(weight)
+
+  def remove_node(self, node):
+    self.nodes.discard(node)
+    self.weights.pop(node, None)
+
+  def compute_score(self, node, key):
+    # Map the hash into (0, 1), the score is -weight / ln(hash)
+    position = (compute_key_hash("%s:%s" % (node, key)) + 1) / float(2 ** 64 + 1)
+    return -self.weights[node] / log(position)
+
+  def get_node(self, key):
+    assert self.nodes
+    return max([ (self.compute_score(node, key), node) for node in self.nodes ])[1]
+
+  def get_nodes(self, key):
+    scores = [ (self.compute_score(node, key), node) for node in self.nodes ]
+    scores.sort(reverse=True)
+    return [node for (score, node) in scores]
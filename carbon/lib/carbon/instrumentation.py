@@ -61,6 +61,12 @@ def getMemUsage():
 
 
 def recordMetrics():
+  # These create LoopingCalls, which install the reactor, when imported.
+  # That mustn't happen while twistd is still loading the plugins.
+  from carbon.aggregator.rules import RuleManager
+  from carbon.rewrite import RewriteRuleManager
+  from carbon.regexlist import WhiteList, BlackList
+
   global lastUsage
   myStats = stats.copy()
   stats.clear()
@@ -98,14 +104,73 @@ def recordMetrics():
     record('allocatedBuffers', len(BufferManager))
     record('bufferedDatapoints',
            sum([b.size for b in BufferManager.buffers.values()]))
+    record('bufferMemorySaved', BufferManager.memory_saved())
     record('aggregateDatapointsSent', myStats.get('aggregateDatapointsSent', 0))
+    if settings.AGGREGATOR_PROCESSES:
+      record('aggregatorProcessDrops', myStats.get('aggregatorProcessDrops', 0))
+    if 'aggregatorUnknownRules' in myStats:
+      record('aggregatorUnknownRules', myStats['aggregatorUnknownRules'])
+    hits, misses = RuleManager.cache.resetStats()
+    record('aggregationRules.cacheHits', hits)
+    record('aggregationRules.cacheMisses', misses)
+    if 'aggregationRules.reloadTime' in myStats:
+      record('aggregationRules.reloadTime', myStats['aggregationRules.reloadTime'])
+      record('aggregationRules.buffersRemoved', myStats.get('aggregationRules.buffersRemoved', 0))
+    for rewrite_rules in (RewriteRuleManager.preRules, RewriteRuleManager.postRules):
+      if rewrite_rules:
+        hits, misses = rewrite_rules.cache.resetStats()
+        record('rewriteRules.%s.cacheHits' % rewrite_rules.name, hits)
+        record('rewriteRules.%s.cacheMisses' % rewrite_rules.name, misses)
 
   # relay metrics
   else:
     record = relay_record
 
+  # routing metrics
+  routeCache = getattr(state.router, 'cache', None)
+  if routeCache is not None:
+    hits, misses = routeCache.resetStats()
+    record('router.cacheHits', hits)
+    record('router.cacheMisses', misses)
+
+  # destination metrics, the disk queue gauges are sampled every second
+  if settings.program != 'carbon-cache':
+    for stat, value in myStats.items():
+      if stat.startswith('destinations.'):
+        if isinstance(value, list):
+          value = value[-1] # the most recent sample
+        record(stat, value)
+        if stat.endswith('.compressedBytesSent') and value:
+          bytesSent = myStats.get(stat[:-len('compressedBytesSent')] + 'bytesSent', 0)
+          record(stat[:-len('compressedBytesSent')] + 'compressionRatio', float(bytesSent) / value)
+
   # common metrics
   record('metricsReceived', myStats.get('metricsReceived', 0))
+  amqpBacklog = myStats.get('amqp.backlog')
+  if amqpBacklog:
+    record('amqp.backlog', amqpBacklog[-1]) # the most recent sample
+  if 'amqp.messagesReceived' in myStats:
+    record('amqp.messagesReceived', myStats['amqp.messagesReceived'])
+  compressedBytes = myStats.get('compression.bytesReceived', 0)
+  if compressedBytes:
+    decompressedBytes = myStats.get('compression.bytesDecompressed', 0)
+    record('compression.bytesReceived', compressedBytes)
+    record('compression.bytesDecompressed', decompressedBytes)
+    record('compression.ratio', float(decompressedBytes) / compressedBytes)
+  if 'receiverProcessDrops' in myStats:
+    record('receiverProcessDrops', myStats['receiverProcessDrops'])
+  for regex_list in (WhiteList, BlackList):
+    # Receiver processes forward their own matching stats
+    forwarded = '%s.cacheHits' % regex_list.name in myStats
+    if regex_list or forwarded:
+      hits, misses, matchTime = regex_list.reset_stats()
+      hits += myStats.get('%s.cacheHits' % regex_list.name, 0)
+      misses += myStats.get('%s.cacheMisses' % regex_list.name, 0)
+      matchTime += myStats.get('%s.matchTime' % regex_list.name, 0.0)
+      record('%s.cacheHits' % regex_list.name, hits)
+      record('%s.cacheMisses' % regex_list.name, misses)
+      if misses:
+        record('%s.avgMatchTime' % regex_list.name, matchTime / misses)
   record('cpuUsage', getCpuUsage())
   try: # This only works on Linux
     record('memUsage', getMemUsage())
@@ -1,11 +1,14 @@
+import zlib
 from twisted.internet import reactor
-from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.protocol import Protocol, DatagramProtocol
 from twisted.internet.error import ConnectionDone
-from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
+from twisted.protocols.basic import Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
 from carbon.util import pickle, get_unpickler
+from carbon.binaryformat import decodeDatapoints
+from carbon.compression import COMPRESSION_REQUEST, COMPRESSION_ACCEPTED
 
 
 class MetricReceiver:
@@ -47,63 +50,184 @@ class MetricReceiver:
     events.resumeReceivingMetrics.removeHandler(self.resumeReceiving)
 
   def metricReceived(self, metric, datapoint):
-    if BlackList and metric in BlackList:
-      instrumentation.increment('blacklistMatches')
-      return
-    if WhiteList and metric not in WhiteList:
-      instrumentation.increment('whitelistRejects')
-      return
-    if datapoint[1] == datapoint[1]: # filter out NaN values
-      events.metricReceived(metric, datapoint)
-
-
-class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
+    self.metricsReceived([(metric, datapoint)])
+
+  def metricsReceived(self, datapoints):
+    """ Filters and dispatches a list of (metric, datapoint) tuples at once.
+    """
+    if BlackList:
+      accepted = [item for item in datapoints if item[0] not in BlackList]
+      if len(accepted) < len(datapoints):
+        instrumentation.increment('blacklistMatches', len(datapoints) - len(accepted))
+      datapoints = accepted
+    if WhiteList:
+      accepted = [item for item in datapoints if item[0] in WhiteList]
+      if len(accepted) < len(datapoints):
+        instrumentation.increment('whitelistRejects', len(datapoints) - len(accepted))
+      datapoints = accepted
+
+    datapoints = [item for item in datapoints if item[1][1] == item[1][1]] # filter out NaN values
+    if datapoints:
+      events.metricsReceived(datapoints)
+
+
+class MetricLineReceiver(MetricReceiver, Protocol):
+  """ Parses each chunk handed to dataReceived in a single pass rather
+  than dispatching every line separately, the resulting batch of datapoints
+  is passed on through metricsReceived.
+  """
   delimiter = '\n'
+  MAX_LENGTH = 16384
+  _buffer = ''
+
+  def dataReceived(self, data):
+    lines = (self._buffer + data).split(self.delimiter)
+    self._buffer = lines.pop()
+    if lines:
+      self.linesReceived(lines)
+    if len(self._buffer) > self.MAX_LENGTH:
+      self.lineLengthExceeded(self._buffer)
 
   def lineReceived(self, line):
-    try:
-      metric, value, timestamp = line.strip().split()
-      datapoint = ( float(timestamp), float(value) )
-    except:
-      log.listener('invalid line received from client %s, ignoring' % self.peerName)
-      return
+    self.linesReceived([line])
 
-    self.metricReceived(metric, datapoint)
+  def linesReceived(self, lines):
+    datapoints = []
+    append = datapoints.append
+    for line in lines:
+      try:
+        metric, value, timestamp = line.split()
+        append( (metric, (float(timestamp), float(value))) )
+      except:
+        log.listener('invalid line received from client %s, ignoring' % self.peerName)
+
+    if datapoints:
+      self.metricsReceived(datapoints)
+
+  def lineLengthExceeded(self, line):
+    log.listener('line from client %s exceeds %d bytes, dropping connection' % (self.peerName, self.MAX_LENGTH))
+    self._buffer = ''
+    self.transport.loseConnection()
 
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
   def datagramReceived(self, data, (host, port)):
+    datapoints = []
     for line in data.splitlines():
       try:
-        metric, value, timestamp = line.strip().split()
-        datapoint = ( float(timestamp), float(value) )
-
-        self.metricReceived(metric, datapoint)
+        metric, value, timestamp = line.split()
+        datapoints.append( (metric, (float(timestamp), float(value))) )
       except:
         log.listener('invalid line received from %s, ignoring' % host)
 
+    if datapoints:
+      self.metricsReceived(datapoints)
 
-class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
+
+class MetricMessageReceiver(MetricReceiver, Int32StringReceiver):
+  """ Base class for receivers of Int32 framed messages from other carbon
+  daemons, which may ask to compress the connection (see carbon.compression)
+  with their first message.
+  """
   MAX_LENGTH = 2 ** 20
 
   def connectionMade(self):
     MetricReceiver.connectionMade(self)
-    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+    self.firstMessage = True
+    self.decompressor = None
+
+  def dataReceived(self, data):
+    if self.decompressor is None:
+      Int32StringReceiver.dataReceived(self, data)
+      return
+
+    # Decompress at most one frame's worth at a time, so an oversized frame
+    # is caught by MAX_LENGTH before the rest of it is inflated
+    instrumentation.increment('compression.bytesReceived', len(data))
+    while data and not self.transport.disconnecting:
+      try:
+        chunk = self.decompressor.decompress(data, self.MAX_LENGTH + self.prefixLength)
+      except zlib.error, e:
+        log.listener('invalid compressed data received from %s, disconnecting: %s' % (self.peerName, e))
+        self.transport.loseConnection()
+        return
+      data = self.decompressor.unconsumed_tail
+      instrumentation.increment('compression.bytesDecompressed', len(chunk))
+      Int32StringReceiver.dataReceived(self, chunk)
 
   def stringReceived(self, data):
+    if self.firstMessage:
+      self.firstMessage = False
+      if data == COMPRESSION_REQUEST:
+        self.sendString(COMPRESSION_ACCEPTED)
+        self.decompressor = zlib.decompressobj()
+        log.listener('%s connection with %s is compressed' % (self.__class__.__name__, self.peerName))
+        return
+    self.messageReceived(data)
+
+  def messageReceived(self, data):
+    raise NotImplementedError()
+
+
+class MetricPickleReceiver(MetricMessageReceiver):
+  def connectionMade(self):
+    MetricMessageReceiver.connectionMade(self)
+    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+
+  def messageReceived(self, data):
     try:
       datapoints = self.unpickler.loads(data)
     except:
       log.listener('invalid pickle received from %s, ignoring' % self.peerName)
       return
 
+    batch = []
     for (metric, datapoint) in datapoints:
       try:
         datapoint = ( float(datapoint[0]), float(datapoint[1]) ) #force proper types
       except:
         continue
 
-      self.metricReceived(metric, datapoint)
+      batch.append( (metric, datapoint) )
+
+    if batch:
+      self.metricsReceived(batch)
+
+
+class MetricBinaryReceiver(MetricMessageReceiver):
+  """ Receives messages in the format described in carbon.binaryformat """
+  def messageReceived(self, data):
+    try:
+      datapoints = decodeDatapoints(data)
+    except ValueError, e:
+      log.listener('invalid binary message received from %s, ignoring: %s' % (self.peerName, e))
+      return
+
+    if datapoints:
+      self.metricsReceived(datapoints)
+
+
+class WorkerChannelReceiver(MetricBinaryReceiver):
+  """ Receives the batches forwarded by receiver processes (see
+  carbon.workers), which have already been filtered, and their stats.
+  """
+  def getPeerName(self):
+    return "receiver process"
+
+  def messageReceived(self, data):
+    if data.startswith(STATS_MESSAGE):
+      try:
+        stats = decodeDatapoints(data[len(STATS_MESSAGE):])
+      except ValueError, e:
+        log.listener('invalid stats received from %s, ignoring: %s' % (self.peerName, e))
+        return
+      for stat, (timestamp, value) in stats:
+        instrumentation.increment(stat, value)
+    else:
+      MetricBinaryReceiver.messageReceived(self, data)
+
+  def metricsReceived(self, datapoints):
+    events.metricsReceived(datapoints)
 
 
 class CacheManagementHandler(Int32StringReceiver):
@@ -143,4 +267,5 @@ class CacheManagementHandler(Int32StringReceiver):
 
 # Avoid import circularities
 from carbon.cache import MetricCache
+from carbon.workers import STATS_MESSAGE
 from carbon import instrumentation
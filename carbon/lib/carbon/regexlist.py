@@ -2,27 +2,39 @@ import time
 import re
 import os.path
 from carbon import log
+from carbon.conf import settings
+from carbon.util import LRUCache
 from twisted.internet.task import LoopingCall
 
 
+# Patterns using backreferences or inline flags can't be safely joined into
+# one alternation, lists containing them are matched one regex at a time.
+UNCOMBINABLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]')
+
+
 class RegexList:
   """ Maintain a list of regex for matching whitelist and blacklist """
 
-  def __init__(self):
+  def __init__(self, name):
+    self.name = name
     self.regex_list = []
+    self.combined_regex = None
     self.list_file = None
     self.read_task = LoopingCall(self.read_list)
     self.rules_last_read = 0.0
+    self.cache = LRUCache(settings.REGEX_LIST_CACHE_SIZE)
+    self.match_time = 0.0
 
   def read_from(self, list_file):
     self.list_file = list_file
+    self.cache.max_size = settings.REGEX_LIST_CACHE_SIZE
     self.read_list()
     self.read_task.start(10, now=False)
 
   def read_list(self):
     # Clear rules and move on if file isn't there
     if not os.path.exists(self.list_file):
-      self.regex_list = []
+      self.set_patterns([])
       return
 
     try:
@@ -35,28 +47,60 @@ class RegexList:
       return
 
     # Begin read
-    new_regex_list = []
+    patterns = []
     for line in open(self.list_file):
       pattern = line.strip()
-      if line.startswith('#') or not line:
+      if pattern.startswith('#') or not pattern:
         continue
       try:
-        new_regex_list.append(re.compile(pattern))
+        re.compile(pattern)
+        patterns.append(pattern)
       except:
         log.err("Failed to parse '%s' in '%s'. Ignoring line" % (pattern, self.list_file))
 
-    self.regex_list = new_regex_list
+    self.set_patterns(patterns)
     self.rules_last_read = mtime
 
-  def __contains__(self, value):
+  def set_patterns(self, patterns):
+    self.regex_list = [re.compile(pattern) for pattern in patterns]
+    self.combined_regex = None
+
+    if patterns and not [p for p in patterns if UNCOMBINABLE_PATTERN.search(p)]:
+      try:
+        self.combined_regex = re.compile('|'.join(['(?:%s)' % p for p in patterns]))
+      except:
+        log.err("Failed to combine the patterns in '%s', matching them one at a time" % self.list_file)
+
+    self.cache.clear()
+
+  def matches(self, value):
+    if self.combined_regex is not None:
+      return bool( self.combined_regex.search(value) )
+
     for regex in self.regex_list:
       if regex.search(value):
         return True
     return False
 
+  def __contains__(self, value):
+    verdict = self.cache.get(value)
+    if verdict is None:
+      start = time.time()
+      verdict = self.matches(value)
+      self.match_time += time.time() - start
+      self.cache[value] = verdict
+    return verdict
+
   def __nonzero__(self):
     return bool(self.regex_list)
 
+  def reset_stats(self):
+    """Returns (cache hits, cache misses, seconds spent matching misses)
+    since the last call"""
+    hits, misses = self.cache.resetStats()
+    match_time, self.match_time = self.match_time, 0.0
+    return (hits, misses, match_time)
+
 
-WhiteList = RegexList()
-BlackList = RegexList()
+WhiteList = RegexList('whitelist')
+BlackList = RegexList('blacklist')
@@ -1,18 +1,113 @@
 import re
+import sre_parse
+import sre_constants
 from carbon.conf import OrderedConfigParser
 from carbon.util import parseDestinations
+from carbon.regexlist import UNCOMBINABLE_PATTERN
+
+
+# Python's re module can't compile patterns with more groups than this
+MAX_COMBINED_GROUPS = 99
+
+
+def isAnchored(pattern):
+  "Whether every match of the pattern has to start at the beginning"
+  try:
+    parsed = sre_parse.parse(pattern)
+  except:
+    return False
+  return len(parsed) > 0 and parsed[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
 
 
 class RelayRule:
-  def __init__(self, condition, destinations, continue_matching=False):
+  def __init__(self, condition, destinations, continue_matching=False, pattern=None):
     self.condition = condition
     self.destinations = destinations
     self.continue_matching = continue_matching
+    self.pattern = pattern # None for the default rule
 
   def matches(self, metric):
     return bool( self.condition(metric) )
 
 
+class CompiledRelayRules:
+  """Finds the rules a metric matches with a few combined regexes instead
+  of one search per rule, with the same first match and continue semantics
+  as scanning the rules in order.
+
+  Each rule becomes a lookahead alternative anchored at the start of the
+  name followed by an empty marker group, so the alternative that matches is
+  the first rule in order that would have matched, and the marker group
+  identifies it. Patterns that aren't anchored with ^ themselves are
+  prefixed to match anywhere in the name. Rules whose patterns can't be combined (backreferences,
+  named groups, inline flags) are searched on their own, in place.
+  """
+  def __init__(self, rules):
+    self.rules = rules
+    self.chunks = {} # { first rule index : [(regex or None, markers or rule index)] }
+
+  def buildChunks(self, start):
+    chunks = []
+    alternatives = []
+    markers = {}
+    groups = 0
+
+    for index in xrange(start, len(self.rules)):
+      pattern = self.rules[index].pattern
+      if pattern is None: # the default rule
+        pattern = ''
+      elif UNCOMBINABLE_PATTERN.search(pattern) or '(?P<' in pattern:
+        if alternatives:
+          chunks.append( (re.compile('|'.join(alternatives), re.I), markers) )
+          alternatives, markers, groups = [], {}, 0
+        chunks.append( (None, index) )
+        continue
+
+      pattern_groups = re.compile(pattern, re.I).groups
+      if alternatives and groups + pattern_groups + 1 > MAX_COMBINED_GROUPS:
+        chunks.append( (re.compile('|'.join(alternatives), re.I), markers) )
+        alternatives, markers, groups = [], {}, 0
+
+      groups += pattern_groups + 1
+      markers[groups] = index
+      if isAnchored(pattern):
+        alternatives.append( r'(?=%s)()' % pattern )
+      else:
+        alternatives.append( r'(?=[\s\S]*?(?:%s))()' % pattern )
+
+    if alternatives:
+      chunks.append( (re.compile('|'.join(alternatives), re.I), markers) )
+    return chunks
+
+  def firstMatch(self, metric, start):
+    "Index of the first rule from start on that the metric matches, or None"
+    chunks = self.chunks.get(start)
+    if chunks is None:
+      chunks = self.chunks[start] = self.buildChunks(start)
+
+    for regex, markers in chunks:
+      if regex is None:
+        if self.rules[markers].matches(metric):
+          return markers
+      else:
+        match = regex.match(metric)
+        if match:
+          return markers[match.lastindex]
+    return None
+
+  def matchingRules(self, metric):
+    start = 0
+    while start < len(self.rules):
+      index = self.firstMatch(metric, start)
+      if index is None:
+        return
+      rule = self.rules[index]
+      yield rule
+      if not rule.continue_matching:
+        return
+      start = index + 1
+
+
 def loadRelayRules(path):
   rules = []
   parser = OrderedConfigParser()
@@ -39,7 +134,8 @@ def loadRelayRules(path):
       continue_matching = False
       if parser.has_option(section, 'continue'):
         continue_matching = parser.getboolean(section, 'continue')
-      rule = RelayRule(condition=regex.search, destinations=destinations, continue_matching=continue_matching)
+      rule = RelayRule(condition=regex.search, destinations=destinations,
+                       continue_matching=continue_matching, pattern=pattern)
       rules.append(rule)
       continue
 
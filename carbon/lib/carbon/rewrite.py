@@ -1,20 +1,22 @@
-import time
 import re
 from os.path import exists, getmtime
 from twisted.internet.task import LoopingCall
 from carbon import log
+from carbon.conf import settings
+from carbon.util import LRUCache
+from carbon.regexlist import UNCOMBINABLE_PATTERN
 
 
 class RewriteRuleManager:
   def __init__(self):
-    self.preRules = []
-    self.postRules = []
+    self.preRules = RewriteRuleSet('pre')
+    self.postRules = RewriteRuleSet('post')
     self.read_task = LoopingCall(self.read_rules)
     self.rules_last_read = 0.0
 
   def clear(self):
-    self.preRules = []
-    self.postRules = []
+    self.preRules.set_rules([])
+    self.postRules.set_rules([])
 
   def read_from(self, rules_file):
     self.rules_file = rules_file
@@ -57,11 +59,55 @@ class RewriteRuleManager:
         elif section == 'post':
           post.append(rule)
 
-    self.preRules = pre
-    self.postRules = post
+    self.preRules.set_rules(pre)
+    self.postRules.set_rules(post)
     self.rules_last_read = mtime
 
 
+class RewriteRuleSet:
+  """The rules of one section, applied in order. Names none of the rules
+  match are recognised by one search with the patterns combined, and the
+  results are remembered for the most recently rewritten names."""
+  def __init__(self, name):
+    self.name = name
+    self.cache = LRUCache(settings.REWRITE_RULE_CACHE_SIZE)
+    self.set_rules([])
+
+  def set_rules(self, rules):
+    self.rules = rules
+    self.combined_regex = None
+
+    patterns = [rule.pattern for rule in rules]
+    if patterns and not [p for p in patterns if UNCOMBINABLE_PATTERN.search(p)]:
+      try:
+        self.combined_regex = re.compile('|'.join(['(?:%s)' % p for p in patterns]))
+      except:
+        log.err("Failed to combine the %s rewrite rules, applying them one at a time" % self.name)
+
+    self.cache.max_size = settings.REWRITE_RULE_CACHE_SIZE
+    self.cache.clear()
+
+  def __iter__(self):
+    return iter(self.rules)
+
+  def __len__(self):
+    return len(self.rules)
+
+  def apply(self, metric):
+    if not self.rules:
+      return metric
+
+    rewritten = self.cache.get(metric)
+    if rewritten is None:
+      rewritten = metric
+      # If no rule matches the name, none can match what earlier rules make of it
+      if self.combined_regex is None or self.combined_regex.search(metric):
+        for rule in self.rules:
+          rewritten = rule.apply(rewritten)
+      self.cache[metric] = rewritten
+    return rewritten
+
+
 class RewriteRule:
   def __init__(self, pattern, replacement):
     self.pattern = pattern
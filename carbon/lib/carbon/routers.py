@@ -1,6 +1,9 @@
 import imp
-from carbon.relayrules import loadRelayRules
-from carbon.hashing import ConsistentHashRing
+from carbon import log
+from carbon.conf import settings
+from carbon.relayrules import loadRelayRules, CompiledRelayRules
+from carbon.hashing import ConsistentHashRing, JumpHashRing, RendezvousHashRing
+from carbon.util import LRUCache
 
 
 class DatapointRouter:
@@ -17,34 +20,68 @@ class DatapointRouter:
     destinations which are configured (addDestination has been called for it)
     may be generated by this method."""
 
+  def groupByDestinations(self, datapoints):
+    """Groups a list of (metric, datapoint) tuples in a single pass, returns
+    a dict mapping each tuple of destinations to the datapoints that should
+    be sent to all of them. Datapoints whose metric can't be routed are
+    logged and dropped so the rest of the batch still goes out."""
+    groups = {}
+    for item in datapoints:
+      try:
+        destinations = tuple(self.getDestinations(item[0]))
+      except:
+        log.err(None, "Failed to route datapoint for metric %r" % (item[0],))
+        continue
+      if destinations in groups:
+        groups[destinations].append(item)
+      else:
+        groups[destinations] = [item]
+    return groups
+
 
 class RelayRulesRouter(DatapointRouter):
   def __init__(self, rules_path):
     self.rules_path = rules_path
-    self.rules = loadRelayRules(rules_path)
     self.destinations = set()
+    self.cache = LRUCache(settings.ROUTER_CACHE_SIZE)
+    self.loadRules()
+
+  def loadRules(self):
+    self.rules = loadRelayRules(self.rules_path)
+    self.matcher = CompiledRelayRules(self.rules)
+    self.cache.clear()
 
   def addDestination(self, destination):
     self.destinations.add(destination)
+    self.cache.clear()
 
   def removeDestination(self, destination):
     self.destinations.discard(destination)
+    self.cache.clear()
 
   def getDestinations(self, key):
-    for rule in self.rules:
-      if rule.matches(key):
-        for destination in rule.destinations:
-          if destination in self.destinations:
-            yield destination
-        if not rule.continue_matching:
-          return
+    destinations = self.cache.get(key)
+    if destinations is None:
+      destinations = self.cache[key] = tuple(self.computeDestinations(key))
+    return destinations
+
+  def computeDestinations(self, key):
+    for rule in self.matcher.matchingRules(key):
+      for destination in rule.destinations:
+        if destination in self.destinations:
+          yield destination
 
 
 class ConsistentHashingRouter(DatapointRouter):
+  ring_class = ConsistentHashRing
+
   def __init__(self, replication_factor=1):
     self.replication_factor = int(replication_factor)
     self.instance_ports = {} # { (server, instance) : port }
-    self.ring = ConsistentHashRing([])
+    self.ring = self.ring_class([])
+    # Metrics repeat every interval, remember where they were routed to.
+    # Any change to the ring or the key function invalidates the cache.
+    self.cache = LRUCache(settings.ROUTER_CACHE_SIZE)
 
   def addDestination(self, destination):
     (server, port, instance) = destination
@@ -52,6 +89,7 @@ class ConsistentHashingRouter(DatapointRouter):
       raise Exception("destination instance (%s, %s) already configured" % (server, instance))
     self.instance_ports[ (server, instance) ] = port
     self.ring.add_node( (server, instance) )
+    self.cache.clear()
 
   def removeDestination(self, destination):
     (server, port, instance) = destination
@@ -59,8 +97,15 @@ class ConsistentHashingRouter(DatapointRouter):
       raise Exception("destination instance (%s, %s) not configured" % (server, instance))
     del self.instance_ports[ (server, instance) ]
     self.ring.remove_node( (server, instance) )
+    self.cache.clear()
 
   def getDestinations(self, metric):
+    destinations = self.cache.get(metric)
+    if destinations is None:
+      destinations = self.cache[metric] = tuple(self.computeDestinations(metric))
+    return destinations
+
+  def computeDestinations(self, metric):
     key = self.getKey(metric)
 
     used_servers = set()
@@ -80,6 +125,7 @@ class ConsistentHashingRouter(DatapointRouter):
 
   def setKeyFunction(self, func):
     self.getKey = func
+    self.cache.clear()
 
   def setKeyFunctionFromModule(self, keyfunc_spec):
     module_path, func_name = keyfunc_spec.rsplit(':', 1)
@@ -88,3 +134,21 @@ class ConsistentHashingRouter(DatapointRouter):
     module = imp.load_module('keyfunc_module', module_file, module_path, description)
     keyfunc = getattr(module, func_name)
     self.setKeyFunction(keyfunc)
+
+
+class JumpHashingRouter(ConsistentHashingRouter):
+  "Routes with jump consistent hashing over the destinations in configured order"
+  ring_class = JumpHashRing
+
+
+class RendezvousHashingRouter(ConsistentHashingRouter):
+  "Routes with rendezvous (highest random weight) hashing"
+  ring_class = RendezvousHashRing
+
+
+# RELAY_METHOD values that route by hashing metric names
+HASHING_ROUTERS = {
+  'consistent-hashing' : ConsistentHashingRouter,
+  'jump-hashing' : JumpHashingRouter,
+  'rendezvous-hashing' : RendezvousHashingRouter,
+}
@@ -40,7 +40,7 @@ class CarbonRootService(MultiService):
 def createBaseService(config):
     from carbon.conf import settings
     from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
-                                  MetricDatagramReceiver)
+                                  MetricBinaryReceiver, MetricDatagramReceiver)
 
     root_service = CarbonRootService()
     root_service.setName(settings.program)
@@ -59,24 +59,31 @@ def createBaseService(config):
         amqp_exchange_name = settings.get("AMQP_EXCHANGE", "graphite")
 
 
-    for interface, port, protocol in ((settings.LINE_RECEIVER_INTERFACE,
-                                       settings.LINE_RECEIVER_PORT,
-                                       MetricLineReceiver),
-                                      (settings.PICKLE_RECEIVER_INTERFACE,
-                                       settings.PICKLE_RECEIVER_PORT,
-                                       MetricPickleReceiver)):
-        if port:
-            factory = ServerFactory()
-            factory.protocol = protocol
-            service = TCPServer(int(port), factory, interface=interface)
+    if settings.RECEIVER_PROCESSES:
+        from carbon.workers import createReceiverServices
+        createReceiverServices(root_service)
+    else:
+        for interface, port, protocol in ((settings.LINE_RECEIVER_INTERFACE,
+                                           settings.LINE_RECEIVER_PORT,
+                                           MetricLineReceiver),
+                                          (settings.PICKLE_RECEIVER_INTERFACE,
+                                           settings.PICKLE_RECEIVER_PORT,
+                                           MetricPickleReceiver),
+                                          (settings.BINARY_RECEIVER_INTERFACE,
+                                           settings.BINARY_RECEIVER_PORT,
+                                           MetricBinaryReceiver)):
+            if port:
+                factory = ServerFactory()
+                factory.protocol = protocol
+                service = TCPServer(int(port), factory, interface=interface)
+                service.setServiceParent(root_service)
+
+        if settings.ENABLE_UDP_LISTENER:
+            service = UDPServer(int(settings.UDP_RECEIVER_PORT),
+                                MetricDatagramReceiver(),
+                                interface=settings.UDP_RECEIVER_INTERFACE)
             service.setServiceParent(root_service)
 
-    if settings.ENABLE_UDP_LISTENER:
-        service = UDPServer(int(settings.UDP_RECEIVER_PORT),
-                            MetricDatagramReceiver(),
-                            interface=settings.UDP_RECEIVER_INTERFACE)
-        service.setServiceParent(root_service)
-
     if use_amqp:
         factory = amqp_listener.createAMQPListener(
             amqp_user, amqp_password,
@@ -115,7 +122,7 @@ def createCacheService(config):
     from carbon.protocols import CacheManagementHandler
 
     # Configure application components
-    events.metricReceived.addHandler(MetricCache.store)
+    events.metricsReceived.addHandler(MetricCache.storeMany)
 
     root_service = createBaseService(config)
     factory = ServerFactory()
@@ -140,7 +147,7 @@ def createCacheService(config):
 def createAggregatorService(config):
     from carbon.aggregator import receiver
     from carbon.aggregator.rules import RuleManager
-    from carbon.routers import ConsistentHashingRouter
+    from carbon.routers import ConsistentHashingRouter, HASHING_ROUTERS
     from carbon.client import CarbonClientManager
     from carbon.rewrite import RewriteRuleManager
     from carbon.conf import settings
@@ -149,12 +156,17 @@ def createAggregatorService(config):
     root_service = createBaseService(config)
 
     # Configure application components
-    router = ConsistentHashingRouter()
+    router = HASHING_ROUTERS.get(settings.RELAY_METHOD, ConsistentHashingRouter)()
+    state.router = router
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(receiver.process)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    if settings.AGGREGATOR_PROCESSES:
+      from carbon.aggregator.workers import createAggregatorServices
+      createAggregatorServices(root_service)
+    else:
+      events.metricsReceived.addHandler(receiver.process_many)
+    events.metricsGenerated.addHandler(client_manager.sendDatapoints)
 
     RuleManager.read_from(settings["aggregation-rules"])
     if exists(settings["rewrite-rules"]):
@@ -170,7 +182,7 @@ def createAggregatorService(config):
 
 
 def createRelayService(config):
-    from carbon.routers import RelayRulesRouter, ConsistentHashingRouter
+    from carbon.routers import RelayRulesRouter, HASHING_ROUTERS
     from carbon.client import CarbonClientManager
     from carbon.conf import settings
     from carbon import events
@@ -180,14 +192,15 @@ def createRelayService(config):
     # Configure application components
     if settings.RELAY_METHOD == 'rules':
       router = RelayRulesRouter(settings["relay-rules"])
-    elif settings.RELAY_METHOD == 'consistent-hashing':
-      router = ConsistentHashingRouter(settings.REPLICATION_FACTOR)
+    elif settings.RELAY_METHOD in HASHING_ROUTERS:
+      router = HASHING_ROUTERS[settings.RELAY_METHOD](settings.REPLICATION_FACTOR)
+    state.router = router
 
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(client_manager.sendDatapoint)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    events.metricsReceived.addHandler(client_manager.sendDatapoints)
+    events.metricsGenerated.addHandler(client_manager.sendDatapoints)
 
     if not settings.DESTINATIONS:
       raise Exception("Required setting DESTINATIONS is missing from carbon.conf")
@@ -4,5 +4,7 @@ several modules.
 """
 
 metricReceiversPaused = False
+metricReceiversHeld = False
 cacheTooFull = False
 connectedMetricReceiverProtocols = set()
+router = None
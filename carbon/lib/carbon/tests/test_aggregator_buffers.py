@@ -0,0 +1,142 @@
+import time
+from unittest import TestCase
+
+from carbon import events
+from carbon.conf import settings
+from carbon.aggregator.buffers import BufferManager, IntervalBuffer
+from carbon.aggregator.rules import AGGREGATION_METHODS, get_aggregation_func
+from carbon.aggregator.sketch import QuantileSketch
+import carbon.service # sets up state.events and state.instrumentation
+
+
+class BufferManagerTest(TestCase):
+
+    def setUp(self):
+        self.generated = []
+        events.metricsGenerated.addHandler(self.generated.append)
+
+    def tearDown(self):
+        events.metricsGenerated.removeHandler(self.generated.append)
+        BufferManager.clear()
+
+    def configure(self, metric, frequency):
+        buffer = BufferManager.get_buffer(metric)
+        buffer.configure_aggregation(frequency, AGGREGATION_METHODS['sum'])
+        return buffer
+
+    def test_one_task_per_frequency(self):
+        for i in range(10):
+            self.configure("a%d" % i, 60)
+        self.configure("b", 10)
+        self.assertEqual([10, 60], sorted(BufferManager.schedules))
+        self.assertEqual(10, len(BufferManager.schedules[60][1]))
+
+    def test_sweep_sends_one_batch(self):
+        now = int(time.time())
+        for i in range(10):
+            self.configure("a%d" % i, 60).input((now, i))
+        BufferManager.compute_values(60)
+        self.assertEqual(1, len(self.generated))
+        self.assertEqual(sorted([("a%d" % i, (now - now % 60, i)) for i in range(10)]),
+                         sorted(self.generated[0]))
+
+        BufferManager.compute_values(60)
+        self.assertEqual(1, len(self.generated))
+
+    def test_large_sweeps_are_batched(self):
+        now = int(time.time())
+        buffers = [self.configure("a%d" % i, 60) for i in range(10)]
+        for buffer in buffers:
+            buffer.input((now, 1))
+        BufferManager.remove_buffer("a9")
+
+        sweep_size = settings["AGGREGATION_SWEEP_SIZE"]
+        settings["AGGREGATION_SWEEP_SIZE"] = 3
+        try:
+            list(BufferManager.compute_batches(buffers, now))
+        finally:
+            settings["AGGREGATION_SWEEP_SIZE"] = sweep_size
+        self.assertEqual([3, 3, 3], [len(batch) for batch in self.generated])
+
+    def test_closing_the_last_buffer_stops_the_task(self):
+        buffer = self.configure("a", 60)
+        compute_task = BufferManager.schedules[60][0]
+        buffer.close()
+        self.assertFalse(compute_task.running)
+        self.assertEqual({}, BufferManager.schedules)
+
+    def test_clear_stops_every_task(self):
+        self.configure("a", 60)
+        self.configure("b", 10)
+        tasks = [compute_task for compute_task, buffers in BufferManager.schedules.values()]
+        BufferManager.clear()
+        self.assertFalse([task for task in tasks if task.running])
+        self.assertEqual(0, len(BufferManager))
+
+
+class IntervalBufferTest(TestCase):
+
+    def accumulate(self, values, method):
+        func = get_aggregation_func(method)
+        buffer = IntervalBuffer(0, getattr(func, 'quantile', None) is not None)
+        for value in values:
+            buffer.input((0, value))
+        return func(buffer)
+
+    def test_methods(self):
+        values = [3, 1, 4, 1, 5, 9, 2, 6]
+        self.assertEqual(31, self.accumulate(values, 'sum'))
+        self.assertEqual(31 / 8.0, self.accumulate(values, 'avg'))
+        self.assertEqual(1, self.accumulate(values, 'min'))
+        self.assertEqual(9, self.accumulate(values, 'max'))
+        self.assertEqual(8, self.accumulate(values, 'count'))
+        self.assertEqual(6, self.accumulate(values, 'last'))
+
+    def test_unknown_methods(self):
+        self.assertEqual(None, get_aggregation_func('median'))
+        self.assertEqual(None, get_aggregation_func('p101'))
+
+    def test_percentiles_are_within_the_sketch_accuracy(self):
+        values = range(1, 10001)
+        for method, expected in (('p50', 5000), ('p99', 9900), ('p99.9', 9990), ('p0', 1)):
+            estimate = self.accumulate(values, method)
+            self.assertTrue(abs(estimate - expected) <= expected * 0.01, (method, estimate))
+
+    def test_non_finite_values_are_skipped(self):
+        values = [1, float('inf'), 2, float('-inf'), float('nan'), 0]
+        self.assertEqual(3, self.accumulate(values, 'sum'))
+        self.assertEqual(0, self.accumulate(values, 'min'))
+        self.assertEqual(2, self.accumulate(values, 'max'))
+        self.assertEqual(3, self.accumulate(values, 'count'))
+        self.assertEqual(0, self.accumulate(values, 'last'))
+        self.assertTrue(abs(self.accumulate(values, 'p50') - 1) <= 0.01)
+
+    def test_memory_saved(self):
+        buffer = BufferManager.get_buffer("a")
+        buffer.configure_aggregation(60, AGGREGATION_METHODS['sum'])
+        for i in range(100):
+            buffer.input((0, i))
+        self.assertTrue(BufferManager.memory_saved() >= 100 * 8)
+        BufferManager.clear()
+
+
+class QuantileSketchTest(TestCase):
+
+    def test_merged_sketches_match_one_sketch(self):
+        whole, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for value in range(-500, 1000):
+            whole.add(value)
+            if value % 2:
+                first.add(value)
+            else:
+                second.add(value)
+        first.merge(second)
+        for q in (0, 0.1, 0.5, 0.9, 1):
+            self.assertEqual(whole.quantile(q), first.quantile(q))
+
+    def test_buckets_are_bounded(self):
+        sketch = QuantileSketch(max_buckets=100)
+        for value in range(1, 100000):
+            sketch.add(value)
+        self.assertTrue(len(sketch) <= 100)
+        self.assertTrue(abs(sketch.quantile(0.99) - 99000) <= 990)
@@ -0,0 +1,105 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from carbon.aggregator import receiver
+from carbon.aggregator.buffers import BufferManager
+from carbon.aggregator.rules import AggregationRule, RuleManager
+import carbon.service # sets up state.events and state.instrumentation
+
+
+RULES = [
+    AggregationRule("servers.<host>.cpu.total", "servers.all.cpu.total", "sum", 60),
+    AggregationRule("servers.*.requests.<<path>>", "requests.<path>", "sum", 60),
+    AggregationRule("apps.<app>.*.latency", "apps.<app>.latency", "avg", 60),
+    AggregationRule("<env>.apps.web*.errors", "<env>.web.errors", "sum", 60),
+    AggregationRule("servers.db1.cpu", "db.cpu", "avg", 60),
+    AggregationRule("<<everything>>", "all.count", "sum", 60),
+]
+
+METRICS = [
+    "servers.web1.cpu.total", "servers.web1.cpu.totals", "servers.web1.requests.api.users",
+    "apps.store.host1.latency", "apps.store.latency", "prod.apps.web3.errors",
+    "prod.apps.db3.errors", "servers.db1.cpu.total", "servers.db1.cpuload", "other",
+]
+
+
+class RuleManagerTest(TestCase):
+
+    def setUp(self):
+        RuleManager.set_rules(list(RULES))
+
+    def tearDown(self):
+        RuleManager.clear()
+
+    def linearScan(self, metric):
+        aggregates = []
+        for rule in RULES:
+            aggregate_metric = rule.get_aggregate_metric(metric)
+            if aggregate_metric is not None:
+                aggregates.append((rule, aggregate_metric))
+        return tuple(aggregates)
+
+    def test_index_matches_like_a_linear_scan(self):
+        for metric in METRICS:
+            self.assertEqual(self.linearScan(metric), RuleManager.get_aggregate_metrics(metric))
+
+    def test_index_narrows_candidates(self):
+        candidates = RuleManager.index.candidates("apps.store.host1.latency")
+        self.assertEqual([RULES[2], RULES[5]], candidates)
+
+    def test_aggregates_are_cached(self):
+        for metric in METRICS:
+            RuleManager.get_aggregate_metrics(metric)
+            RuleManager.get_aggregate_metrics(metric)
+        self.assertEqual((len(METRICS), len(METRICS)), RuleManager.cache.resetStats())
+
+    def test_setting_rules_clears_the_cache(self):
+        RuleManager.get_aggregate_metrics("servers.web1.cpu.total")
+        RuleManager.set_rules(RULES[:1])
+        self.assertEqual(0, len(RuleManager.cache))
+        self.assertEqual(((RULES[0], "servers.all.cpu.total"),),
+                         RuleManager.get_aggregate_metrics("servers.web1.cpu.total"))
+
+
+class RuleReloadTest(TestCase):
+
+    def setUp(self):
+        fd, self.rules_path = tempfile.mkstemp()
+        os.close(fd)
+        RuleManager.rules_file = self.rules_path
+        RuleManager.rules_last_read = 0.0
+
+    def tearDown(self):
+        os.unlink(self.rules_path)
+        RuleManager.clear()
+        BufferManager.clear()
+
+    def write_rules(self, lines):
+        with open(self.rules_path, 'w') as rules_file:
+            rules_file.write('\n'.join(lines) + '\n')
+        RuleManager.rules_last_read = 0.0
+        RuleManager.read_rules()
+
+    def test_unchanged_rules_keep_their_buffers(self):
+        self.write_rules(["cpu.all (60) = sum servers.<host>.cpu",
+                          "memory.all (60) = sum servers.<host>.memory"])
+        kept_rule = RuleManager.rules[0]
+        receiver.process("servers.host1.cpu", (0, 1))
+        receiver.process("servers.host1.memory", (0, 1))
+        cpu_buffer = BufferManager.buffers["cpu.all"]
+
+        self.write_rules(["cpu.all (60) = sum servers.<host>.cpu",
+                          "disk.all (60) = sum servers.<host>.disk"])
+        self.assertTrue(RuleManager.rules[0] is kept_rule)
+        self.assertTrue(BufferManager.buffers["cpu.all"] is cpu_buffer)
+        self.assertFalse("memory.all" in BufferManager.buffers)
+        self.assertEqual((), RuleManager.get_aggregate_metrics("servers.host1.memory"))
+
+    def test_changed_frequency_replaces_the_buffer(self):
+        self.write_rules(["cpu.all (60) = sum servers.<host>.cpu"])
+        receiver.process("servers.host1.cpu", (0, 1))
+        self.write_rules(["cpu.all (10) = sum servers.<host>.cpu"])
+        self.assertFalse("cpu.all" in BufferManager.buffers)
+        receiver.process("servers.host1.cpu", (0, 1))
+        self.assertEqual(10, BufferManager.buffers["cpu.all"].aggregation_frequency)
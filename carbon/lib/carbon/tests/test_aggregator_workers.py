@@ -0,0 +1,101 @@
+from unittest import TestCase
+
+from carbon import events, state
+from carbon.aggregator.buffers import BufferManager
+from carbon.aggregator.rules import AggregationRule, RuleManager
+from carbon.aggregator.workers import (AggregatorDispatcher, PartitionReceiver,
+                                       getPartition, getRuleKey)
+import carbon.service # sets up state.events and state.instrumentation
+
+
+RULES = [
+    AggregationRule("servers.<host>.cpu", "servers.all.cpu", "sum", 60),
+    AggregationRule("servers.<host>.cpu", "servers.<host>.cpu.max", "max", 60),
+]
+
+
+class FakeChannel:
+    connected = True
+
+    def __init__(self):
+        self.sent = []
+
+    def sendDatapoints(self, datapoints):
+        self.sent.extend(datapoints)
+
+
+class AggregatorWorkersTest(TestCase):
+
+    def setUp(self):
+        RuleManager.set_rules(list(RULES))
+        self.generated = []
+        events.metricsGenerated.addHandler(self.generated.extend)
+
+    def tearDown(self):
+        events.metricsGenerated.removeHandler(self.generated.extend)
+        RuleManager.clear()
+        BufferManager.clear()
+
+    def forwarded(self, datapoints):
+        "What the daemon sends each of 4 aggregator processes"
+        dispatcher = AggregatorDispatcher(4)
+        for channel in dispatcher.channels:
+            channel.channel = FakeChannel()
+        dispatcher.process_many(datapoints)
+        return [channel.channel.sent for channel in dispatcher.channels]
+
+    def test_datapoints_go_to_the_partitions_of_their_aggregates(self):
+        datapoints = [("servers.host%d.cpu" % i, (0, i)) for i in range(20)]
+        datapoints.append(("servers.all.cpu", (0, 1)))
+        forwarded = self.forwarded(datapoints + [("servers.host1.memory", (0, 1))])
+        self.assertEqual(datapoints[:-1] + [("servers.host1.memory", (0, 1))], self.generated)
+
+        for metric, datapoint in datapoints[:-1]:
+            for rule, aggregate_metric in ((RULES[0], "servers.all.cpu"), (RULES[1], metric + ".max")):
+                name = "%s %s" % (aggregate_metric, getRuleKey(rule))
+                for partition, sent in enumerate(forwarded):
+                    self.assertEqual(partition == getPartition(aggregate_metric, 4),
+                                     (name, datapoint) in sent)
+
+    def test_partitions_buffer_what_they_are_sent(self):
+        datapoints = [("servers.host%d.cpu" % i, (0, i)) for i in range(20)]
+        owned = set()
+        for worker_id, sent in enumerate(self.forwarded(datapoints)):
+            PartitionReceiver(worker_id, 4).process_many(sent)
+            for aggregate_metric in BufferManager.buffers:
+                self.assertEqual(worker_id, getPartition(aggregate_metric, 4))
+            owned.update(BufferManager.buffers)
+            BufferManager.clear()
+        self.assertEqual(21, len(owned))
+
+    def test_unknown_rules_are_counted(self):
+        receiver = PartitionReceiver(0, 1)
+        receiver.process_many([("servers.all.cpu servers.<host>.cpu servers.all.cpu avg 60", (0, 1))])
+        self.assertEqual({}, BufferManager.buffers)
+        self.assertEqual(1, state.instrumentation.stats.pop('aggregatorUnknownRules'))
+
+    def test_receiving_waits_for_every_process(self):
+        dispatcher = AggregatorDispatcher(2)
+        dispatcher.holdReceiving()
+        try:
+            dispatcher.channels[0].connected(FakeChannel())
+            self.assertTrue(state.metricReceiversPaused)
+            # eg. a relay client whose send queue drained
+            events.resumeReceivingMetrics()
+            self.assertTrue(state.metricReceiversPaused)
+            dispatcher.channels[1].connected(FakeChannel())
+            self.assertFalse(state.metricReceiversPaused)
+        finally:
+            state.metricReceiversHeld = False
+            events.resumeReceivingMetrics()
+
+    def test_unicode_names_are_partitioned_by_their_utf8_encoding(self):
+        self.assertEqual(getPartition("servers.all.cpu", 7), getPartition(u"servers.all.cpu", 7))
+        self.assertEqual(getPartition("caf\xc3\xa9.cpu", 7), getPartition(u"caf\xe9.cpu", 7))
+
+    def test_batches_are_held_while_a_process_is_down(self):
+        dispatcher = AggregatorDispatcher(1)
+        dispatcher.process_many([("servers.host1.cpu", (0, 1))])
+        channel = FakeChannel()
+        dispatcher.channels[0].connected(channel)
+        self.assertEqual(2, len(channel.sent))
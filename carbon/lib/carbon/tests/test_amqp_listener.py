@@ -0,0 +1,85 @@
+from os.path import dirname, join
+from unittest import TestCase
+
+from carbon.conf import settings
+settings.setdefault("CONF_DIR", join(dirname(__file__), "data"))
+
+from twisted.internet.defer import succeed
+from txamqp.queue import TimeoutDeferredQueue, Closed
+from carbon import events
+from carbon.amqp_listener import createAMQPListener
+import carbon.service # sets up state.events and state.instrumentation
+
+
+class FakeContent:
+    def __init__(self, body):
+        self.body = body
+
+
+class FakeMessage:
+    def __init__(self, routing_key, body, delivery_tag=1):
+        self.routing_key = routing_key
+        self.content = FakeContent(body)
+        self.delivery_tag = delivery_tag
+
+
+class FakeChannel:
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acks.append((delivery_tag, multiple))
+        return succeed(None)
+
+
+class AMQPListenerTest(TestCase):
+
+    def setUp(self):
+        self.name_in_body = settings.get("AMQP_METRIC_NAME_IN_BODY", False)
+        self.factory = createAMQPListener("guest", "guest", "/", "graphite")
+        self.protocol = self.factory.buildProtocol(None)
+        self.batches = []
+        events.metricsReceived.addHandler(self.batches.append)
+
+    def tearDown(self):
+        settings["AMQP_METRIC_NAME_IN_BODY"] = self.name_in_body
+        events.metricsReceived.removeHandler(self.batches.append)
+
+    def parse(self, body, routing_key="a.b"):
+        return self.protocol.parseMessage(FakeMessage(routing_key, body))
+
+    def test_routing_key_is_the_metric_name(self):
+        settings["AMQP_METRIC_NAME_IN_BODY"] = False
+        self.assertEqual([("a.b", (10.0, 1.0)), ("a.b", (20.0, 2.0))],
+                         self.parse("1 10\n2 20\n"))
+        self.assertEqual([("a.b", (10.0, 1.0))], self.parse("1 10"))
+
+    def test_metric_names_in_body(self):
+        settings["AMQP_METRIC_NAME_IN_BODY"] = True
+        self.assertEqual([("c.d", (10.0, 1.0)), ("e.f", (20.0, 2.0))],
+                         self.parse("c.d 1 10\ne.f 2 20\n"))
+
+    def test_bad_lines_are_skipped(self):
+        settings["AMQP_METRIC_NAME_IN_BODY"] = False
+        self.assertEqual([("a.b", (20.0, 2.0))], self.parse("x 10\n2 20\n"))
+        self.assertEqual([("a.b", (10.0, 1.0))], self.parse("1 10\n\n2\n"))
+        # Fields of different lines are never paired up
+        self.assertEqual([], self.parse("1\n10 2 20\n"))
+
+    def test_arrived_messages_are_acked_as_one_batch(self):
+        settings["AMQP_METRIC_NAME_IN_BODY"] = False
+        queue = TimeoutDeferredQueue()
+        for tag in range(1, 4):
+            queue.put(FakeMessage("a.b", "%d 10\n" % tag, delivery_tag=tag))
+        self.protocol.prefetch_count = 10
+        self.protocol.chan = FakeChannel()
+        self.protocol.queue = lambda consumer_tag: succeed(queue)
+
+        loop = self.protocol.receive_loop()
+        self.protocol.backlog_task.stop()
+        self.assertEqual([[("a.b", (10.0, 1.0)), ("a.b", (10.0, 2.0)), ("a.b", (10.0, 3.0))]],
+                         self.batches)
+        self.assertEqual([(3, True)], self.protocol.chan.acks)
+
+        queue.close()
+        loop.addErrback(lambda failure: failure.trap(Closed))
@@ -0,0 +1,201 @@
+import shutil
+import tempfile
+from unittest import TestCase
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from twisted.test.proto_helpers import StringTransport
+
+from carbon.conf import settings
+from carbon.client import SendQueue, QueuedBatch, CarbonClientFactory, CarbonClientManager
+from carbon.routers import DatapointRouter
+
+
+class SendQueueTest(TestCase):
+
+    def setUp(self):
+        self.batch_size = settings.MAX_DATAPOINTS_PER_MESSAGE
+        settings["MAX_DATAPOINTS_PER_MESSAGE"] = 2
+        self.queue = SendQueue()
+
+    def tearDown(self):
+        settings["MAX_DATAPOINTS_PER_MESSAGE"] = self.batch_size
+
+    def test_datapoints_are_taken_in_order_by_batch(self):
+        """Datapoints come out in order, MAX_DATAPOINTS_PER_MESSAGE at a time."""
+        for i in range(5):
+            self.queue.append(("a.b", (i, i)))
+        self.assertEqual(5, self.queue.size)
+        taken = []
+        while self.queue.size:
+            taken.append([t for (m, (t, v)) in self.queue.takeBatch().datapoints])
+        self.assertEqual([[0, 1], [2, 3], [4]], taken)
+
+    def test_taken_batch_is_not_extended(self):
+        """Appending after the last batch was taken starts a new batch."""
+        self.queue.append(("a.b", (0, 0)))
+        batch = self.queue.takeBatch()
+        self.queue.append(("a.b", (1, 1)))
+        self.assertEqual(1, len(batch))
+        self.assertEqual(1, self.queue.size)
+
+    def test_payload_is_serialized_once(self):
+        calls = []
+        def serialize(datapoints):
+            calls.append(datapoints)
+            return "payload"
+        self.queue.append(("a.b", (0, 0)))
+        batch = self.queue.takeBatch()
+        self.assertEqual("payload", batch.getPayload(serialize))
+        self.assertEqual("payload", batch.getPayload(serialize))
+        self.assertEqual(1, len(calls))
+
+
+class FakeRouter(DatapointRouter):
+
+    def __init__(self, routes):
+        self.routes = routes
+
+    def getDestinations(self, metric):
+        return iter(self.routes[metric])
+
+
+class FakeFactory(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def sendBatch(self, batch):
+        self.batches.append(batch)
+
+
+class CarbonClientManagerTest(TestCase):
+
+    def test_replicas_share_batches(self):
+        """Datapoints are grouped by destinations and every replica gets the
+        same batch object, so it is only serialized once."""
+        router = FakeRouter({"a": ["x", "y"], "b": ["y"], "c": ["x", "y"]})
+        manager = CarbonClientManager(router)
+        manager.client_factories = {"x": FakeFactory(), "y": FakeFactory()}
+        manager.sendDatapoints([("a", (1, 1)), ("b", (1, 2)), ("c", (1, 3))])
+
+        x = manager.client_factories["x"].batches
+        y = manager.client_factories["y"].batches
+        self.assertEqual([[("a", (1, 1)), ("c", (1, 3))]],
+                         [batch.datapoints for batch in x])
+        self.assertEqual(2, len(y))
+        self.assertTrue(x[0] in y)
+        self.assertEqual([[("b", (1, 2))]],
+                         [batch.datapoints for batch in y if batch is not x[0]])
+
+
+class FakeProtocol(object):
+
+    paused = False
+
+    def __init__(self):
+        self.sendQueuedCalls = 0
+
+    def sendQueued(self):
+        self.sendQueuedCalls += 1
+
+
+class DiskQueueOverflowTest(TestCase):
+
+    def setUp(self):
+        self.saved = dict((key, settings[key]) for key in ("USE_DISK_QUEUE", "MAX_QUEUE_SIZE"))
+        self.saved["QUEUE_DIR"] = settings.get("QUEUE_DIR")
+        settings["QUEUE_DIR"] = tempfile.mkdtemp()
+        settings["USE_DISK_QUEUE"] = True
+        settings["MAX_QUEUE_SIZE"] = 2
+        self.factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+
+    def tearDown(self):
+        shutil.rmtree(settings["QUEUE_DIR"])
+        settings.update(self.saved)
+
+    def test_overflow_is_queued_on_disk_and_drained_in_order(self):
+        for i in range(4):
+            self.factory.sendBatch(QueuedBatch([("a.b", (i, 1.0))]))
+        self.assertEqual(2, self.factory.queueSize)
+        self.assertEqual(2, self.factory.diskQueue.size)
+
+        # Nothing is drained while disconnected
+        self.factory.drainDiskQueue()
+        self.assertEqual(2, self.factory.diskQueue.size)
+
+        self.factory.connectedProtocols.append(FakeProtocol())
+        self.factory.queue.takeBatch()
+        self.factory.queue.takeBatch()
+        self.factory.drainDiskQueue()
+        self.assertEqual(1, self.factory.connectedProtocols[0].sendQueuedCalls)
+        self.assertEqual(0, self.factory.diskQueue.size)
+        taken = []
+        while self.factory.queueSize:
+            taken.extend([t for (m, (t, v)) in self.factory.queue.takeBatch().datapoints])
+        self.assertEqual([2, 3], taken)
+
+
+class FakeConnector:
+    host = "127.0.0.1"
+    port = 2004
+
+
+class MultipleConnectionsTest(TestCase):
+
+    def setUp(self):
+        self.connections = settings["DESTINATION_CONNECTIONS"]
+        settings["DESTINATION_CONNECTIONS"] = 2
+        self.factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        self.protocols = []
+        for connection in self.factory.connections:
+            protocol = connection.buildProtocol(None)
+            protocol.makeConnection(StringTransport())
+            self.protocols.append(protocol)
+
+    def tearDown(self):
+        settings["DESTINATION_CONNECTIONS"] = self.connections
+
+    def sent(self):
+        return [len(protocol.transport.value()) > 0 for protocol in self.protocols]
+
+    def connectionLost(self, protocol):
+        "What the reactor does when one of the connections goes"
+        reason = Failure(ConnectionDone())
+        protocol.connectionLost(reason)
+        self.factory.clientConnectionLost(FakeConnector(), reason)
+
+    def test_batches_are_spread_across_connections(self):
+        self.assertEqual(2, len(self.factory.connectedProtocols))
+        self.factory.sendBatch(QueuedBatch([("a.b", (0, 1.0))]))
+        self.factory.sendBatch(QueuedBatch([("a.b", (1, 1.0))]))
+        self.assertEqual([True, True], self.sent())
+
+    def test_paused_connections_are_skipped(self):
+        self.protocols[0].pauseProducing()
+        for i in range(3):
+            self.factory.sendBatch(QueuedBatch([("a.b", (i, 1.0))]))
+        self.assertEqual([False, True], self.sent())
+        self.assertEqual(0, self.factory.queueSize)
+
+    def test_queue_is_drained_by_whichever_connection_resumes(self):
+        for protocol in self.protocols:
+            protocol.pauseProducing()
+        for i in range(3):
+            self.factory.sendBatch(QueuedBatch([("a.b", (i, 1.0))]))
+        self.assertEqual(3, self.factory.queueSize)
+        self.protocols[1].resumeProducing()
+        self.assertEqual(0, self.factory.queueSize)
+        self.assertEqual([False, True], self.sent())
+
+    def test_ready_to_stop_once_every_connection_is_lost(self):
+        self.factory.started = True
+        readyToStop = self.factory.disconnect()
+        self.assertTrue(self.protocols[0].transport.disconnecting)
+        for protocol in self.protocols:
+            self.assertFalse(readyToStop.called)
+            self.connectionLost(protocol)
+        self.assertTrue(readyToStop.called)
+
+    def test_lost_connections_are_forgotten(self):
+        self.protocols[0].connectionLost(Failure(ConnectionDone()))
+        self.assertEqual([self.protocols[1]], self.factory.connectedProtocols)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from carbon.diskqueue import DiskQueue
+
+
+class DiskQueueTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def takeAll(self, queue):
+        taken = []
+        record = queue.take()
+        while record is not None:
+            taken.extend([t for (m, (t, v)) in record[0]])
+            record = queue.take()
+        return taken
+
+    def test_records_are_taken_in_order_across_segments(self):
+        queue = DiskQueue(self.path, 1, 2 ** 20)
+        for i in range(5):
+            queue.append([("a.b", (i, 1.0)), ("a.c", (i, 2.0))])
+        self.assertEqual(10, queue.size)
+        self.assertEqual([0, 0, 1, 1, 2, 2, 3, 3, 4, 4], self.takeAll(queue))
+        self.assertEqual(0, queue.size)
+        self.assertEqual(0, queue.bytes)
+        # Fully read segments are removed
+        self.assertEqual(1, len([n for n in os.listdir(self.path) if n.endswith('.segment')]))
+
+    def test_queue_resumes_after_reopening(self):
+        queue = DiskQueue(self.path, 1, 2 ** 20)
+        for i in range(3):
+            queue.append([("a.b", (i, 1.0))])
+        queue.take()
+        queue.close()
+
+        queue = DiskQueue(self.path, 1, 2 ** 20)
+        self.assertEqual(2, queue.size)
+        self.assertEqual([1, 2], self.takeAll(queue))
+
+    def test_partially_written_record_is_discarded(self):
+        queue = DiskQueue(self.path, 2 ** 20, 2 ** 20)
+        queue.append([("a.b", (0, 1.0))])
+        queue.close()
+        segment = [n for n in os.listdir(self.path) if n.endswith('.segment')][0]
+        open(os.path.join(self.path, segment), 'ab').write('\x00\x01')
+
+        queue = DiskQueue(self.path, 2 ** 20, 2 ** 20)
+        self.assertEqual(1, queue.size)
+        queue.append([("a.b", (1, 1.0))])
+        self.assertEqual([0, 1], self.takeAll(queue))
+
+    def test_append_fails_once_full(self):
+        queue = DiskQueue(self.path, 2 ** 20, 1)
+        self.assertTrue(queue.append([("a.b", (0, 1.0))]))
+        self.assertFalse(queue.append([("a.b", (1, 1.0))]))
+        self.assertEqual(1, queue.size)
+
+    def test_age_of_empty_queue(self):
+        queue = DiskQueue(self.path, 2 ** 20, 2 ** 20)
+        self.assertEqual(0.0, queue.age())
+        queue.append([("a.b", (0, 1.0))])
+        self.assertTrue(queue.age() >= 0.0)
+
+    def test_single_datapoints_are_written_as_one_record(self):
+        queue = DiskQueue(self.path, 2 ** 20, 2 ** 20, record_size=3)
+        queue.append([("a.b", (0, 1.0))])
+        queue.append([("a.b", (1, 1.0))])
+        self.assertEqual(2, queue.size)
+        self.assertEqual(0, queue.bytes)
+        queue.append([("a.b", (2, 1.0))])
+        queue.append([("a.b", (3, 1.0))])
+        self.assertEqual(4, queue.size)
+        # Taking flushes out what is still pending as a record of its own
+        self.assertEqual([0, 1, 2], [t for (m, (t, v)) in queue.take()[0]])
+        self.assertEqual([3], [t for (m, (t, v)) in queue.take()[0]])
+        self.assertEqual(0, queue.size)
+
+    def test_unencodable_datapoints_are_dropped_alone(self):
+        queue = DiskQueue(self.path, 2 ** 20, 2 ** 20, record_size=2)
+        queue.append([("a.b", (0, 1.0))])
+        queue.append([("a" * 2 ** 16, (1, 1.0)), ("a.b", (2, 1.0))])
+        self.assertEqual(2, queue.size)
+        self.assertEqual([], queue.pending)
+        self.assertEqual([0, 2], self.takeAll(queue))
+        self.assertEqual(0, queue.size)
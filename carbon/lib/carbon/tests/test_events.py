@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from carbon.events import BatchEvent, DatapointEvent
+
+
+class DatapointEventTest(TestCase):
+
+    def setUp(self):
+        self.batchEvent = BatchEvent("metricsTest")
+        self.event = DatapointEvent("metricTest", self.batchEvent)
+
+    def test_single_datapoint_is_sent_as_batch(self):
+        """Firing the single datapoint event fires a batch of one."""
+        batches = []
+        self.batchEvent.addHandler(batches.append)
+        self.event("a.b", (10.0, 1.0))
+        self.assertEqual([[("a.b", (10.0, 1.0))]], batches)
+
+    def test_single_datapoint_handler_sees_each_datapoint(self):
+        """Handlers added to the single datapoint event get every datapoint
+        of a batch and can be removed again."""
+        received = []
+        handler = lambda metric, datapoint: received.append(metric)
+        self.event.addHandler(handler)
+        self.batchEvent([("a.b", (10.0, 1.0)), ("c.d", (10.0, 2.0))])
+        self.event.removeHandler(handler)
+        self.batchEvent([("e.f", (10.0, 3.0))])
+        self.assertEqual(["a.b", "c.d"], received)
+
+    def test_failing_datapoint_does_not_abort_the_batch(self):
+        """An exception on one datapoint is logged and the rest of the
+        batch is still handled."""
+        received = []
+        def handler(metric, datapoint):
+            if metric == "bad":
+                raise ValueError(metric)
+            received.append(metric)
+        self.event.addHandler(handler)
+        self.batchEvent([("a.b", (10.0, 1.0)), ("bad", (10.0, 2.0)), ("c.d", (10.0, 3.0))])
+        self.assertEqual(["a.b", "c.d"], received)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from carbon.hashing import ConsistentHashRing, JumpHashRing, RendezvousHashRing
+
+
+NODES = [("10.0.0.%d" % i, "a") for i in range(1, 6)]
+KEYS = ["servers.host%d.cpu" % i for i in range(1000)]
+
+
+class HashRingTest(TestCase):
+
+    def test_first_of_get_nodes_is_get_node(self):
+        for ring_class in (ConsistentHashRing, JumpHashRing, RendezvousHashRing):
+            ring = ring_class(NODES)
+            for key in KEYS[:100]:
+                nodes = ring.get_nodes(key)
+                self.assertEqual(ring.get_node(key), nodes[0])
+                self.assertEqual(sorted(NODES), sorted(nodes))
+
+    def test_ring_is_sorted(self):
+        ring = ConsistentHashRing(NODES)
+        self.assertEqual(sorted(ring.ring), ring.ring)
+        self.assertEqual(500, len(ring.ring))
+
+    def test_added_node_only_takes_keys(self):
+        """Keys either stay put or move to the added node."""
+        for ring_class in (JumpHashRing, RendezvousHashRing):
+            before = ring_class(NODES[:4])
+            after = ring_class(NODES)
+            moved = 0
+            for key in KEYS:
+                if before.get_node(key) != after.get_node(key):
+                    self.assertEqual(NODES[4], after.get_node(key))
+                    moved += 1
+            self.assertTrue(100 < moved < 300)
+
+    def test_rendezvous_weights(self):
+        ring = RendezvousHashRing(NODES[:2], weights={NODES[0]: 3.0})
+        heavy = len([key for key in KEYS if ring.get_node(key) == NODES[0]])
+        self.assertTrue(650 < heavy < 850)
@@ -0,0 +1,169 @@
+import zlib
+from os.path import dirname, join
+from unittest import TestCase
+
+from carbon.conf import settings
+settings.setdefault("CONF_DIR", join(dirname(__file__), "data"))
+
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from carbon import events, instrumentation, state
+from carbon.binaryformat import decodeDatapoints, encodeDatapoints
+from carbon.client import CarbonClientFactory, QueuedBatch
+from carbon.compression import COMPRESSION_REQUEST
+from carbon.protocols import MetricLineReceiver, MetricBinaryReceiver
+
+state.events = events
+state.instrumentation = instrumentation
+
+
+class MetricLineReceiverTest(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        events.metricsReceived.addHandler(self.batches.append)
+        self.protocol = MetricLineReceiver()
+        self.protocol.peerName = "peer"
+        self.protocol.transport = StringTransport()
+
+    def tearDown(self):
+        events.metricsReceived.removeHandler(self.batches.append)
+
+    def test_chunk_dispatched_as_single_batch(self):
+        """All complete lines in a chunk are delivered as one batch."""
+        self.protocol.dataReceived("a.b 1 10\nc.d 2 20\n")
+        self.assertEqual(
+            [[("a.b", (10.0, 1.0)), ("c.d", (20.0, 2.0))]], self.batches)
+
+    def test_partial_line_is_buffered(self):
+        """A trailing partial line is completed by the following chunk."""
+        self.protocol.dataReceived("a.b 1 10\nc.d 2")
+        self.protocol.dataReceived(" 20\n")
+        self.assertEqual(
+            [[("a.b", (10.0, 1.0))], [("c.d", (20.0, 2.0))]], self.batches)
+
+    def test_invalid_and_nan_lines_are_dropped(self):
+        """Malformed lines and NaN values don't make it into the batch."""
+        self.protocol.dataReceived("garbage\na.b nan 10\n\nc.d 2 20\n")
+        self.assertEqual([[("c.d", (20.0, 2.0))]], self.batches)
+
+    def test_overlong_line_drops_connection(self):
+        """A partial line longer than MAX_LENGTH disconnects the client."""
+        self.protocol.dataReceived("x" * (MetricLineReceiver.MAX_LENGTH + 1))
+        self.assertTrue(self.protocol.transport.disconnecting)
+        self.assertEqual([], self.batches)
+
+
+class BinaryFormatTest(TestCase):
+
+    def test_round_trip(self):
+        """Encoded batches decode to the same datapoints."""
+        datapoints = [("a.b", (10.0, 1.5)), ("c.d", (10.0, 2.0)),
+                      ("a.b", (20.0, -3.25))]
+        self.assertEqual(datapoints, decodeDatapoints(encodeDatapoints(datapoints)))
+
+    def test_unicode_names(self):
+        """Unicode names, as a pickle can carry, are sent UTF-8 encoded."""
+        datapoints = [(u"a.b", (10.0, 1.5)), (u"caf\xe9.b", (10.0, 2.0))]
+        self.assertEqual([("a.b", (10.0, 1.5)), ("caf\xc3\xa9.b", (10.0, 2.0))],
+                         decodeDatapoints(encodeDatapoints(datapoints)))
+
+    def test_empty_batch(self):
+        self.assertEqual([], decodeDatapoints(encodeDatapoints([])))
+
+    def test_malformed_messages_raise_value_error(self):
+        """Truncated or inconsistent messages are rejected."""
+        message = encodeDatapoints([("a.b", (10.0, 1.5))])
+        self.assertRaises(ValueError, decodeDatapoints, message[:-1])
+        self.assertRaises(ValueError, decodeDatapoints, message + "x")
+        self.assertRaises(ValueError, decodeDatapoints, "\x02" + message[1:])
+        # A record pointing past the name table
+        bad_id = message[:-20] + "\x00\x00\x00\x01" + message[-16:]
+        self.assertRaises(ValueError, decodeDatapoints, bad_id)
+
+
+class CompressionTest(TestCase):
+
+    def setUp(self):
+        self.saved = (settings["DESTINATION_COMPRESSION"], settings["DESTINATION_PROTOCOL"])
+        settings["DESTINATION_COMPRESSION"] = "zlib"
+        settings["DESTINATION_PROTOCOL"] = "binary"
+        self.batches = []
+        events.metricsReceived.addHandler(self.batches.append)
+
+        self.factory = CarbonClientFactory(("127.0.0.1", 2004, None))
+        self.client = self.factory.connections[0].buildProtocol(None)
+        self.client.makeConnection(StringTransport())
+        self.receiver = MetricBinaryReceiver()
+        self.receiver.makeConnection(StringTransport())
+
+    def tearDown(self):
+        settings["DESTINATION_COMPRESSION"], settings["DESTINATION_PROTOCOL"] = self.saved
+        events.metricsReceived.removeHandler(self.batches.append)
+        self.client.connectionLost(Failure(ConnectionDone()))
+        self.receiver.connectionLost(Failure(ConnectionDone()))
+
+    def deliver(self, source, destination):
+        data = source.transport.value()
+        source.transport.clear()
+        destination.dataReceived(data)
+        return data
+
+    def test_negotiated_connection_is_compressed(self):
+        batch = [("servers.host1.cpu.usage", (float(t), 1.0)) for t in range(100)]
+        self.factory.sendBatch(QueuedBatch(batch))
+        self.assertEqual(100, self.factory.queueSize) # held back while negotiating
+
+        self.deliver(self.client, self.receiver)
+        self.deliver(self.receiver, self.client)
+        self.assertTrue(self.client.compressor is not None)
+        self.assertEqual(0, self.factory.queueSize)
+
+        compressed = self.deliver(self.client, self.receiver)
+        self.assertEqual([batch], self.batches)
+        self.assertTrue(len(compressed) < len(encodeDatapoints(batch)) / 2)
+
+    def test_falls_back_to_uncompressed(self):
+        """Destinations that never answer are reconnected to and sent
+        uncompressed data, nothing is sent uncompressed after a request."""
+        self.client.negotiationTimeout.cancel()
+        self.client.negotiationTimedOut()
+        self.assertTrue(self.client.transport.disconnecting)
+        self.client.connectionLost(Failure(ConnectionDone()))
+
+        batch = [("a.b", (10.0, 1.0))]
+        self.factory.sendBatch(QueuedBatch(batch))
+        self.client = self.factory.connections[0].buildProtocol(None)
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(encodeDatapoints(batch), self.client.transport.value()[4:])
+
+        # Once that connection is lost the next one asks again
+        self.client.connectionLost(Failure(ConnectionDone()))
+        self.client = self.factory.connections[0].buildProtocol(None)
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(COMPRESSION_REQUEST, self.client.transport.value()[4:])
+
+    def test_oversized_compressed_frame_is_not_inflated(self):
+        """A small compressed message that inflates past MAX_LENGTH drops
+        the connection after at most one frame's worth is decompressed."""
+        self.deliver(self.client, self.receiver)
+        self.deliver(self.receiver, self.client)
+        before = instrumentation.stats.get('compression.bytesDecompressed', 0)
+
+        compressor = zlib.compressobj()
+        bomb = compressor.compress("\x7f\xff\xff\xff" + "\x00" * 2 ** 25) + compressor.flush()
+        self.receiver.dataReceived(bomb)
+        self.assertTrue(self.receiver.transport.disconnecting)
+        decompressed = instrumentation.stats['compression.bytesDecompressed'] - before
+        self.assertTrue(decompressed <= MetricBinaryReceiver.MAX_LENGTH + 4)
+        self.assertEqual([], self.batches)
+
+    def test_negotiation_keeps_a_transport_pause(self):
+        """Finishing the negotiation doesn't resume a connection the
+        transport paused in the meantime."""
+        self.client.pauseProducing()
+        self.client.compressionNegotiated()
+        self.assertTrue(self.client.paused)
+        self.client.resumeProducing()
+        self.assertFalse(self.client.paused)
@@ -0,0 +1,55 @@
+import os
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from carbon.regexlist import RegexList
+
+
+class RegexListTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.list_file = join(self.tmpdir, "blacklist.conf")
+        self.regex_list = RegexList("blacklist")
+        self.regex_list.list_file = self.list_file
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def write_list(self, lines, mtime):
+        f = open(self.list_file, "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+        os.utime(self.list_file, (mtime, mtime))
+
+    def test_patterns_are_combined(self):
+        """Plain patterns get compiled into a single alternation."""
+        self.write_list(["# comment", "", "^foo\\.", "bar$"], 1000)
+        self.regex_list.read_list()
+        self.assertNotEqual(None, self.regex_list.combined_regex)
+        self.assertTrue("foo.baz" in self.regex_list)
+        self.assertTrue("baz.bar" in self.regex_list)
+        self.assertFalse("baz.qux" in self.regex_list)
+
+    def test_backreferences_are_matched_separately(self):
+        """Patterns with backreferences are not combined."""
+        self.write_list(["(a)\\1", "^(b)x\\1"], 1000)
+        self.regex_list.read_list()
+        self.assertEqual(None, self.regex_list.combined_regex)
+        self.assertTrue("xaa" in self.regex_list)
+        self.assertTrue("bxb" in self.regex_list)
+        self.assertFalse("bxa" in self.regex_list)
+
+    def test_reload_invalidates_cached_verdicts(self):
+        """Verdicts are cached until a changed list is read."""
+        self.write_list(["^foo"], 1000)
+        self.regex_list.read_list()
+        self.assertFalse("bar" in self.regex_list)
+        self.assertFalse("bar" in self.regex_list)
+        self.assertEqual((1, 1), self.regex_list.reset_stats()[:2])
+
+        self.write_list(["^foo", "^bar"], 2000)
+        self.regex_list.read_list()
+        self.assertTrue("bar" in self.regex_list)
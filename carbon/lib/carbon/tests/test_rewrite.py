@@ -0,0 +1,64 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from carbon.rewrite import RewriteRuleManager, RewriteRule, RewriteRuleSet
+
+
+REWRITE_RULES = """
+[pre]
+^servers\\.old\\. = servers.new.
+\\.new\\. = .newer.
+
+[post]
+_sum$ =
+"""
+
+
+class RewriteRuleSetTest(TestCase):
+
+    def linear(self, rules, metric):
+        for rule in rules:
+            metric = rule.apply(metric)
+        return metric
+
+    def test_rules_apply_in_order(self):
+        rules = [RewriteRule(r"^a\.", "b."), RewriteRule(r"^b\.", "c.")]
+        rule_set = RewriteRuleSet('pre')
+        rule_set.set_rules(rules)
+        self.assertTrue(rule_set.combined_regex is not None)
+        for metric in ["a.x", "b.x", "c.x", "x.a"]:
+            self.assertEqual(self.linear(rules, metric), rule_set.apply(metric))
+            self.assertEqual(self.linear(rules, metric), rule_set.apply(metric))
+        self.assertEqual((4, 4), rule_set.cache.resetStats())
+
+    def test_uncombinable_rules(self):
+        rules = [RewriteRule(r"(\w+)\.\1", r"\1"), RewriteRule(r"(?i)CPU", "cpu")]
+        rule_set = RewriteRuleSet('pre')
+        rule_set.set_rules(rules)
+        self.assertEqual(None, rule_set.combined_regex)
+        self.assertEqual("a.cpu", rule_set.apply("a.a.CPU"))
+
+
+class RewriteRuleManagerTest(TestCase):
+
+    def setUp(self):
+        fd, self.rules_path = tempfile.mkstemp()
+        os.write(fd, REWRITE_RULES)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.rules_path)
+        RewriteRuleManager.clear()
+        RewriteRuleManager.rules_last_read = 0.0
+
+    def test_reading_rules_invalidates_the_caches(self):
+        RewriteRuleManager.rules_file = self.rules_path
+        RewriteRuleManager.read_rules()
+        self.assertEqual("servers.newer.cpu", RewriteRuleManager.preRules.apply("servers.old.cpu"))
+        self.assertEqual("cpu", RewriteRuleManager.postRules.apply("cpu_sum"))
+
+        RewriteRuleManager.rules_last_read = 0.0
+        RewriteRuleManager.read_rules()
+        self.assertEqual(0, len(RewriteRuleManager.preRules.cache))
+        self.assertEqual(0, len(RewriteRuleManager.postRules.cache))
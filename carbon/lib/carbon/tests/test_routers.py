@@ -0,0 +1,123 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from carbon.relayrules import CompiledRelayRules, isAnchored
+from carbon.routers import ConsistentHashingRouter, RelayRulesRouter
+
+
+RELAY_RULES = """
+[carbon]
+pattern = ^carbon\\.
+destinations = 10.0.0.1:2004:a
+
+[mirror]
+pattern = CPU
+destinations = 10.0.0.2:2004:a
+continue = true
+
+[repeated]
+pattern = (\\w+)\\.\\1
+destinations = 10.0.0.3:2004:a
+
+[disk]
+pattern = (disk|io)\\.
+destinations = 10.0.0.4:2004:a
+continue = true
+
+[default]
+default = true
+destinations = 10.0.0.5:2004:a
+"""
+
+
+class ConsistentHashingRouterTest(TestCase):
+
+    def setUp(self):
+        self.router = ConsistentHashingRouter(replication_factor=2)
+        for destination in [("10.0.0.1", 2004, "a"), ("10.0.0.2", 2004, "a"),
+                            ("10.0.0.3", 2004, "a")]:
+            self.router.addDestination(destination)
+
+    def test_cached_destinations_match_the_ring(self):
+        for i in range(100):
+            metric = "servers.host%d.cpu" % i
+            expected = tuple(self.router.computeDestinations(metric))
+            self.assertEqual(expected, self.router.getDestinations(metric))
+            self.assertEqual(expected, self.router.getDestinations(metric))
+        self.assertEqual((100, 100), self.router.cache.resetStats())
+
+    def test_ring_changes_invalidate_the_cache(self):
+        metric = "servers.host1.cpu"
+        before = self.router.getDestinations(metric)
+        self.router.removeDestination(before[0])
+        after = self.router.getDestinations(metric)
+        self.assertFalse(before[0] in after)
+        self.assertEqual(tuple(self.router.computeDestinations(metric)), after)
+
+    def test_key_function_change_invalidates_the_cache(self):
+        self.router.getDestinations("servers.host1.cpu")
+        self.router.setKeyFunction(lambda metric: "constant")
+        self.assertEqual(0, len(self.router.cache))
+
+    def test_unroutable_datapoints_are_skipped(self):
+        def keyFunction(metric):
+            if metric == "bad":
+                raise ValueError("cannot route %s" % metric)
+            return metric
+        self.router.setKeyFunction(keyFunction)
+        datapoints = [("servers.host1.cpu", (1, 1.0)), ("bad", (1, 2.0)),
+                      ("servers.host1.cpu", (2, 3.0))]
+        groups = self.router.groupByDestinations(datapoints)
+        self.assertEqual([[datapoints[0], datapoints[2]]], groups.values())
+
+
+class RelayRulesRouterTest(TestCase):
+
+    def setUp(self):
+        fd, self.rules_path = tempfile.mkstemp()
+        os.write(fd, RELAY_RULES)
+        os.close(fd)
+        self.router = RelayRulesRouter(self.rules_path)
+        for i in range(1, 6):
+            self.router.addDestination(("10.0.0.%d" % i, 2004, "a"))
+
+    def tearDown(self):
+        os.unlink(self.rules_path)
+
+    def linearScan(self, metric):
+        destinations = []
+        for rule in self.router.rules:
+            if rule.matches(metric):
+                destinations.extend(rule.destinations)
+                if not rule.continue_matching:
+                    break
+        return tuple(destinations)
+
+    def test_compiled_rules_match_like_a_linear_scan(self):
+        for metric in ["carbon.agents.cpu", "servers.host1.cpu.usage",
+                       "servers.host1.host1.cpu", "servers.disk.cpu",
+                       "servers.disk.io.reads", "servers.host1.memory"]:
+            self.assertEqual(self.linearScan(metric), self.router.getDestinations(metric))
+
+    def test_continue_is_honoured(self):
+        self.assertEqual((("10.0.0.2", 2004, "a"), ("10.0.0.4", 2004, "a"), ("10.0.0.5", 2004, "a")),
+                         self.router.getDestinations("servers.disk.cpu"))
+
+    def test_many_rules_are_split_into_chunks(self):
+        rules = self.router.rules[:1] * 150 + self.router.rules[-1:]
+        matcher = CompiledRelayRules(rules)
+        self.assertEqual([rules[0]], list(matcher.matchingRules("carbon.x")))
+        self.assertEqual([rules[-1]], list(matcher.matchingRules("servers.x")))
+        self.assertTrue(len(matcher.chunks[0]) > 1)
+
+    def test_reloading_rules_clears_the_cache(self):
+        self.router.getDestinations("servers.host1.memory")
+        self.router.loadRules()
+        self.assertEqual(0, len(self.router.cache))
+
+    def test_anchored_patterns(self):
+        self.assertTrue(isAnchored(r"^carbon\."))
+        self.assertTrue(isAnchored(r"^a|^b"))
+        self.assertFalse(isAnchored(r"^a|b"))
+        self.assertFalse(isAnchored(r"carbon"))
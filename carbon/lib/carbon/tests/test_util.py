@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from carbon.util import LRUCache
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_key_is_evicted(self):
+        """Once full, the key that was used longest ago is evicted."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+        self.assertEqual(2, len(cache))
+
+    def test_hits_and_misses_are_counted(self):
+        """get() counts hits and misses until resetStats() is called."""
+        cache = LRUCache(10)
+        cache["a"] = 1
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual((1, 1), cache.resetStats())
+        self.assertEqual((0, 0), cache.resetStats())
+
+    def test_pop_removes_key(self):
+        cache = LRUCache(10)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(1, cache.pop("a"))
+        self.assertEqual(None, cache.pop("a"))
+        cache["c"] = 3
+        self.assertEqual(["b", "c"], [k for k in ("a", "b", "c") if k in cache])
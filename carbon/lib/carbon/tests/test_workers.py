@@ -0,0 +1,75 @@
+from unittest import TestCase
+
+from twisted.test.proto_helpers import StringTransport
+
+from carbon.conf import settings
+from carbon.binaryformat import encodeDatapoints
+from carbon.protocols import WorkerChannelReceiver
+from carbon.workers import WorkerChannelFactory, WorkerChannelSender, STATS_MESSAGE
+from carbon import instrumentation
+import carbon.service # sets up state.events and state.instrumentation
+
+
+class FakeChannel:
+    connected = True
+
+    def __init__(self):
+        self.sent = []
+        self.stats = []
+
+    def sendDatapoints(self, datapoints):
+        self.sent.extend(datapoints)
+
+    def sendStats(self, stats):
+        self.stats.append(stats)
+
+
+class WorkerChannelFactoryTest(TestCase):
+
+    def setUp(self):
+        self.max_queue_size = settings.MAX_QUEUE_SIZE
+        settings.MAX_QUEUE_SIZE = 3
+        instrumentation.stats.clear()
+        self.factory = WorkerChannelFactory(0)
+        self.factory.listening = True
+
+    def tearDown(self):
+        settings.MAX_QUEUE_SIZE = self.max_queue_size
+        instrumentation.stats.clear()
+        if self.factory.stats_task.running:
+            self.factory.stats_task.stop()
+
+    def test_batches_are_buffered_while_disconnected(self):
+        datapoints = [("a.%d" % i, (0, i)) for i in range(4)]
+        self.factory.sendDatapoints(datapoints[:2])
+        self.factory.sendDatapoints(datapoints[2:3])
+        self.factory.sendDatapoints(datapoints[3:])
+        self.assertEqual(1, instrumentation.stats['receiverProcessDrops'])
+
+        channel = FakeChannel()
+        self.factory.connected(channel)
+        self.assertEqual(datapoints[:3], channel.sent)
+        self.assertEqual([], self.factory.pending)
+
+    def test_stats_are_forwarded(self):
+        channel = FakeChannel()
+        self.factory.connected(channel)
+        instrumentation.increment('metricsReceived', 5)
+        instrumentation.increment('compression.bytesReceived', 10)
+        self.factory.sendStats()
+        self.assertEqual([{'compression.bytesReceived': 10}], channel.stats)
+        self.assertEqual({}, instrumentation.stats)
+
+    def test_daemon_adds_forwarded_stats(self):
+        receiver = WorkerChannelReceiver()
+        receiver.peerName = "receiver process"
+        receiver.messageReceived(STATS_MESSAGE + encodeDatapoints([('whitelist.cacheHits', (0, 7))]))
+        self.assertEqual(7, instrumentation.stats['whitelist.cacheHits'])
+
+    def test_unencodable_batches_are_counted(self):
+        sender = WorkerChannelSender()
+        sender.factory = self.factory
+        sender.makeConnection(StringTransport())
+        sender.sendDatapoints([("a" * 2 ** 16, (0, 1))])
+        self.assertEqual('', sender.transport.value())
+        self.assertEqual(1, instrumentation.stats['receiverProcessDrops'])
@@ -111,6 +111,83 @@ def parseDestinations(destination_strings):
 
 
 
+class LRUCache(object):
+  """A mapping bounded to max_size entries that evicts the least recently
+  used key when full. Lookups through get() are counted as hits and misses
+  so callers can report their hit rate."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.clear()
+
+  def clear(self):
+    # Entries are [previous, next, key, value] links of a circular doubly
+    # linked list ordered from least to most recently used.
+    self.links = {}
+    self.root = []
+    self.root[:] = [self.root, self.root, None, None]
+
+  def __len__(self):
+    return len(self.links)
+
+  def __contains__(self, key):
+    return key in self.links
+
+  def _moveToEnd(self, link):
+    previous, next = link[0], link[1]
+    previous[1] = next
+    next[0] = previous
+    root = self.root
+    last = root[0]
+    last[1] = root[0] = link
+    link[0] = last
+    link[1] = root
+
+  def get(self, key, default=None):
+    link = self.links.get(key)
+    if link is None:
+      self.misses += 1
+      return default
+
+    self.hits += 1
+    self._moveToEnd(link)
+    return link[3]
+
+  def __setitem__(self, key, value):
+    link = self.links.get(key)
+    if link is not None:
+      link[3] = value
+      self._moveToEnd(link)
+      return
+
+    root = self.root
+    last = root[0]
+    link = [last, root, key, value]
+    last[1] = root[0] = self.links[key] = link
+
+    if len(self.links) > self.max_size:
+      oldest = root[1]
+      root[1] = oldest[1]
+      oldest[1][0] = root
+      del self.links[oldest[2]]
+
+  def pop(self, key, default=None):
+    link = self.links.pop(key, None)
+    if link is None:
+      return default
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+    return link[3]
+
+  def resetStats(self):
+    """Returns (hits, misses) since the last call and resets both counters"""
+    stats = (self.hits, self.misses)
+    self.hits = self.misses = 0
+    return stats
+
+
 # This whole song & dance is due to pickle being insecure
 # yet performance critical for carbon. We leave the insecure
 # mode (which is faster) as an option (USE_INSECURE_UNPICKLER).
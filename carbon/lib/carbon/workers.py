@@ -0,0 +1,338 @@
+"""Multi-process receivers.
+
+With RECEIVER_PROCESSES set, a carbon daemon spawns that many receiver
+processes instead of listening for metrics itself. Each receiver binds the
+line, pickle, binary and UDP ports with SO_REUSEPORT so the kernel spreads
+connections (and datagrams) across them, parses and filters what it gets,
+and forwards the resulting batches to the daemon over a local UNIX socket
+using the binary format from carbon.binaryformat. Everything past parsing
+(the cache, aggregation, routing) stays in the daemon's own process.
+
+Receivers buffer up to MAX_QUEUE_SIZE datapoints while the daemon is
+unreachable and count what they drop beyond that. Their own stats (drops,
+whitelist and blacklist matching, compression) are sent to the daemon
+every WORKER_STATS_INTERVAL seconds, prefixed with STATS_MESSAGE, and
+reported with the daemon's. Worker processes exit once the daemon that
+spawned them is gone.
+"""
+
+import os
+import sys
+import socket
+from os.path import dirname, exists
+
+from twisted.application.service import Service
+from twisted.internet import reactor, tcp, udp
+from twisted.internet.task import LoopingCall
+from twisted.internet.protocol import ProcessProtocol, ReconnectingClientFactory
+from twisted.internet.error import ProcessDone
+from twisted.protocols.basic import Int32StringReceiver
+from carbon.conf import settings
+from carbon.util import pickle
+from carbon.binaryformat import encodeDatapoints
+from carbon import log, events, state, instrumentation
+
+
+# Linux's value, older Pythons don't expose the constant
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+WORKER_RESPAWN_DELAY = 5
+WORKER_STATS_INTERVAL = 10
+PARENT_CHECK_INTERVAL = 1
+STATS_MESSAGE = '\x00carbon-worker-stats'
+
+
+class ReusePortTCPPort(tcp.Port):
+  def createInternetSocket(self):
+    s = tcp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+class ReusePortUDPPort(udp.Port):
+  def createInternetSocket(self):
+    s = udp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+def getChannelPath():
+  return os.path.splitext(settings['pidfile'])[0] + '.receivers.sock'
+
+
+#
+# Daemon side
+#
+
+class ReceiverProcessProtocol(ProcessProtocol):
+  def __init__(self, supervisor, worker_id):
+    self.supervisor = supervisor
+    self.worker_id = worker_id
+    self.output = ''
+
+  def connectionMade(self):
+    self.transport.write(pickle.dumps(dict(settings), protocol=-1))
+    self.transport.closeStdin()
+
+  def outReceived(self, data):
+    lines = (self.output + data).split('\n')
+    self.output = lines.pop()
+    for line in lines:
+      log.listener('%s %d: %s' % (self.supervisor.worker_name, self.worker_id, line))
+
+  errReceived = outReceived
+
+  def processEnded(self, reason):
+    self.supervisor.workerEnded(self.worker_id, reason)
+
+
+class ReceiverSupervisor(Service):
+  "Spawns the receiver processes and respawns them if they die"
+  worker_name = 'receiver'
+  worker_module = 'carbon.workers'
+
+  def __init__(self, count):
+    self.count = count
+    self.processes = {}
+
+  def startService(self):
+    Service.startService(self)
+    for worker_id in range(self.count):
+      self.spawn(worker_id)
+
+  def stopService(self):
+    Service.stopService(self)
+    for process in self.processes.values():
+      try:
+        process.signalProcess('TERM')
+      except:
+        pass
+    self.processes.clear()
+
+  def spawn(self, worker_id):
+    if not self.running:
+      return
+
+    env = dict(os.environ)
+    lib_dir = dirname(dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [lib_dir, env.get('PYTHONPATH')]))
+    args = [sys.executable, '-m', self.worker_module] + self.getArgs(worker_id)
+
+    log.listener("starting %s process %d" % (self.worker_name, worker_id))
+    self.processes[worker_id] = reactor.spawnProcess(
+      ReceiverProcessProtocol(self, worker_id), sys.executable, args, env=env)
+
+  def getArgs(self, worker_id):
+    return [getChannelPath(), str(worker_id)]
+
+  def workerEnded(self, worker_id, reason):
+    self.processes.pop(worker_id, None)
+    if not self.running:
+      return
+
+    if reason.check(ProcessDone):
+      log.listener("%s process %d exited" % (self.worker_name, worker_id))
+    else:
+      log.listener("%s process %d died: %s" % (self.worker_name, worker_id, reason.value))
+    reactor.callLater(WORKER_RESPAWN_DELAY, self.spawn, worker_id)
+
+
+def createReceiverServices(root_service):
+  from twisted.application.internet import UNIXServer
+  from twisted.internet.protocol import ServerFactory
+  from carbon.protocols import WorkerChannelReceiver
+
+  channel_path = getChannelPath()
+  if exists(channel_path):
+    os.unlink(channel_path)
+
+  factory = ServerFactory()
+  factory.protocol = WorkerChannelReceiver
+  service = UNIXServer(channel_path, factory, mode=0600)
+  service.setServiceParent(root_service)
+
+  service = ReceiverSupervisor(int(settings.RECEIVER_PROCESSES))
+  service.setServiceParent(root_service)
+
+
+#
+# Receiver process side
+#
+
+class WorkerChannelSender(Int32StringReceiver):
+  "Forwards parsed batches to the daemon, pausing receivers on backpressure"
+
+  def connectionMade(self):
+    self.transport.registerProducer(self, streaming=True)
+    self.factory.connected(self)
+
+  def pauseProducing(self):
+    events.pauseReceivingMetrics()
+
+  def resumeProducing(self):
+    events.resumeReceivingMetrics()
+
+  def stopProducing(self):
+    pass
+
+  def sendDatapoints(self, datapoints):
+    for i in xrange(0, len(datapoints), settings.MAX_DATAPOINTS_PER_MESSAGE):
+      batch = datapoints[i:i + settings.MAX_DATAPOINTS_PER_MESSAGE]
+      try:
+        message = encodeDatapoints(batch)
+      except:
+        log.err(None, "Failed to encode a batch of %d datapoints, dropping it" % len(batch))
+        instrumentation.increment(self.factory.drop_stat, len(batch))
+        continue
+      self.sendString(message)
+
+  def sendStats(self, stats):
+    "Sends a dict of counters to be added to the daemon's own"
+    self.sendString(STATS_MESSAGE + encodeDatapoints([(stat, (0, value)) for stat, value in stats.items()]))
+
+
+class ChannelFactory(ReconnectingClientFactory):
+  """Sends batches over a channel, holding up to MAX_QUEUE_SIZE datapoints
+  while it is down and counting what is dropped beyond that in drop_stat"""
+  protocol = WorkerChannelSender
+  maxDelay = 5
+  drop_stat = 'receiverProcessDrops'
+
+  def __init__(self, worker_id):
+    self.worker_id = worker_id
+    self.channel = None
+    self.pending = []
+    self.pendingCount = 0
+    self.dropped = 0
+
+  def log(self, message):
+    log.listener("channel %d %s" % (self.worker_id, message))
+
+  def connected(self, channel):
+    self.resetDelay()
+    self.channel = channel
+
+    pending, self.pending, self.pendingCount = self.pending, [], 0
+    for datapoints in pending:
+      channel.sendDatapoints(datapoints)
+    if self.dropped:
+      self.log("dropped %d datapoints while the channel was down" % self.dropped)
+      self.dropped = 0
+
+  def sendDatapoints(self, datapoints):
+    if self.channel is not None and self.channel.connected:
+      self.channel.sendDatapoints(datapoints)
+    elif self.pendingCount + len(datapoints) <= settings.MAX_QUEUE_SIZE:
+      self.pending.append(datapoints)
+      self.pendingCount += len(datapoints)
+    else:
+      if not self.dropped:
+        self.log("buffer is full, dropping datapoints until the channel is back")
+      self.dropped += len(datapoints)
+      instrumentation.increment(self.drop_stat, len(datapoints))
+
+  def clientConnectionLost(self, connector, reason):
+    self.log("lost its channel: %s" % reason.value)
+    self.channel = None
+    ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class WorkerChannelFactory(ChannelFactory):
+  "The receiver process end of the channel to the daemon"
+
+  def __init__(self, worker_id):
+    ChannelFactory.__init__(self, worker_id)
+    self.listening = False
+    self.stats_task = LoopingCall(self.sendStats)
+
+  def log(self, message):
+    log.listener("receiver %d %s" % (self.worker_id, message))
+
+  def connected(self, channel):
+    ChannelFactory.connected(self, channel)
+    if not self.stats_task.running:
+      self.stats_task.start(WORKER_STATS_INTERVAL, now=False)
+    if not self.listening:
+      self.listening = True
+      startListening()
+
+  def sendStats(self):
+    if self.channel is None or not self.channel.connected:
+      return
+
+    # The daemon counts metricsReceived itself as the batches arrive
+    stats = dict([(stat, value) for stat, value in instrumentation.stats.items()
+                  if stat != 'metricsReceived' and not isinstance(value, list)])
+    instrumentation.stats.clear()
+
+    from carbon.regexlist import WhiteList, BlackList
+    for regex_list in (WhiteList, BlackList):
+      if regex_list:
+        hits, misses, matchTime = regex_list.reset_stats()
+        stats['%s.cacheHits' % regex_list.name] = hits
+        stats['%s.cacheMisses' % regex_list.name] = misses
+        stats['%s.matchTime' % regex_list.name] = matchTime
+
+    if stats:
+      self.channel.sendStats(stats)
+
+
+def exitWithParent():
+  "Stops the reactor once the daemon that spawned this process has exited"
+  parent_pid = os.getppid()
+
+  def checkParent():
+    if os.getppid() != parent_pid:
+      log.msg("parent process %d is gone, exiting" % parent_pid)
+      reactor.stop()
+
+  task = LoopingCall(checkParent)
+  task.start(PARENT_CHECK_INTERVAL, now=False)
+  return task
+
+
+def startListening():
+  from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
+                                MetricBinaryReceiver, MetricDatagramReceiver)
+  from twisted.internet.protocol import ServerFactory
+
+  for interface, port, protocol in ((settings.LINE_RECEIVER_INTERFACE,
+                                     settings.LINE_RECEIVER_PORT,
+                                     MetricLineReceiver),
+                                    (settings.PICKLE_RECEIVER_INTERFACE,
+                                     settings.PICKLE_RECEIVER_PORT,
+                                     MetricPickleReceiver),
+                                    (settings.BINARY_RECEIVER_INTERFACE,
+                                     settings.BINARY_RECEIVER_PORT,
+                                     MetricBinaryReceiver)):
+    if port:
+      factory = ServerFactory()
+      factory.protocol = protocol
+      ReusePortTCPPort(int(port), factory, interface=interface, reactor=reactor).startListening()
+
+  if settings.ENABLE_UDP_LISTENER:
+    ReusePortUDPPort(int(settings.UDP_RECEIVER_PORT), MetricDatagramReceiver(),
+                     interface=settings.UDP_RECEIVER_INTERFACE, reactor=reactor).startListening()
+
+  if settings.USE_WHITELIST:
+    from carbon.regexlist import WhiteList, BlackList
+    WhiteList.read_from(settings["whitelist"])
+    BlackList.read_from(settings["blacklist"])
+
+
+def main():
+  channel_path, worker_id = sys.argv[1], int(sys.argv[2])
+  settings.update(pickle.load(sys.stdin))
+  log.logToStdout()
+
+  state.events = events
+  state.instrumentation = instrumentation
+
+  factory = WorkerChannelFactory(worker_id)
+  events.metricsReceived.addHandler(factory.sendDatapoints)
+  reactor.connectUNIX(channel_path, factory)
+  exitWithParent()
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -131,6 +131,16 @@ except:
   warning += 1
 
 
+# Test for scandir
+try:
+  import scandir
+except:
+  print "[WARNING]"
+  print "Unable to import the 'scandir' module, do you have scandir installed for python %s?" % py_version
+  print "This feature is not required but speeds up finding metrics in the webapp.\n"
+  warning += 1
+
+
 # Test for python-ldap
 try:
   import ldap
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Measures how many metrics per second carbon-aggregator can map to their
+aggregate metrics: testing every rule in order as it used to, through the
+rule index alone, and through the index behind the rule manager's cache
+(every metric is seen once per simulated interval). --rules rules of the
+form 'servers.groupN.<host>.cpu.usage' are generated along with a few
+wildcard rules every metric is a candidate for. The linear scan is timed
+over a sample of the metrics, as it is far too slow to run over millions.
+"""
+
+import sys, os
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from carbon.conf import settings
+from carbon.aggregator.rules import AggregationRule, RuleManager
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def buildRules(count):
+  rules = [AggregationRule('servers.group%d.<host>.cpu.usage' % i, 'servers.group%d.all.cpu.usage' % i, 'sum', 60)
+           for i in xrange(count)]
+  rules.append(AggregationRule('servers.*.<host>.memory', 'servers.all.memory', 'avg', 60))
+  rules.append(AggregationRule('<<metric>>.total', '<metric>.all', 'sum', 60))
+  return rules
+
+
+def linearScan(rules, metric):
+  aggregates = []
+  for rule in rules:
+    aggregate_metric = rule.get_aggregate_metric(metric)
+    if aggregate_metric is not None:
+      aggregates.append( (rule, aggregate_metric) )
+  return aggregates
+
+
+def indexed(metric):
+  aggregates = []
+  for rule in RuleManager.index.candidates(metric):
+    aggregate_metric = rule.get_aggregate_metric(metric)
+    if aggregate_metric is not None:
+      aggregates.append( (rule, aggregate_metric) )
+  return aggregates
+
+
+def rate(match, metrics, intervals):
+  start = cpuTime()
+  for interval in xrange(intervals):
+    for metric in metrics:
+      match(metric)
+  return len(metrics) * intervals / (cpuTime() - start)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--rules', type='int', default=2000, help="Number of aggregation rules (default 2000)")
+  parser.add_option('--metrics', type='int', default=1000000, help="Distinct metrics (default 1000000)")
+  parser.add_option('--intervals', type='int', default=2, help="Times each metric is seen (default 2)")
+  parser.add_option('--sample', type='int', default=2000, help="Metrics timed with the linear scan (default 2000)")
+  parser.add_option('--cache-size', type='int', default=None, help="AGGREGATION_RULE_CACHE_SIZE (default: enough for every metric)")
+  options, args = parser.parse_args()
+
+  settings['AGGREGATION_RULE_CACHE_SIZE'] = options.cache_size or options.metrics
+  rules = buildRules(options.rules)
+  RuleManager.set_rules(rules)
+
+  metrics = ['servers.group%d.host%d.%s' % (i % options.rules, i, ('cpu.usage', 'memory')[i % 2])
+             for i in xrange(options.metrics)]
+  sample = metrics[:options.sample]
+
+  print "%d rules, %d metrics x %d intervals" % (len(rules), options.metrics, options.intervals)
+  print "%-22s %14s" % ("method", "metrics/sec")
+  print "%-22s %14d" % ("linear scan", rate(lambda metric: linearScan(rules, metric), sample, 1))
+  print "%-22s %14d" % ("index", rate(indexed, metrics, 1))
+  print "%-22s %14d" % ("index + cache", rate(RuleManager.get_aggregate_metrics, metrics, options.intervals))
+  print "cache holds %d entries; per-rule caches would hold %d" % (len(RuleManager.cache), len(rules) * options.metrics)
+
+
+if __name__ == '__main__':
+  main()
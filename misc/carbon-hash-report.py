@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Compares the hashing methods a relay can route with. For each method it
+reports how evenly a set of metric names is spread over the destinations
+(the busiest and idlest destination relative to a perfectly even share),
+and which fraction of the names land on a different destination after a
+membership change (the ideal being the share of the added or removed
+destinations). Metric names can be read from a file, one per line, or
+are generated.
+"""
+
+import sys
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from carbon.hashing import ConsistentHashRing, JumpHashRing, RendezvousHashRing
+
+
+RINGS = [
+  ('consistent-hashing', ConsistentHashRing),
+  ('jump-hashing', JumpHashRing),
+  ('rendezvous-hashing', RendezvousHashRing),
+]
+
+
+def placements(ring_class, nodes, keys):
+  ring = ring_class(nodes)
+  return [ring.get_node(key) for key in keys]
+
+
+def skew(nodes, placed):
+  counts = dict((node, 0) for node in nodes)
+  for node in placed:
+    counts[node] += 1
+  even = float(len(placed)) / len(nodes)
+  return (max(counts.values()) / even, min(counts.values()) / even)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--nodes', type='int', default=10, help="Destinations before the change (default 10)")
+  parser.add_option('--add', type='int', default=1, help="Destinations added at the end (default 1)")
+  parser.add_option('--remove', type='int', default=0, help="Destinations removed from the end (default 0)")
+  parser.add_option('--keys', type='int', default=100000, help="Generated metric names (default 100000)")
+  parser.add_option('--metrics-file', help="Read metric names from this file instead")
+  options, args = parser.parse_args()
+
+  if options.metrics_file:
+    keys = [line.strip() for line in open(options.metrics_file) if line.strip()]
+  else:
+    keys = ['servers.host%d.cpu%d.usage' % (i / 16, i % 16) for i in xrange(options.keys)]
+
+  before = [('10.0.%d.%d' % (i / 256, i % 256), 'a') for i in xrange(options.nodes + options.add)]
+  after = before[:options.nodes + options.add - options.remove]
+  before = before[:options.nodes]
+  changed = abs(len(after) - len(before)) / float(max(len(before), len(after)))
+
+  print "%d metrics, %d -> %d destinations (ideal movement %.1f%%)" % (len(keys), len(before), len(after), changed * 100)
+  print "%-20s %10s %10s %10s" % ("method", "max/even", "min/even", "moved")
+  for name, ring_class in RINGS:
+    old = placements(ring_class, before, keys)
+    new = placements(ring_class, after, keys)
+    moved = sum([1 for (a, b) in zip(old, new) if a != b]) / float(len(keys))
+    high, low = skew(after, new)
+    print "%-20s %10.3f %10.3f %9.1f%%" % (name, high, low, moved * 100)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Reports the resident memory carbon needs per million active metrics.
+
+Two intervals worth of plaintext datapoints for --metrics distinct metrics
+are fed through MetricLineReceiver into either a MetricCache that is
+drained in between as the writer would (the cache scenario) or the
+aggregator with a per-host and a global rule (the
+aggregator scenario), with a blacklist enabled so its verdict cache holds
+every name as well. Each scenario runs in a fresh process so the RSS
+figures don't influence each other.
+"""
+
+import sys, os, time
+from os.path import dirname, join, abspath
+from optparse import OptionParser, SUPPRESS_HELP
+from subprocess import Popen, PIPE
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+CPUS_PER_HOST = 16
+RULES = [
+  'servers.<host>.cpu.usage (60) = sum servers.<host>.*.usage',
+  'servers.all.cpu.usage (60) = avg servers.*.*.usage',
+]
+
+
+def rss():
+  return int( open('/proc/self/statm').read().split()[1] ) * os.sysconf('SC_PAGESIZE')
+
+
+def feed(protocol, metrics, timestamp, chunk_lines=5000):
+  for start in xrange(0, metrics, chunk_lines):
+    protocol.dataReceived(''.join(['servers.host%d.cpu%d.usage %d %d\n' %
+                                   (i / CPUS_PER_HOST, i % CPUS_PER_HOST, i, timestamp)
+                                   for i in xrange(start, min(start + chunk_lines, metrics))]))
+
+
+def measure(scenario, metrics):
+  from carbon.conf import settings
+  settings.setdefault('CONF_DIR', join(ROOT_DIR, 'carbon', 'conf'))
+
+  from twisted.test.proto_helpers import StringTransport
+  from carbon import state, events, instrumentation, protocols
+  from carbon.aggregator import rules, receiver
+  from carbon.cache import MetricCache
+  from carbon.regexlist import BlackList
+  state.events = events
+  state.instrumentation = instrumentation
+
+  BlackList.set_patterns(['^nothing\\.matches\\.this'])
+  BlackList.cache.max_size = float('inf')
+
+  if scenario == 'cache':
+    events.metricsReceived.addHandler(MetricCache.storeMany)
+  else:
+    rules.RuleManager.set_rules([rules.RuleManager.parse_definition(rule) for rule in RULES])
+    events.metricsReceived.addHandler(receiver.process_many)
+
+  protocol = protocols.MetricLineReceiver()
+  protocol.peerName = 'benchmark'
+  protocol.transport = StringTransport()
+
+  baseline = rss()
+  now = int( time.time() )
+  feed(protocol, metrics, now - 60)
+  if scenario == 'cache': # the writer drains the cache between intervals
+    for metric in MetricCache.keys():
+      MetricCache.pop(metric)
+  feed(protocol, metrics, now)
+  return rss() - baseline
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--metrics', type='int', default=1000000, help="Number of distinct metrics (default 1000000)")
+  parser.add_option('--measure', help=SUPPRESS_HELP)
+  options, args = parser.parse_args()
+
+  if options.measure:
+    print measure(options.measure, options.metrics)
+    return
+
+  print "RSS growth per million active metrics (%d metrics fed)" % options.metrics
+  for scenario in ('cache', 'aggregator'):
+    command = [sys.executable, abspath(__file__), '--metrics', str(options.metrics), '--measure', scenario]
+    output = Popen(command, stdout=PIPE).communicate()[0]
+    growth = int(output.strip().splitlines()[-1]) * 1000000.0 / options.metrics / 2 ** 20
+    print "%-10s  %8.1f MB" % (scenario, growth)
+
+if __name__ == '__main__':
+  main()
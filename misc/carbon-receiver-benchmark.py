@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Measures how many plaintext protocol lines per second of CPU time a single
+core can push through carbon's line receiver, comparing the batching
+MetricLineReceiver with the legacy receiver, which filtered each line and
+fired a per-datapoint metricReceived event for it.
+
+The receivers are fed from memory through a fake transport, so the numbers
+cover parsing, filtering and event dispatch but no socket I/O.
+"""
+
+import sys, os, time
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from twisted.internet.error import ConnectionDone
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from carbon.conf import settings
+settings.setdefault('CONF_DIR', join(ROOT_DIR, 'carbon', 'conf'))
+
+from carbon import state, events, instrumentation
+from carbon.protocols import MetricLineReceiver
+from carbon.regexlist import WhiteList, BlackList
+from carbon import log
+
+state.events = events
+state.instrumentation = instrumentation
+
+
+# The per-datapoint event the legacy receiver fired, with its default handler
+legacyMetricReceived = events.Event('metricReceived')
+legacyMetricReceived.addHandler(lambda metric, datapoint: instrumentation.increment('metricsReceived'))
+
+
+class LegacyMetricLineReceiver(LineOnlyReceiver):
+  "The line receiver as it was before batching was introduced"
+  delimiter = '\n'
+
+  def connectionMade(self):
+    self.peerName = 'benchmark'
+
+  def lineReceived(self, line):
+    try:
+      metric, value, timestamp = line.strip().split()
+      datapoint = ( float(timestamp), float(value) )
+    except:
+      log.listener('invalid line received from client %s, ignoring' % self.peerName)
+      return
+
+    self.metricReceived(metric, datapoint)
+
+  def metricReceived(self, metric, datapoint):
+    if BlackList and metric in BlackList:
+      instrumentation.increment('blacklistMatches')
+      return
+    if WhiteList and metric not in WhiteList:
+      instrumentation.increment('whitelistRejects')
+      return
+    if datapoint[1] == datapoint[1]: # filter out NaN values
+      legacyMetricReceived(metric, datapoint)
+
+
+def generateChunks(lines, chunk_size):
+  now = int( time.time() )
+  data = ''.join(['servers.host%d.cpu.core%d.usage %f %d\n' % (i % 1000, i % 16, i * 0.5, now)
+                  for i in xrange(lines)])
+  return [data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)]
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def run(protocol_class, chunks, lines):
+  protocol = protocol_class()
+  protocol.makeConnection(StringTransport())
+
+  start = cpuTime()
+  for chunk in chunks:
+    protocol.dataReceived(chunk)
+  elapsed = cpuTime() - start
+
+  protocol.connectionLost(Failure(ConnectionDone()))
+  return lines / max(elapsed, 0.000001)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--lines', type='int', default=1000000, help="Number of lines to send (default 1000000)")
+  parser.add_option('--chunk-size', type='int', default=65536, help="Bytes per dataReceived call (default 65536)")
+  options, args = parser.parse_args()
+
+  received = [0]
+  def countMany(datapoints):
+    received[0] += len(datapoints)
+  events.metricsReceived.addHandler(countMany)
+  legacyMetricReceived.addHandler(lambda metric, datapoint: countMany([(metric, datapoint)]))
+
+  chunks = generateChunks(options.lines, options.chunk_size)
+  print "Feeding %d lines in %d chunks of %d bytes" % (options.lines, len(chunks), options.chunk_size)
+
+  for name, protocol_class in (('legacy', LegacyMetricLineReceiver),
+                               ('batched', MetricLineReceiver)):
+    received[0] = 0
+    rate = run(protocol_class, chunks, options.lines)
+    assert received[0] == options.lines, "%s receiver lost datapoints" % name
+    print "%-8s %12.0f lines/sec/core" % (name, rate)
+
+
+if __name__ == '__main__':
+  main()
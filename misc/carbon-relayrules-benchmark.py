@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Measures how many metrics per second relay rules can route: scanning
+the rules one regex at a time as carbon-relay used to, with the compiled
+matcher alone, and with the compiled matcher behind the router's cache
+(every metric is routed once per simulated interval). A rules file with
+--rules sections of the form 'pattern = ^servers\\.groupN\\.' is generated;
+metrics are spread evenly over the groups, so the average metric matches
+halfway down the list.
+"""
+
+import sys, os, tempfile
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from carbon.routers import RelayRulesRouter
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def writeRules(count):
+  fd, path = tempfile.mkstemp(suffix='.conf')
+  rules = ["[group%d]\npattern = ^servers\\.group%d\\.\ndestinations = 10.0.0.%d:2004\n" % (i, i, i % 4 + 1)
+           for i in xrange(count)]
+  rules.append("[default]\ndefault = true\ndestinations = 10.0.0.1:2004\n")
+  os.write(fd, '\n'.join(rules))
+  os.close(fd)
+  return path
+
+
+def linearScan(router, metric):
+  destinations = []
+  for rule in router.rules:
+    if rule.matches(metric):
+      for destination in rule.destinations:
+        if destination in router.destinations:
+          destinations.append(destination)
+      if not rule.continue_matching:
+        break
+  return destinations
+
+
+def rate(route, metrics, intervals):
+  start = cpuTime()
+  for interval in xrange(intervals):
+    for metric in metrics:
+      route(metric)
+  return len(metrics) * intervals / (cpuTime() - start)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--rules', type='int', default=300, help="Number of relay rules (default 300)")
+  parser.add_option('--metrics', type='int', default=20000, help="Distinct metrics (default 20000)")
+  parser.add_option('--intervals', type='int', default=3, help="Times each metric is routed (default 3)")
+  options, args = parser.parse_args()
+
+  path = writeRules(options.rules)
+  try:
+    router = RelayRulesRouter(path)
+  finally:
+    os.unlink(path)
+  for i in xrange(4):
+    router.addDestination(('10.0.0.%d' % (i + 1), 2004, None))
+
+  metrics = ['servers.group%d.host%d.cpu' % (i % options.rules, i) for i in xrange(options.metrics)]
+
+  def compiled(metric):
+    return tuple(router.computeDestinations(metric))
+
+  print "%d rules, %d metrics x %d intervals" % (options.rules, options.metrics, options.intervals)
+  print "%-22s %14s" % ("method", "metrics/sec")
+  print "%-22s %14d" % ("linear scan", rate(lambda metric: linearScan(router, metric), metrics, options.intervals))
+  print "%-22s %14d" % ("compiled", rate(compiled, metrics, options.intervals))
+  print "%-22s %14d" % ("compiled + cache", rate(router.getDestinations, metrics, options.intervals))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second the consistent hashing router
+can route, with and without its routing decision cache. Every metric is
+routed once per simulated interval, as a relay sees them.
+"""
+
+import sys, os
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from carbon.conf import settings
+from carbon.routers import ConsistentHashingRouter
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def route(router, metrics, intervals, batch_size):
+  datapoints = [(metric, (0, 1.0)) for metric in metrics]
+  start = cpuTime()
+  for interval in xrange(intervals):
+    for i in xrange(0, len(datapoints), batch_size):
+      router.groupByDestinations(datapoints[i:i + batch_size])
+  return len(datapoints) * intervals / (cpuTime() - start)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--metrics', type='int', default=100000, help="Distinct metrics (default 100000)")
+  parser.add_option('--intervals', type='int', default=5, help="Times each metric is routed (default 5)")
+  parser.add_option('--destinations', type='int', default=8, help="Ring size (default 8)")
+  parser.add_option('--replication', type='int', default=2, help="Replication factor (default 2)")
+  options, args = parser.parse_args()
+
+  metrics = ['servers.host%d.cpu%d.usage' % (i / 16, i % 16) for i in xrange(options.metrics)]
+
+  print "%-10s %18s" % ("cache", "datapoints/sec")
+  for cache_size in (0, options.metrics):
+    settings['ROUTER_CACHE_SIZE'] = cache_size
+    router = ConsistentHashingRouter(options.replication)
+    for i in xrange(options.destinations):
+      router.addDestination(('10.0.0.%d' % (i + 1), 2004, None))
+    rate = route(router, metrics, options.intervals, settings.MAX_DATAPOINTS_PER_MESSAGE)
+    hits, misses = router.cache.resetStats()
+    print "%-10s %18d   (hit rate %.1f%%)" % (cache_size and 'on' or 'off', rate,
+                                              100.0 * hits / max(hits + misses, 1))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Times filling a relay destination's send queue with a backlog and then
+draining it message by message, as a relay does when a destination comes
+back after an outage. Compares the deque backed SendQueue against the
+list slicing queue it replaced, whose drain time grows quadratically.
+"""
+
+import sys, os, time
+from os.path import dirname, join, abspath
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'carbon', 'lib'))
+
+from carbon.conf import settings
+from carbon.util import pickle
+from carbon.client import SendQueue
+
+
+def serialize(datapoints):
+  return pickle.dumps(datapoints, protocol=-1)
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def drainList(points, datapoint):
+  "The original list based queue"
+  start = cpuTime()
+  queue = []
+  for i in xrange(points):
+    queue.append(datapoint)
+  while queue:
+    datapoints = queue[:settings.MAX_DATAPOINTS_PER_MESSAGE]
+    queue = queue[settings.MAX_DATAPOINTS_PER_MESSAGE:]
+    serialize(datapoints)
+  return cpuTime() - start
+
+
+def drainSendQueue(points, datapoint):
+  start = cpuTime()
+  queue = SendQueue()
+  for i in xrange(points):
+    queue.append(datapoint)
+  while queue.size:
+    queue.takeBatch().getPayload(serialize)
+  return cpuTime() - start
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--points', type='int', default=10000000, help="Backlog size (default 10000000)")
+  parser.add_option('--max-list-points', type='int', default=1000000,
+    help="Largest backlog to try with the list based queue (default 1000000)")
+  options, args = parser.parse_args()
+
+  datapoint = ('servers.host1.cpu.usage', (time.time(), 42.0))
+  sizes = [options.points / 100, options.points / 10, options.points]
+
+  print "%12s %16s %16s" % ("backlog", "list queue (s)", "SendQueue (s)")
+  for points in sizes:
+    if points <= options.max_list_points:
+      listTime = "%16.2f" % drainList(points, datapoint)
+    else:
+      listTime = "%16s" % "skipped"
+    print "%12d %s %16.2f" % (points, listTime, drainSendQueue(points, datapoint))
+
+
+if __name__ == '__main__':
+  main()
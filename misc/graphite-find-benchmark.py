@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Times metric finds over a synthetic whisper tree the way the webapp
+runs them: listing each directory and stat'ing every entry, using the entry
+types from scandir, with the directory listing cache warm, and from the
+in-memory metric index (USE_METRIC_INDEX). A tree of
+--metrics empty .wsp files is generated under --root unless it already
+exists, laid out as servers.hostN.groupN.metricN with --hosts hosts and ten
+groups per host. Expanding the patterns is also timed on its own, without
+building the nodes found, and the stat calls each method makes are counted.
+"""
+
+import sys, os, time, tempfile
+from os.path import dirname, join, abspath, exists
+from optparse import OptionParser
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'webapp'))
+
+GROUPS = 10
+QUERIES = [
+  'servers.host1.group1.metric1',
+  'servers.host1*.group1.*',
+  'servers.*.group{1,2}.metric1',
+  'servers.*.*.metric1',
+]
+
+
+def cpuTime():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def buildTree(root, metrics, hosts):
+  per_group = max(metrics / (hosts * GROUPS), 1)
+  for host in xrange(hosts):
+    for group in xrange(GROUPS):
+      path = join(root, 'servers', 'host%d' % host, 'group%d' % group)
+      os.makedirs(path)
+      for metric in xrange(per_group):
+        open(join(path, 'metric%d.wsp' % metric), 'w').close()
+  # Let the directories age past the cache's granularity
+  time.sleep(1.5)
+
+
+class StatCounter:
+  def __init__(self):
+    self.calls = 0
+    self.stat = os.stat
+
+  def __call__(self, path):
+    self.calls += 1
+    return self.stat(path)
+
+
+def run(storage, root, repeat, use_scandir, use_cache, lister=None):
+  scandir = storage.scandir
+  if not use_scandir:
+    storage.scandir = None
+  counter = StatCounter()
+  os.stat = counter
+
+  try:
+    results = 0
+    start = cpuTime()
+    for i in xrange(repeat):
+      for query in QUERIES:
+        if not use_cache:
+          storage.directory_listings.clear()
+        results += len(list(storage.find(root, query, lister)))
+    elapsed = cpuTime() - start
+
+    # Expanding the patterns into paths alone, without building the nodes
+    start = cpuTime()
+    for i in xrange(repeat):
+      for query in QUERIES:
+        if not use_cache:
+          storage.directory_listings.clear()
+        list(storage._find(root, query.split('.'), lister or storage.list_directory))
+    expansion = cpuTime() - start
+  finally:
+    os.stat = counter.stat
+    storage.scandir = scandir
+
+  queries = repeat * len(QUERIES)
+  return (elapsed / queries, expansion / queries, counter.calls / queries / 2, results)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--root', default='/tmp/graphite-find-benchmark', help="Directory of the synthetic tree")
+  parser.add_option('--metrics', type='int', default=1000000, help="Metrics in the tree (default 1000000)")
+  parser.add_option('--hosts', type='int', default=1000, help="Hosts in the tree (default 1000)")
+  parser.add_option('--repeat', type='int', default=3, help="Times each query is run (default 3)")
+  options, args = parser.parse_args()
+
+  # The webapp's default settings, logging to a scratch storage directory
+  storage_dir = tempfile.mkdtemp()
+  os.makedirs(join(storage_dir, 'log', 'webapp'))
+  os.environ['GRAPHITE_STORAGE_DIR'] = storage_dir
+  os.environ['DJANGO_SETTINGS_MODULE'] = 'graphite.settings'
+  from graphite import storage
+
+  if not exists(options.root):
+    print "building a tree of %d metrics under %s" % (options.metrics, options.root)
+    buildTree(options.root, options.metrics, options.hosts)
+
+  start = time.time()
+  index = storage.MetricIndex(options.root)
+  index.refresh()
+  print "indexed %s in %.2f seconds" % (options.root, time.time() - start)
+
+  if storage.scandir is None:
+    print "scandir is not available, only the stat based find can be timed"
+    methods = [("listdir + stat", False, False, None)]
+  else:
+    methods = [("listdir + stat", False, False, None),
+               ("scandir", True, False, None),
+               ("scandir + cache", True, True, None)]
+  methods.append( ("metric index", True, True, index.list_directory) )
+
+  print "%d queries over %s" % (len(QUERIES), options.root)
+  print "%-18s %14s %14s %14s" % ("method", "ms/query", "expansion ms", "stats/query")
+  expected = None
+  for name, use_scandir, use_cache, lister in methods:
+    if use_cache and not lister: # warm the cache
+      run(storage, options.root, 1, use_scandir, use_cache)
+    seconds, expansion, stats, results = run(storage, options.root, options.repeat, use_scandir, use_cache, lister)
+    if expected is not None and results != expected:
+      print "%s found %d nodes instead of %d" % (name, results, expected)
+    expected = results
+    print "%-18s %14.2f %14.2f %14d" % (name, seconds * 1000, expansion * 1000, stats)
+
+
+if __name__ == '__main__':
+  main()
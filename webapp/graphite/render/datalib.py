@@ -18,7 +18,7 @@ import time
 from django.conf import settings
 from graphite.logger import log
 from graphite.storage import STORE, LOCAL_STORE
-from graphite.render.hashing import ConsistentHashRing
+from graphite.render.hashing import HASH_RINGS
 
 try:
   import cPickle as pickle
@@ -97,7 +97,8 @@ class CarbonLinkPool:
     self.hosts = [ (server, instance) for (server, port, instance) in hosts ]
     self.ports = dict( ((server, instance), port) for (server, port, instance) in hosts )
     self.timeout = float(timeout)
-    self.hash_ring = ConsistentHashRing(self.hosts)
+    ring_class = HASH_RINGS[settings.CARBONLINK_HASHING_TYPE]
+    self.hash_ring = ring_class(self.hosts)
     self.connections = {}
     self.last_failure = {}
     # Create a connection pool for each host
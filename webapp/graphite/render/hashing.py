@@ -20,6 +20,7 @@ try:
 except ImportError:
   from md5 import md5
 import bisect
+from math import log as ln
 
 def hashRequest(request):
   # Normalize the request parameters so ensure we're deterministic
@@ -67,11 +68,13 @@ class ConsistentHashRing:
     return small_hash
 
   def add_node(self, key):
+    entries = []
     for i in range(self.replica_count):
       replica_key = "%s:%d" % (key, i)
       position = self.compute_ring_position(replica_key)
-      entry = (position, key)
-      bisect.insort(self.ring, entry)
+      entries.append( (position, key) )
+    self.ring.extend(entries)
+    self.ring.sort()
 
   def remove_node(self, key):
     self.ring = [entry for entry in self.ring if entry[1] != key]
@@ -83,3 +86,64 @@ class ConsistentHashRing:
     index %= len(self.ring)
     entry = self.ring[index]
     return entry[1]
+
+
+# These must place keys exactly like carbon.hashing, or CarbonLink asks the
+# wrong carbon-cache for a metric's cached datapoints.
+
+def compute_key_hash(key):
+  return int(md5( str(key) ).hexdigest()[:16], 16)
+
+
+def jump_hash(key_hash, bucket_count):
+  bucket, j = -1, 0
+  while j < bucket_count:
+    bucket = j
+    key_hash = (key_hash * 2862933555777941757 + 1) & 0xffffffffffffffff
+    j = int( (bucket + 1) * (float(1 << 31) / float((key_hash >> 33) + 1)) )
+  return bucket
+
+
+class JumpHashRing:
+  def __init__(self, nodes):
+    self.nodes = []
+    for node in nodes:
+      self.add_node(node)
+
+  def add_node(self, key):
+    if key not in self.nodes:
+      self.nodes.append(key)
+
+  def remove_node(self, key):
+    if key in self.nodes:
+      self.nodes.remove(key)
+
+  def get_node(self, key):
+    return self.nodes[ jump_hash(compute_key_hash(key), len(self.nodes)) ]
+
+
+class RendezvousHashRing:
+  def __init__(self, nodes, weights=None):
+    self.weights = {}
+    for node in nodes:
+      self.add_node(node, (weights or {}).get(node, 1.0))
+
+  def add_node(self, key, weight=1.0):
+    self.weights[key] = float(weight)
+
+  def remove_node(self, key):
+    self.weights.pop(key, None)
+
+  def compute_score(self, node, key):
+    position = (compute_key_hash("%s:%s" % (node, key)) + 1) / float(2 ** 64 + 1)
+    return -self.weights[node] / ln(position)
+
+  def get_node(self, key):
+    return max([ (self.compute_score(node, key), node) for node in self.weights ])[1]
+
+
+HASH_RINGS = {
+  'consistent-hashing' : ConsistentHashRing,
+  'jump-hashing' : JumpHashRing,
+  'rendezvous-hashing' : RendezvousHashRing,
+}
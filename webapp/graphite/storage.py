@@ -1,7 +1,8 @@
-import os, time, fnmatch, socket, errno
+import os, time, fnmatch, socket, errno, threading
 from os.path import isdir, isfile, join, exists, splitext, basename, realpath
 import whisper
 from graphite.remote_storage import RemoteStore
+from graphite.logger import log
 from django.conf import settings
 
 try:
@@ -14,6 +15,11 @@ try:
 except ImportError:
   gzip = False
 
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = getattr(os, 'scandir', None)
+
 try:
   import cPickle as pickle
 except ImportError:
@@ -59,7 +65,7 @@ class Store:
   def find_first(self, query):
     # Search locally first
     for directory in self.directories:
-      for match in find(directory, query):
+      for match in find_local(directory, query):
         return match
 
     # If nothing found earch remotely
@@ -77,7 +83,7 @@ class Store:
 
     # Search locally
     for directory in self.directories:
-      for match in find(directory, query):
+      for match in find_local(directory, query):
         if match.metric_path not in found:
           yield match
           found.add(match.metric_path)
@@ -131,12 +137,26 @@ def find_escaped_pattern_fields(pattern_string):
       yield index
 
 
-def find(root_dir, pattern):
-  "Generates nodes beneath root_dir matching the given pattern"
+def find_local(root_dir, pattern):
+  """Finds the nodes beneath root_dir matching the given pattern with the
+  metric index when it is enabled, and on the filesystem when it isn't or
+  the index is not built yet or stale"""
+  if settings.USE_METRIC_INDEX:
+    index = get_metric_index(root_dir)
+    index.refresh()
+    if index.is_current():
+      return find(root_dir, pattern, index.list_directory)
+
+  return find(root_dir, pattern)
+
+
+def find(root_dir, pattern, lister=None):
+  """Generates nodes beneath root_dir matching the given pattern, listing
+  directories with lister (by default list_directory)"""
   clean_pattern = pattern.replace('\\', '')
   pattern_parts = clean_pattern.split('.')
 
-  for absolute_path in _find(root_dir, pattern_parts):
+  for absolute_path, is_dir in _find(root_dir, pattern_parts, lister or list_directory):
 
     if DATASOURCE_DELIMETER in basename(absolute_path):
       (absolute_path,datasource_pattern) = absolute_path.rsplit(DATASOURCE_DELIMETER,1)
@@ -152,10 +172,10 @@ def find(root_dir, pattern):
       metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
     metric_path = '.'.join(metric_path_parts)
 
-    if isdir(absolute_path):
+    if is_dir:
       yield Branch(absolute_path, metric_path)
 
-    elif isfile(absolute_path):
+    else:
       (metric_path,extension) = splitext(metric_path)
 
       if extension == '.wsp':
@@ -177,18 +197,16 @@ def find(root_dir, pattern):
               yield source
 
 
-def _find(current_dir, patterns):
-  """Recursively generates absolute paths whose components underneath current_dir
-  match the corresponding pattern in patterns"""
+def _find(current_dir, patterns, lister):
+  """Recursively generates (absolute path, is directory) for the paths whose
+  components underneath current_dir match the corresponding pattern in patterns"""
   pattern = patterns[0]
   patterns = patterns[1:]
-  entries = os.listdir(current_dir)
+  subdirs, files = lister(current_dir)
 
-  subdirs = [e for e in entries if isdir( join(current_dir,e) )]
   matching_subdirs = match_entries(subdirs, pattern)
 
   if len(patterns) == 1 and rrdtool: #the last pattern may apply to RRD data sources
-    files = [e for e in entries if isfile( join(current_dir,e) )]
     rrd_files = match_entries(files, pattern + ".rrd")
 
     if rrd_files: #let's assume it does
@@ -196,21 +214,163 @@ def _find(current_dir, patterns):
 
       for rrd_file in rrd_files:
         absolute_path = join(current_dir, rrd_file)
-        yield absolute_path + DATASOURCE_DELIMETER + datasource_pattern
+        yield (absolute_path + DATASOURCE_DELIMETER + datasource_pattern, False)
 
   if patterns: #we've still got more directories to traverse
     for subdir in matching_subdirs:
 
       absolute_path = join(current_dir, subdir)
-      for match in _find(absolute_path, patterns):
+      for match in _find(absolute_path, patterns, lister):
         yield match
 
   else: #we've got the last pattern
-    files = [e for e in entries if isfile( join(current_dir,e) )]
     matching_files = match_entries(files, pattern + '.*')
 
-    for basename in matching_subdirs + matching_files:
-      yield join(current_dir, basename)
+    for basename in matching_subdirs:
+      yield (join(current_dir, basename), True)
+    for basename in matching_files:
+      yield (join(current_dir, basename), False)
+
+
+# { directory : (mtime, subdirectories, files) }
+directory_listings = {}
+
+def list_directory(path):
+  """Returns the names of the subdirectories and files in a directory.
+  Listings are remembered until the directory's mtime changes, which costs
+  one stat per directory rather than one per entry. Listings of directories
+  modified in the last second aren't remembered, as further changes within
+  the mtime's granularity would go unnoticed."""
+  mtime = os.stat(path).st_mtime
+  listing = directory_listings.get(path)
+  if listing is not None and listing[0] == mtime:
+    return listing[1:]
+
+  subdirs, files = read_directory(path)
+  if time.time() - mtime > 1:
+    if len(directory_listings) >= settings.DIRECTORY_CACHE_SIZE:
+      directory_listings.clear()
+    directory_listings[path] = (mtime, subdirs, files)
+  return (subdirs, files)
+
+
+def read_directory(path):
+  """Splits a directory's entries into subdirectories and files, using the
+  entry types scandir reads along with the names where it is available
+  instead of a stat per entry"""
+  subdirs = []
+  files = []
+
+  if scandir is not None:
+    for entry in scandir(path):
+      if entry.is_dir():
+        subdirs.append(entry.name)
+      elif entry.is_file():
+        files.append(entry.name)
+
+  else:
+    for name in os.listdir(path):
+      if isdir( join(path,name) ):
+        subdirs.append(name)
+      elif isfile( join(path,name) ):
+        files.append(name)
+
+  return (subdirs, files)
+
+
+class MetricIndex:
+  """An in-memory tree of the directories and metric files beneath a data
+  directory, so finds are answered without touching the filesystem. It is
+  rescanned every METRIC_INDEX_REFRESH_INTERVAL seconds, which stats every
+  directory but only re-lists those whose mtime changed. Directories that
+  aren't indexed yet are listed from the filesystem."""
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+    self.root = None
+    self.last_refresh = 0.0
+    self.lock = threading.Lock()
+
+  def list_directory(self, path):
+    self.refresh()
+    relative_path = path[ len(self.root_dir): ].strip('/')
+    node = self.root
+    if relative_path:
+      for name in relative_path.split('/'):
+        if node is None:
+          break
+        node = node.subdirs.get(name)
+
+    if node is None:
+      return list_directory(path)
+    return (node.subdir_names, node.files)
+
+  def is_current(self):
+    "Whether the index is built and was refreshed within the interval"
+    if self.root is None:
+      return False
+    return time.time() - self.last_refresh < settings.METRIC_INDEX_REFRESH_INTERVAL
+
+  def refresh(self):
+    if time.time() - self.last_refresh < settings.METRIC_INDEX_REFRESH_INTERVAL:
+      return
+    if not self.lock.acquire(False): # another thread is on it, use the index as it is
+      return
+
+    try:
+      t = time.time()
+      self.root = self.scan(self.root_dir, self.root)
+      self.last_refresh = time.time()
+      log.info("[MetricIndex] refreshing the index of %s took %.6f seconds" % (self.root_dir, self.last_refresh - t))
+    finally:
+      self.lock.release()
+
+  def scan(self, path, node):
+    "Brings the node of the directory at path up to date, returns None if it is gone"
+    try:
+      mtime = os.stat(path).st_mtime
+
+      if node is None or node.mtime != mtime:
+        subdir_names, files = read_directory(path)
+        if node is None:
+          node = MetricIndexNode()
+        node.subdirs = dict( (name, node.subdirs.get(name)) for name in subdir_names )
+        node.subdir_names = subdir_names
+        node.files = files
+        # Changes within the mtime's granularity would go unnoticed
+        if time.time() - mtime > 1:
+          node.mtime = mtime
+        else:
+          node.mtime = None
+
+    except OSError:
+      return None
+
+    for name in node.subdir_names:
+      node.subdirs[name] = self.scan(join(path, name), node.subdirs[name])
+
+    if None in node.subdirs.values():
+      node.subdir_names = [name for name in node.subdir_names if node.subdirs[name] is not None]
+    return node
+
+
+class MetricIndexNode:
+  __slots__ = ('mtime', 'subdirs', 'subdir_names', 'files')
+
+  def __init__(self):
+    self.mtime = None
+    self.subdirs = {} # { name : MetricIndexNode }
+    self.subdir_names = []
+    self.files = []
+
+
+# { data directory : MetricIndex }
+metric_indexes = {}
+
+def get_metric_index(root_dir):
+  index = metric_indexes.get(root_dir)
+  if index is None:
+    index = metric_indexes[root_dir] = MetricIndex(root_dir)
+  return index
 
 
 def _deduplicate(entries):